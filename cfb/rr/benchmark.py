@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the RR pipeline on synthetic trade files.
+
+Generates daily files in the same {"time", "trades": [...]} shape main.run
+reads, times each stage (read, checks, window filter, PED check, weighted
+median, calc and a full run) for a range of file sizes and appends the
+timings as json lines, so runs can be compared and regressions flagged. The
+approximate (sketch) calc is timed too, with its drift from the exact RR &
+partition VWMs. The grouped median, PED and partition total kernels are
+timed with each backend (kernels.BACKENDS) and checked to give bit identical
+results:
+
+    python benchmark.py --sizes 10000 100000 1000000 --out bench.jsonl
+    python benchmark.py --sizes 10000 100000 --out new.jsonl --compare bench.jsonl
+
+@author: theo
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from pytz import timezone
+import utilities
+import containers
+import kernels
+import readers
+import main
+
+
+CALC_TIME = datetime(2020, 1, 1, 16)
+
+
+def make_trades(
+    calc_time: datetime,
+    trades_per_hour: int,
+    exchanges: int = 5,
+    outlier_rate: float = 0.0,
+    hours: int = 24,
+    seed: int = 0,
+) -> dict:
+    """
+    Synthetic trade file: a random walk price traded on 'exchanges' venues
+    over the 'hours' up to calc_time (GMT), with a share of trades priced well
+    away from the market.
+
+    Parameters
+    ----------
+    calc_time : datetime
+        the file's top level time, naive datetimes are taken as GMT.
+    trades_per_hour : int
+        number of trades in each hour.
+    exchanges : int, optional
+        number of exchanges trading. The default is 5.
+    outlier_rate : float, optional
+        share of trades priced 20-50% away from the market. The default is 0.0.
+    hours : int, optional
+        hours of trades before calc_time. The default is 24.
+    seed : int, optional
+        random seed. The default is 0.
+
+    Returns
+    -------
+    dict
+        {"time": calc time in ms, "trades": list of trade dicts}.
+
+    """
+
+    rng = np.random.default_rng(seed)
+
+    if calc_time.tzinfo is None:
+
+        calc_time = timezone("GMT").localize(calc_time)
+
+    end = int(calc_time.timestamp() * 1000)
+
+    n = trades_per_hour * hours
+
+    times = np.sort(rng.integers(end - hours * 3600 * 1000, end, n))
+
+    price = 100 * np.exp(np.cumsum(rng.normal(0, 0.0005, n)))
+
+    price *= 1 + rng.normal(0, 0.0005, n)
+
+    outliers = rng.random(n) < outlier_rate
+
+    price[outliers] *= 1 + rng.choice([-1, 1], outliers.sum()) * rng.uniform(0.2, 0.5, outliers.sum())
+
+    size = np.round(rng.exponential(0.5, n), 6)
+
+    names = [f"exchange{i}" for i in range(exchanges)]
+
+    exchange = rng.integers(0, exchanges, n)
+
+    trades = [
+        {"exchange": names[e], "time": int(t), "price": round(float(p), 2), "size": float(s)}
+        for e, t, p, s in zip(exchange, times, price, size)
+    ]
+
+    return {"time": str(end), "trades": trades}
+
+
+def write_trade_file(path: str, calc_time: datetime, **kwargs) -> str:
+    """
+    Writes a synthetic trade file as path/{date}.json, kwargs are passed to
+    make_trades. Returns the file name.
+    """
+
+    file = f"{calc_time.date()}.json"
+
+    with open(os.path.join(path, file), "w") as f:
+
+        json.dump(make_trades(calc_time, **kwargs), f)
+
+    return file
+
+
+def timed(func, *args, repeats: int = 3):
+    """
+    Runs func(*args) 'repeats' times with prints silenced, returns the
+    fastest time in seconds and the last result.
+    """
+
+    best = np.inf
+
+    for _ in range(repeats):
+
+        with contextlib.redirect_stdout(io.StringIO()):
+
+            t0 = time.perf_counter()
+
+            result = func(*args)
+
+            best = min(best, time.perf_counter() - t0)
+
+    return best, result
+
+
+def identical(a, b) -> bool:
+    """whether two kernel results (arrays, lists & tuples of them) are bit identical."""
+
+    if isinstance(a, (tuple, list)):
+
+        return type(a) == type(b) and len(a) == len(b) and all(identical(x, y) for x, y in zip(a, b))
+
+    if a is None or b is None:
+
+        return a is b
+
+    a, b = np.asarray(a), np.asarray(b)
+
+    if a.dtype != b.dtype or a.shape != b.shape:
+
+        return False
+
+    if a.dtype.kind == "f":
+
+        return np.array_equal(a.view(np.uint8), b.view(np.uint8))
+
+    return a.tolist() == b.tolist()
+
+
+def bench_kernels(df, repeats: int, partition: int = 5) -> dict:
+    """
+    Times the grouped weighted median, PED (per partition) and partition
+    totals kernels on a window of trades with each backend, returns
+    {stage: seconds} i.e. 'kernel_median_numba'. A warning is printed if a
+    backend's results are not bit identical to NumPy's.
+    """
+
+    times, price, size, codes, names = containers.as_arrays(containers.sort_by_time(df))
+
+    buckets = (times - times.min()) // (partition * 60 * 1000) if len(times) > 0 else times
+
+    n_cells = (int(buckets.max()) + 1) * len(names) if len(times) > 0 else 0
+
+    # trades without an exchange (code -1) get the last cell of their bucket.
+    cells = buckets * len(names) + np.where(codes < 0, len(names) - 1, codes)
+
+    stages = {
+        "median": lambda: kernels.grouped_weighted_median(price, size, buckets, codes),
+        "ped": lambda: kernels.grouped_ped_weighted_median(price, size, buckets, codes, 10, codes),
+        "cell_totals": lambda: kernels.cell_totals(cells, price, size, n_cells),
+    }
+
+    timings = {}
+
+    results = {}
+
+    backend = kernels.BACKEND
+
+    try:
+
+        for name in kernels.BACKENDS:
+
+            kernels.set_backend(name)
+
+            for stage, func in stages.items():
+
+                # the first call compiles (or loads the compiled) kernel.
+                func()
+
+                timings[f"kernel_{stage}_{name}"], results[stage, name] = timed(func, repeats=repeats)
+
+    finally:
+
+        kernels.set_backend(backend)
+
+    for stage, name in results:
+
+        if not identical(results[stage, name], results[stage, "numpy"]):
+
+            print(f"WARNING {name} {stage} KERNEL IS NOT BIT IDENTICAL TO NUMPY")
+
+    return timings
+
+
+def bench_size(path: str, size: int, exchanges: int, outlier_rate: float, repeats: int, relative_accuracy: float = 0.001) -> [dict, dict]:
+    """
+    Times every stage for a file of 'size' trades (spread over a day), returns
+    {stage: seconds} and the relative drift of the sketch calc from the exact
+    one {'rr_drift': ..., 'max_vwm_drift': ...}.
+    """
+
+    file = write_trade_file(
+        path, CALC_TIME, trades_per_hour=max(1, size // 24), exchanges=exchanges, outlier_rate=outlier_rate
+    )
+
+    date = timezone("GMT").localize(CALC_TIME)
+
+    timings = {}
+
+    timings["read_json"], data = timed(utilities.read_json, path + "/", file, repeats=repeats)
+
+    timings["read_json_stream"], _ = timed(readers.read_json_stream, path + "/", file, repeats=repeats)
+
+    # erroneous_check replaces the trades in place, so each repeat gets a copy.
+    timings["erroneous_check"], checked = timed(
+        lambda: utilities.erroneous_check(dict(data)), repeats=repeats
+    )
+
+    timings["filter_window"], df = timed(utilities.filter_window, checked, date, 60, repeats=repeats)
+
+    timings["trade_index"], index = timed(containers.TradeIndex, checked["trades"], repeats=repeats)
+
+    timings["window_from_index"], _ = timed(
+        utilities.filter_window, {"trades": index}, date, 60, repeats=repeats
+    )
+
+    timings["potentially_errorneous_check"], (ped_exchanges, _, _) = timed(
+        utilities.potentially_errorneous_check, df, 10, repeats=repeats
+    )
+
+    timings["weighted_median"], _ = timed(utilities.weighted_median, df, repeats=repeats)
+
+    timings.update(bench_kernels(df, repeats))
+
+    timings["calc"], (rr, output) = timed(
+        utilities.calc, df, 5, datetime.timestamp(date), True, repeats=repeats
+    )
+
+    timings["calc_sketch"], (rr_sketch, output_sketch) = timed(
+        lambda: utilities.calc(df, 5, datetime.timestamp(date), True, relative_accuracy=relative_accuracy), repeats=repeats
+    )
+
+    drift = {
+        "relative_accuracy": relative_accuracy,
+        "rr_drift": abs(rr_sketch / rr - 1),
+        "max_vwm_drift": float((output_sketch["VWM_Price"] / output["VWM_Price"] - 1).abs().max()),
+    }
+
+    with tempfile.TemporaryDirectory() as save_path:
+
+        def run():
+
+            for file in os.listdir(save_path):
+
+                os.remove(os.path.join(save_path, file))
+
+            # each repeat (and size) is timed from a cold start.
+            main.DAY_CACHE.clear()
+
+            main.BUCKET_CACHE.clear()
+
+            main.run(path + "/", save_path + "/", CALC_TIME, CALC_TIME, "days", "GMT", CALC_TIME.hour, 60, 5, [], 10, True, True)
+
+        timings["run"], _ = timed(run, repeats=repeats)
+
+    return timings, drift
+
+
+def git_commit() -> str:
+
+    try:
+
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+
+    except OSError:
+
+        return ""
+
+
+def run_benchmarks(sizes: list, exchanges: int = 5, outlier_rate: float = 0.01, repeats: int = 3, label: str = "", relative_accuracy: float = 0.001) -> pd.DataFrame:
+    """
+    Benchmarks every stage for each size.
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per size & stage with the fastest time in seconds and the
+        details of the run (commit, versions...), the calc_sketch rows with
+        its drift from the exact calc.
+
+    """
+
+    rows = []
+
+    stamp = datetime.now().isoformat(timespec="seconds")
+
+    commit = git_commit()
+
+    with tempfile.TemporaryDirectory() as path:
+
+        for size in sizes:
+
+            print(f"Benchmarking: {size} trades")
+
+            timings, drift = bench_size(path, size, exchanges, outlier_rate, repeats, relative_accuracy)
+
+            for stage, seconds in timings.items():
+
+                rows.append(
+                    {
+                        "timestamp": stamp,
+                        "label": label,
+                        "commit": commit,
+                        "python": platform.python_version(),
+                        "numpy": np.__version__,
+                        "pandas": pd.__version__,
+                        "size": size,
+                        "exchanges": exchanges,
+                        "outlier_rate": outlier_rate,
+                        "stage": stage,
+                        "seconds": seconds,
+                        "trades_per_second": size / seconds if seconds > 0 else np.nan,
+                        **(drift if stage == "calc_sketch" else {}),
+                    }
+                )
+
+    return pd.DataFrame(rows)
+
+
+def compare(results: pd.DataFrame, baseline: pd.DataFrame, tolerance: float = 0.2) -> pd.DataFrame:
+    """
+    Compares results to a baseline run, matched on size & stage (the latest
+    baseline timing of each is used).
+
+    Parameters
+    ----------
+    results : pd.DataFrame
+        output of run_benchmarks.
+    baseline : pd.DataFrame
+        earlier output of run_benchmarks.
+    tolerance : float, optional
+        allowed slowdown before a stage is flagged, 0.2 = 20%. The default is 0.2.
+
+    Returns
+    -------
+    pd.DataFrame
+        size, stage, baseline & new seconds, ratio and a 'regression' flag.
+
+    """
+
+    baseline = baseline.sort_values("timestamp").groupby(["size", "stage"]).last()["seconds"]
+
+    out = results.set_index(["size", "stage"])[["seconds"]].join(
+        baseline.rename("baseline_seconds"), how="inner"
+    )
+
+    out["ratio"] = out["seconds"] / out["baseline_seconds"]
+
+    out["regression"] = out["ratio"] > 1 + tolerance
+
+    return out.reset_index()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark the RR pipeline on synthetic trade files.")
+
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000], help="trades per file, i.e. 10000 ... 10000000")
+
+    parser.add_argument("--exchanges", type=int, default=5)
+
+    parser.add_argument("--outlier-rate", type=float, default=0.01)
+
+    parser.add_argument("--repeats", type=int, default=3)
+
+    parser.add_argument("--label", default="")
+
+    parser.add_argument("--out", default="benchmarks.jsonl", help="json lines file results are appended to")
+
+    parser.add_argument("--compare", help="json lines file of an earlier run to compare against")
+
+    parser.add_argument("--tolerance", type=float, default=0.2)
+
+    parser.add_argument("--relative-accuracy", type=float, default=0.001, help="error bound of the sketch calc")
+
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.exchanges, args.outlier_rate, args.repeats, args.label, args.relative_accuracy)
+
+    print(results.pivot(index="stage", columns="size", values="seconds").to_string())
+
+    print(f"SKETCH DRIFT: \n{results[results['stage'] == 'calc_sketch'][['size', 'relative_accuracy', 'rr_drift', 'max_vwm_drift']].to_string(index=False)}")
+
+    results.to_json(args.out, orient="records", lines=True, mode="a")
+
+    if args.compare:
+
+        comparison = compare(results, pd.read_json(args.compare, lines=True), args.tolerance)
+
+        print(comparison.to_string(index=False))
+
+        if comparison["regression"].any():
+
+            print(f"REGRESSIONS: {comparison[comparison['regression']][['size', 'stage']].values.tolist()}")
+
+            raise SystemExit(1)
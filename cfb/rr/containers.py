@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Containers for checked trades. A TradeBatch holds trades as flat typed arrays
+(int64 ms time, float64 price & size and a small integer exchange code with a
+lookup of names), about 25 bytes a trade. A TradeIndex keeps a day of trades
+sorted by time so the trades of any [start, end) window are found with a
+binary search and returned as a slice rather than by masking the whole day.
+
+@author: theo
+"""
+
+import numpy as np
+import pandas as pd
+
+
+TRADE_COLUMNS = ["exchange", "time", "price", "size"]
+
+
+class TradeBatch:
+    """
+    Struct of arrays of trades. Indexing with a slice, mask or positions
+    returns a TradeBatch of those trades (a view for slices) sharing the
+    exchange lookup.
+    """
+
+    __slots__ = ("time", "price", "size", "codes", "exchanges")
+
+    def __init__(self, time: np.ndarray, price: np.ndarray, size: np.ndarray, codes: np.ndarray, exchanges: np.ndarray):
+        """
+        Parameters
+        ----------
+        time : np.ndarray
+            int64 ms times.
+        price : np.ndarray
+            float64 prices.
+        size : np.ndarray
+            float64 sizes.
+        codes : np.ndarray
+            integer exchange code of each trade, -1 for a trade without an
+            exchange.
+        exchanges : np.ndarray
+            exchange name of each code. A trailing None is added if not
+            there, so code -1 is named None as in containers.as_arrays.
+
+        """
+
+        if len(exchanges) == 0 or exchanges[-1] is not None:
+
+            exchanges = np.append(np.asarray(exchanges, dtype=object), None)
+
+        self.time = time
+
+        self.price = price
+
+        self.size = size
+
+        self.codes = codes
+
+        self.exchanges = exchanges
+
+    @classmethod
+    def from_frame(cls, trades) -> "TradeBatch":
+        """from anything pd.DataFrame accepts with exchange, time, price & size."""
+
+        trades = pd.DataFrame(trades)
+
+        exchange = pd.Categorical(trades["exchange"])
+
+        return cls(
+            trades["time"].to_numpy(dtype=np.int64),
+            trades["price"].to_numpy(dtype=np.float64),
+            trades["size"].to_numpy(dtype=np.float64),
+            exchange.codes,
+            np.asarray(exchange.categories, dtype=object),
+        )
+
+    def __len__(self) -> int:
+
+        return len(self.time)
+
+    def __getitem__(self, rows) -> "TradeBatch":
+
+        return TradeBatch(self.time[rows], self.price[rows], self.size[rows], self.codes[rows], self.exchanges)
+
+    @property
+    def exchange(self) -> np.ndarray:
+        """exchange name of each trade."""
+
+        return self.exchanges[self.codes]
+
+    @property
+    def nbytes(self) -> int:
+
+        return self.time.nbytes + self.price.nbytes + self.size.nbytes + self.codes.nbytes
+
+    def isin(self, exchanges: list) -> np.ndarray:
+        """mask of the trades from 'exchanges'."""
+
+        return np.isin(self.codes, np.flatnonzero(np.isin(self.exchanges, list(exchanges))))
+
+    def to_frame(self) -> pd.DataFrame:
+
+        return pd.DataFrame(
+            {
+                "exchange": pd.Categorical.from_codes(self.codes, categories=self.exchanges[:-1]),
+                "time": self.time,
+                "price": self.price,
+                "size": self.size,
+            }
+        )
+
+
+def compact(trades: pd.DataFrame):
+    """
+    TradeBatch of the trades if they only have the trade columns, otherwise
+    (erroneous flags or extra fields that outputs carry) the frame as is.
+    """
+
+    if sorted(trades.columns) == sorted(TRADE_COLUMNS):
+
+        return TradeBatch.from_frame(trades)
+
+    return trades
+
+
+def as_arrays(trades) -> [np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    time, price, size, exchange codes and exchange names (indexed by code, a
+    trade without an exchange has code -1 and name None) of a TradeBatch or
+    frame of trades.
+    """
+
+    if isinstance(trades, TradeBatch):
+
+        return trades.time, trades.price, trades.size, trades.codes, trades.exchanges
+
+    codes, exchanges = pd.factorize(trades["exchange"])
+
+    return (
+        trades["time"].to_numpy(),
+        trades["price"].to_numpy(),
+        trades["size"].to_numpy(),
+        codes,
+        np.append(np.asarray(exchanges, dtype=object), None),
+    )
+
+
+def exchange_mask(trades, exchanges: list) -> np.ndarray:
+    """mask of the trades (TradeBatch or frame) from 'exchanges'."""
+
+    if isinstance(trades, TradeBatch):
+
+        return trades.isin(exchanges)
+
+    return trades["exchange"].isin(exchanges).to_numpy()
+
+
+def sort_by_time(trades):
+    """trades (TradeBatch or frame) stably sorted by time, as is if already sorted."""
+
+    if isinstance(trades, TradeBatch):
+
+        if np.all(trades.time[1:] >= trades.time[:-1]):
+
+            return trades
+
+        return trades[np.argsort(trades.time, kind="stable")]
+
+    return trades.sort_values("time", kind="stable")
+
+
+def take(trades, rows: np.ndarray) -> pd.DataFrame:
+    """frame of the trades at positions 'rows' (TradeBatch or frame)."""
+
+    if isinstance(trades, TradeBatch):
+
+        return trades[rows].to_frame()
+
+    return trades.iloc[rows].reset_index(drop=True)
+
+
+class TradeIndex:
+    """
+    Trades sorted by time with the times held as an int64 ms array:
+
+        index = TradeIndex(data["trades"])
+
+        df = index.window(start_ms, end_ms)
+
+    Trades without a readable time can never fall in a window and are left
+    out. Trades with only the trade columns are held (and windows returned)
+    as a TradeBatch. No datetime column is built, see with_datetime.
+    """
+
+    def __init__(self, trades, is_sorted: bool = False):
+        """
+        Parameters
+        ----------
+        trades : TradeBatch/list/dict/pd.DataFrame
+            trades, a TradeBatch or anything pd.DataFrame accepts, with a
+            "time" in ms.
+        is_sorted : bool, optional
+            If True the trades are already stably sorted by time (unreadable
+            times last) and are not sorted again. The default is False.
+
+        """
+
+        if isinstance(trades, TradeBatch):
+
+            self.trades = trades if is_sorted else sort_by_time(trades)
+
+            self.times = self.trades.time
+
+            return
+
+        trades = pd.DataFrame(trades)
+
+        times = pd.to_numeric(trades["time"], errors="coerce").to_numpy(dtype=np.float64)
+
+        if not is_sorted:
+
+            order = np.argsort(times, kind="stable")
+
+            trades = trades.iloc[order]
+
+            times = times[order]
+
+        # nan sorts last, so the readable times are a prefix.
+        valid = len(times) - int(np.isnan(times).sum())
+
+        self.times = times[:valid].astype(np.int64)
+
+        self.trades = compact(trades.iloc[:valid].assign(time=self.times))
+
+    def __len__(self) -> int:
+
+        return len(self.times)
+
+    def bounds(self, start: float, end: float) -> [int, int]:
+        """positions of the first trade at or after start and at or after end."""
+
+        lo, hi = np.searchsorted(self.times, [start, end], side="left")
+
+        return int(lo), int(hi)
+
+    def window(self, start: float, end: float):
+        """
+        Trades with start <= time < end, in time order.
+
+        Parameters
+        ----------
+        start : float
+            window start in ms.
+        end : float
+            window end in ms, not included.
+
+        Returns
+        -------
+        TradeBatch/pd.DataFrame
+            slice of the sorted trades.
+
+        """
+
+        lo, hi = self.bounds(start, end)
+
+        if isinstance(self.trades, TradeBatch):
+
+            return self.trades[lo:hi]
+
+        return self.trades.iloc[lo:hi]
+
+    def split(self, column: str, keys: list = None) -> dict:
+        """
+        Splits the trades on 'column' in a single groupby, returns
+        {value: TradeIndex} without the column, for only 'keys' if given.
+        Each part keeps the time order.
+        """
+
+        groups = self.trades.groupby(column, sort=False, observed=True).indices
+
+        trades = self.trades.drop(columns=column)
+
+        return {
+            k: TradeIndex(trades.iloc[rows], is_sorted=True)
+            for k, rows in groups.items()
+            if keys is None or k in keys
+        }
+
+
+def with_datetime(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Adds the GMT "datetime" of each trade's ms time, only done for the rows
+    an output actually needs.
+    """
+
+    return df.assign(
+        datetime=pd.to_datetime(df["time"].to_numpy(dtype=np.int64), unit="ms", utc=True).tz_convert("GMT")
+    )
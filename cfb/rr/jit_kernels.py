@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Numba compiled inner loops of the kernels in kernels.py, used automatically
+when numba is installed (see kernels.BACKEND). Each one walks the trades once
+in the same order and with the same floating point operations as the NumPy
+version, including numpy's pairwise summation of totals, so the results are
+bit identical to it. Importing this module without numba raises ImportError.
+
+Functions are compiled on first use and cached on disk.
+
+@author: theo
+"""
+
+import numba
+import numpy as np
+
+
+# numpy's pairwise summation block (PW_BLOCKSIZE).
+PAIRWISE_BLOCK = 128
+
+
+@numba.njit(cache=True)
+def _block_sum(a, lo, n):
+    """numpy's pairwise_sum of at most PAIRWISE_BLOCK elements a[lo:lo + n]."""
+
+    if n < 8:
+
+        res = 0.0
+
+        for i in range(lo, lo + n):
+
+            res += a[i]
+
+        return res
+
+    r0, r1, r2, r3 = a[lo], a[lo + 1], a[lo + 2], a[lo + 3]
+
+    r4, r5, r6, r7 = a[lo + 4], a[lo + 5], a[lo + 6], a[lo + 7]
+
+    i = 8
+
+    while i < n - (n % 8):
+
+        r0 += a[lo + i]
+
+        r1 += a[lo + i + 1]
+
+        r2 += a[lo + i + 2]
+
+        r3 += a[lo + i + 3]
+
+        r4 += a[lo + i + 4]
+
+        r5 += a[lo + i + 5]
+
+        r6 += a[lo + i + 6]
+
+        r7 += a[lo + i + 7]
+
+        i += 8
+
+    res = ((r0 + r1) + (r2 + r3)) + ((r4 + r5) + (r6 + r7))
+
+    while i < n:
+
+        res += a[lo + i]
+
+        i += 1
+
+    return res
+
+
+@numba.njit(cache=True)
+def _half(n):
+    """length of the first half numpy's pairwise_sum splits n elements into."""
+
+    n2 = n // 2
+
+    return n2 - n2 % 8
+
+
+@numba.njit(cache=True)
+def _pairwise_sum(a, lo, n):
+    """
+    sum of a[lo:lo + n] as numpy's pairwise_sum, which sums blocks and adds
+    the two halves of anything longer recursively. Written with an explicit
+    stack as numba can't cache recursive functions.
+    """
+
+    if n <= PAIRWISE_BLOCK:
+
+        return _block_sum(a, lo, n)
+
+    # each frame is a range waiting for its left half (state 1) or, with the
+    # left half's sum in partial, for its right half (state 2).
+    los = np.empty(64, dtype=np.int64)
+
+    ns = np.empty(64, dtype=np.int64)
+
+    state = np.zeros(64, dtype=np.int64)
+
+    partial = np.empty(64)
+
+    sp = 0
+
+    los[0], ns[0] = lo, n
+
+    while True:
+
+        if ns[sp] > PAIRWISE_BLOCK:
+
+            state[sp] = 1
+
+            los[sp + 1], ns[sp + 1], state[sp + 1] = los[sp], _half(ns[sp]), 0
+
+            sp += 1
+
+            continue
+
+        value = _block_sum(a, los[sp], ns[sp])
+
+        sp -= 1
+
+        while sp >= 0 and state[sp] == 2:
+
+            value = partial[sp] + value
+
+            sp -= 1
+
+        if sp < 0:
+
+            return value
+
+        partial[sp] = value
+
+        state[sp] = 2
+
+        n2 = _half(ns[sp])
+
+        los[sp + 1], ns[sp + 1], state[sp + 1] = los[sp] + n2, ns[sp] - n2, 0
+
+        sp += 1
+
+
+@numba.njit(cache=True)
+def _sum(a, lo, hi):
+    """a[lo:hi].sum() as numpy computes it for a contiguous array."""
+
+    return _pairwise_sum(a, lo, hi - lo)
+
+
+@numba.njit(cache=True)
+def group_bounds(groups):
+    """start & end (exclusive) of each run of equal values of sorted groups."""
+
+    n = len(groups)
+
+    starts = np.empty(n, dtype=np.int64)
+
+    k = 0
+
+    for i in range(n):
+
+        if i == 0 or groups[i] != groups[i - 1]:
+
+            starts[k] = i
+
+            k += 1
+
+    starts = starts[:k]
+
+    ends = np.empty(k, dtype=np.int64)
+
+    ends[: k - 1] = starts[1:]
+
+    if k > 0:
+
+        ends[k - 1] = n
+
+    return starts, ends
+
+
+@numba.njit(cache=True, error_model="numpy")
+def _median_of_sorted(price, size, lo, hi, cumvol):
+    """
+    kernels.grouped_weighted_median's rule over price[lo:hi] (ordered by
+    price), returns the median (not yet nan for no volume), the position it
+    lands on and the total volume. cumvol is scratch of at least hi - lo.
+    """
+
+    total = _sum(size, lo, hi)
+
+    running = 0.0
+
+    last_below = -1
+
+    for i in range(lo, hi):
+
+        running = size[i] if i == lo else running + size[i]
+
+        cumvol[i - lo] = running / total
+
+        if cumvol[i - lo] < 0.5:
+
+            last_below = i
+
+    first_over = cumvol[0] >= 0.5
+
+    index = lo if first_over or last_below < lo else last_below + 1
+
+    index = min(index, hi - 1)
+
+    if not first_over and cumvol[index - lo] == 0.5:
+
+        return (price[index] + price[min(index + 1, hi - 1)]) / 2, index, total
+
+    return price[index], index, total
+
+
+@numba.njit(cache=True, error_model="numpy")
+def grouped_median_sorted(price, size, starts, ends):
+    """
+    medians & positions of every group of trades sorted by (group, price),
+    as kernels.grouped_weighted_median.
+    """
+
+    medians = np.empty(len(starts))
+
+    index = np.empty(len(starts), dtype=np.int64)
+
+    cumvol = np.empty(len(price))
+
+    for g in range(len(starts)):
+
+        median, i, total = _median_of_sorted(price, size, starts[g], ends[g], cumvol)
+
+        medians[g] = median if total > 0 else np.nan
+
+        index[g] = i
+
+    return medians, index
+
+
+@numba.njit(cache=True, error_model="numpy")
+def _median(values):
+    """np.median of a 1d array."""
+
+    for v in values:
+
+        if np.isnan(v):
+
+            return np.nan
+
+    ordered = np.sort(values)
+
+    n = len(ordered)
+
+    if n % 2 == 1:
+
+        return ordered[n // 2]
+
+    return (0.0 + ordered[n // 2 - 1] + ordered[n // 2]) / 2
+
+
+@numba.njit(cache=True, error_model="numpy")
+def grouped_ped_median_sorted(price, size, codes, n_codes, starts, ends, ped):
+    """
+    kernels.grouped_ped_weighted_median over trades sorted by (group, price)
+    with exchanges as codes 0..n_codes - 1. Returns the medians, the position
+    each lands on (-1 if no trades are left) and the exchanges removed from
+    each group as a groups x codes mask.
+    """
+
+    medians = np.full(len(starts), np.nan)
+
+    index = np.full(len(starts), -1, dtype=np.int64)
+
+    removed = np.zeros((len(starts), n_codes), dtype=np.bool_)
+
+    sub_price = np.empty(len(price))
+
+    sub_size = np.empty(len(price))
+
+    positions = np.empty(len(price), dtype=np.int64)
+
+    cumvol = np.empty(len(price))
+
+    present = np.zeros(n_codes, dtype=np.bool_)
+
+    for g in range(len(starts)):
+
+        s, e = starts[g], ends[g]
+
+        present[:] = False
+
+        for i in range(s, e):
+
+            present[codes[i]] = True
+
+        group_codes = np.flatnonzero(present)
+
+        exchange_medians = np.empty(len(group_codes))
+
+        # each exchange's trades keep their price order.
+        for j in range(len(group_codes)):
+
+            n = 0
+
+            for i in range(s, e):
+
+                if codes[i] == group_codes[j]:
+
+                    sub_price[n] = price[i]
+
+                    sub_size[n] = size[i]
+
+                    n += 1
+
+            median, _, total = _median_of_sorted(sub_price, sub_size, 0, n, cumvol)
+
+            exchange_medians[j] = median if total > 0 else np.nan
+
+        median = _median(exchange_medians)
+
+        flagged = np.abs(exchange_medians / median - 1) > ped / 100
+
+        if flagged.sum() > 1:
+
+            for j in range(len(group_codes)):
+
+                removed[g, group_codes[j]] = flagged[j]
+
+        n = 0
+
+        for i in range(s, e):
+
+            if not removed[g, codes[i]]:
+
+                sub_price[n] = price[i]
+
+                sub_size[n] = size[i]
+
+                positions[n] = i
+
+                n += 1
+
+        if n == 0:
+
+            continue
+
+        median, i, total = _median_of_sorted(sub_price, sub_size, 0, n, cumvol)
+
+        medians[g] = median if total > 0 else np.nan
+
+        index[g] = positions[i]
+
+    return medians, index, removed
+
+
+@numba.njit(cache=True)
+def cell_totals(cells, price, size, n_cells):
+    """volume (price x size), size & trade count of each cell in one pass."""
+
+    volume = np.zeros(n_cells)
+
+    traded = np.zeros(n_cells)
+
+    trades = np.zeros(n_cells, dtype=np.int64)
+
+    for i in range(len(cells)):
+
+        volume[cells[i]] += price[i] * size[i]
+
+        traded[cells[i]] += size[i]
+
+        trades[cells[i]] += 1
+
+    return volume, traded, trades
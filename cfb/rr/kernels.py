@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Array kernels used by the _RR calculation. These work on flat numpy arrays
+rather than DataFrames so that many groups (buckets, exchanges, windows...)
+can be handled in one call.
+
+The per group loops run compiled (jit_kernels.py) when numba is installed
+and in NumPy otherwise, with bit identical results. By default ("auto") only
+calls of at least COMPILED_MIN_TRADES trades are compiled, so small jobs
+never pay for importing numba. Set the RR_KERNELS environment variable to
+"numpy", "numba" (always compiled) or "auto", or call set_backend, to choose.
+
+@author: theo
+"""
+
+import importlib.util
+import os
+import numpy as np
+
+
+# numba is only imported (and the compiled kernels loaded) on first use.
+BACKENDS = ["numpy"] if importlib.util.find_spec("numba") is None else ["numpy", "numba"]
+
+BACKEND = "numpy" if len(BACKENDS) == 1 else "auto"
+
+# smallest call the "auto" backend compiles, below this the NumPy kernels are
+# about as fast and importing numba would dominate a short run.
+COMPILED_MIN_TRADES = 50_000
+
+
+def set_backend(name: str):
+    """
+    Chooses the backend of the kernels.
+
+    Parameters
+    ----------
+    name : str
+        "numpy", "numba" or "auto" (both only if numba is installed).
+
+    Returns
+    -------
+    None.
+
+    """
+
+    global BACKEND
+
+    if name not in ["numpy", "numba", "auto"]:
+
+        raise ValueError(f"Unknown backend: {name}")
+
+    if name != "numpy" and "numba" not in BACKENDS:
+
+        raise ValueError(f"Backend {name} is not available, numba is not installed")
+
+    BACKEND = name
+
+
+if os.environ.get("RR_KERNELS"):
+
+    try:
+
+        set_backend(os.environ["RR_KERNELS"])
+
+    except ValueError as e:
+
+        print(f"WARNING RR_KERNELS IGNORED, USING {BACKEND}: {e}")
+
+
+def _jit():
+    """the jit_kernels module, imported on the first compiled call."""
+
+    import jit_kernels
+
+    return jit_kernels
+
+
+def _compiled(groups: np.ndarray) -> bool:
+    """whether the compiled kernels are used for these (integer) group ids."""
+
+    if groups.dtype.kind not in "biu" or len(groups) == 0:
+
+        return False
+
+    return BACKEND == "numba" or (BACKEND == "auto" and len(groups) >= COMPILED_MIN_TRADES)
+
+
+def group_bounds(groups: np.ndarray) -> [np.ndarray, np.ndarray, np.ndarray]:
+    """
+    For a SORTED array of group ids returns the unique ids and the start/end
+    (exclusive) position of each group, found via binary search.
+
+    Parameters
+    ----------
+    groups : np.ndarray
+        sorted array of integer group ids.
+
+    Returns
+    -------
+    keys : np.ndarray
+        unique group ids in ascending order.
+    starts : np.ndarray
+        first position of each group.
+    ends : np.ndarray
+        position after the last element of each group.
+
+    """
+
+    keys = np.unique(groups)
+
+    starts = np.searchsorted(groups, keys, side="left")
+
+    ends = np.searchsorted(groups, keys, side="right")
+
+    return keys, starts, ends
+
+
+def grouped_weighted_median(
+    price: np.ndarray, size: np.ndarray, groups: np.ndarray, labels: np.ndarray = None
+) -> [np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Volume weighted median of every group in one call. Same rule as
+    utilities.weighted_median: trades are ordered by price, the median is the
+    first price whose cumulative volume share reaches 50%, and if that share is
+    exactly 0.5 the median is the average of that price and the next one (unless
+    the very first trade already reaches 50%). Trades at the same price keep
+    their input order, so the earliest of them is reported as the winner.
+
+    Parameters
+    ----------
+    price : np.ndarray
+        trade prices.
+    size : np.ndarray
+        trade sizes.
+    groups : np.ndarray
+        integer group id of each trade i.e. bucket number or exchange code.
+    labels : np.ndarray, optional
+        value returned for the trade the median lands on, normally the exchange.
+        The default is None, in which case no labels are returned.
+
+    Returns
+    -------
+    keys : np.ndarray
+        unique group ids in ascending order.
+    medians : np.ndarray
+        weighted median price of each group, nan if the group has no volume.
+    winners : np.ndarray
+        label of the trade the median lands on for each group, None if no
+        labels were given.
+
+    """
+
+    price = np.asarray(price, dtype=np.float64)
+
+    size = np.asarray(size, dtype=np.float64)
+
+    groups = np.asarray(groups)
+
+    order = np.lexsort((price, groups))
+
+    price = price[order]
+
+    size = size[order]
+
+    if _compiled(groups):
+
+        groups = groups[order]
+
+        starts, ends = _jit().group_bounds(groups)
+
+        medians, index = _jit().grouped_median_sorted(price, size, starts, ends)
+
+        winners = None if labels is None else np.asarray(labels)[order][index]
+
+        return groups[starts], medians, winners
+
+    keys, starts, ends = group_bounds(groups[order])
+
+    if len(keys) == 0:
+
+        return keys, np.empty(0), None if labels is None else np.asarray(labels)[:0]
+
+    cumvol = np.empty_like(size)
+
+    totals = np.empty(len(keys))
+
+    # cumulative and total volume per group, summed the same way numpy/pandas
+    # sum a single group so the exact 0.5 tie is found identically. Kept per
+    # group: a global cumsum less each group's offset, or np.add.reduceat,
+    # rounds differently to the pairwise sum of one group and misses ties.
+    for i, (s, e) in enumerate(zip(starts, ends)):
+
+        np.cumsum(size[s:e], out=cumvol[s:e])
+
+        totals[i] = size[s:e].sum()
+
+    cumvol_percent = cumvol / np.repeat(totals, ends - starts)
+
+    # position of the last trade below 50% in each group, -1 if there is none.
+    positions = np.arange(len(price))
+
+    last_below = np.maximum.reduceat(
+        np.where(cumvol_percent < 0.5, positions, -1), starts
+    )
+
+    first_over = cumvol_percent[starts] >= 0.5
+
+    index = np.where(first_over | (last_below < starts), starts, last_below + 1)
+
+    index = np.minimum(index, ends - 1)
+
+    tie = ~first_over & (cumvol_percent[index] == 0.5)
+
+    medians = np.where(
+        tie,
+        (price[index] + price[np.minimum(index + 1, ends - 1)]) / 2,
+        price[index],
+    )
+
+    medians[~(totals > 0)] = np.nan
+
+    winners = None if labels is None else np.asarray(labels)[order][index]
+
+    return keys, medians, winners
+
+
+def _weighted_median_sorted(price: np.ndarray, size: np.ndarray) -> [float, int]:
+    """
+    Weighted median of trades already ordered by price, same rule as
+    grouped_weighted_median. Returns the median and the position it lands on,
+    nan if there is no volume.
+    """
+
+    total = size.sum()
+
+    if not total > 0:
+
+        return np.nan, 0
+
+    cumvol_percent = np.cumsum(size) / total
+
+    if cumvol_percent[0] >= 0.5:
+
+        return price[0], 0
+
+    index = min(np.flatnonzero(cumvol_percent < 0.5)[-1] + 1, len(price) - 1)
+
+    if cumvol_percent[index] == 0.5:
+
+        return (price[index] + price[min(index + 1, len(price) - 1)]) / 2, index
+
+    return price[index], index
+
+
+def grouped_ped_weighted_median(
+    price: np.ndarray,
+    size: np.ndarray,
+    groups: np.ndarray,
+    exchanges: np.ndarray,
+    ped: float,
+    labels: np.ndarray = None,
+) -> [np.ndarray, np.ndarray, np.ndarray, list]:
+    """
+    Weighted median of every group with the PED check applied within each
+    group (i.e. per partition rather than per window). The trades are sorted
+    once by (group, price), then for each group the per exchange medians, the
+    median across exchanges and the exchanges more than 'ped' % away from it
+    are found and the group median taken over the remaining trades. As in
+    main.calc_date exchanges are only removed if more than one is flagged.
+
+    Parameters
+    ----------
+    price : np.ndarray
+        trade prices.
+    size : np.ndarray
+        trade sizes.
+    groups : np.ndarray
+        integer group id of each trade i.e. bucket number.
+    exchanges : np.ndarray
+        integer exchange code of each trade.
+    ped : float
+        The PED parameter as a %.
+    labels : np.ndarray, optional
+        value returned for the trade the median lands on, normally the exchange.
+        The default is None, in which case no labels are returned.
+
+    Returns
+    -------
+    keys : np.ndarray
+        unique group ids in ascending order.
+    medians : np.ndarray
+        weighted median price of each group after the PED check, nan if no
+        volume is left.
+    winners : np.ndarray
+        label of the trade the median lands on for each group, None if no
+        labels were given or no trades are left.
+    removed : list
+        array of the exchange codes removed from each group.
+
+    """
+
+    price = np.asarray(price, dtype=np.float64)
+
+    size = np.asarray(size, dtype=np.float64)
+
+    groups = np.asarray(groups)
+
+    order = np.lexsort((price, groups))
+
+    price = price[order]
+
+    size = size[order]
+
+    exchanges = np.asarray(exchanges)[order]
+
+    labels = None if labels is None else np.asarray(labels)[order]
+
+    if _compiled(groups):
+
+        return _compiled_ped_weighted_median(price, size, groups[order], exchanges, ped, labels)
+
+    keys, starts, ends = group_bounds(groups[order])
+
+    medians = np.full(len(keys), np.nan)
+
+    winners = np.empty(len(keys), dtype=object)
+
+    removed = []
+
+    for i, (s, e) in enumerate(zip(starts, ends)):
+
+        p, v, x = price[s:e], size[s:e], exchanges[s:e]
+
+        codes = np.unique(x)
+
+        exchange_medians = np.array(
+            [_weighted_median_sorted(p[x == c], v[x == c])[0] for c in codes]
+        )
+
+        median = np.median(exchange_medians)
+
+        flagged = codes[np.abs(exchange_medians / median - 1) > ped / 100]
+
+        if len(flagged) > 1:
+
+            keep = ~np.isin(x, flagged)
+
+            p, v = p[keep], v[keep]
+
+        else:
+
+            keep = slice(None)
+
+            flagged = codes[:0]
+
+        removed.append(flagged)
+
+        if len(p) == 0:
+
+            winners[i] = None
+
+            continue
+
+        medians[i], index = _weighted_median_sorted(p, v)
+
+        winners[i] = None if labels is None else labels[s:e][keep][index]
+
+    return keys, medians, None if labels is None else winners, removed
+
+
+def _compiled_ped_weighted_median(
+    price: np.ndarray,
+    size: np.ndarray,
+    groups: np.ndarray,
+    exchanges: np.ndarray,
+    ped: float,
+    labels: np.ndarray = None,
+) -> [np.ndarray, np.ndarray, np.ndarray, list]:
+    """
+    grouped_ped_weighted_median of trades already sorted by (group, price)
+    with jit_kernels.
+    """
+
+    codes, exchange_index = np.unique(exchanges, return_inverse=True)
+
+    starts, ends = _jit().group_bounds(groups)
+
+    medians, index, removed = _jit().grouped_ped_median_sorted(
+        price, size, exchange_index, len(codes), starts, ends, ped
+    )
+
+    winners = None
+
+    if labels is not None:
+
+        winners = np.empty(len(starts), dtype=object)
+
+        winners[index >= 0] = labels[index[index >= 0]]
+
+    return groups[starts], medians, winners, [codes[r] for r in removed]
+
+
+def cell_totals(cells: np.ndarray, price: np.ndarray, size: np.ndarray, n_cells: int) -> [np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Volume (price x size), size & number of trades in each cell (i.e. bucket &
+    exchange) in one call.
+
+    Parameters
+    ----------
+    cells : np.ndarray
+        integer cell, 0 to n_cells - 1, of each trade.
+    price : np.ndarray
+        trade prices.
+    size : np.ndarray
+        trade sizes.
+    n_cells : int
+        number of cells.
+
+    Returns
+    -------
+    volume : np.ndarray
+        price x size of each cell.
+    traded : np.ndarray
+        size of each cell.
+    trades : np.ndarray
+        number of trades in each cell.
+
+    """
+
+    cells = np.asarray(cells, dtype=np.int64)
+
+    price = np.asarray(price, dtype=np.float64)
+
+    size = np.asarray(size, dtype=np.float64)
+
+    if _compiled(cells):
+
+        return _jit().cell_totals(cells, price, size, n_cells)
+
+    return (
+        np.bincount(cells, price * size, minlength=n_cells),
+        np.bincount(cells, size, minlength=n_cells),
+        np.bincount(cells, minlength=n_cells),
+    )
@@ -7,14 +7,497 @@ Created on Sun Feb 18 12:07:10 2024
 """
 
 import utilities
-from datetime import datetime, timedelta
+import containers
+import readers
+import outofcore
+import sources
+import sinks
+import metrics
+import manifest
+import argparse
+import json
+from datetime import datetime
 import numpy as np
 import pandas as pd
 import os
 from pytz import timezone
 import yaml
+from concurrent.futures import ProcessPoolExecutor, Future
+from functools import partial
+from collections import deque
 
-def run(read_path:str, save_path :str, start: datetime, end:datetime, freq:str, tz:str, close:int, window:int, partition:int, markets:list,ped:float, local : bool, first_last : bool ):
+
+# bucket VWMs kept between calc times so overlapping windows reuse them,
+# one per process when running over a pool.
+BUCKET_CACHE = {}
+
+# checked trades of the day being calculated, so hourly (or finer) calc times
+# load each daily file once. Holds a single day, one per process.
+DAY_CACHE = {}
+
+
+def output_name(instrument: str) -> str:
+    """
+    Output name of an instrument's RR, i.e. 'LTC-USD' -> 'LTCUSD_RR'.
+    """
+
+    return "".join(c for c in str(instrument) if c.isalnum()).upper() + "_RR"
+
+
+def calc_date(date: datetime, read_path: str, window: int, partition: int, ped: float, local: bool, first_last: bool, drop_erroneous: bool = False, stream: bool = False, cache_path: str = None, profile: list = (), trace_memory: list = (), profile_path: str = "", name: str = "LTCUSD_RR", instruments: list = None, instrument_field: str = "instrument", markets: list = None, ped_mode: str = "window", out_of_core: bool = False, memory_budget_mb: float = 256, spill_path: str = None, relative_accuracy: float = None):
+    """
+    Calculates the RR for a single calc time. Kept separate from run so that
+    dates can be spread over a process pool.
+
+    In batch mode (instruments given) the file is loaded and checked once,
+    split by instrument in a single groupby and the RR of every instrument
+    calculated from that shared load.
+
+    Parameters
+    ----------
+    date : datetime
+        calc time.
+    read_path : str
+        path to read input data from.
+    window : int
+        Length of window in minutes.
+    partition : int
+        Partition length in minutes.
+    ped : float
+        The PED parameter as a %.
+    local : bool
+        If True will try to read .json trade files locally.
+    first_last : bool
+        If true will save first and last trade of each partition.
+    drop_erroneous : bool, optional
+        If True erroneous trades are dropped rather than flagged. The default is False.
+    stream : bool, optional
+        If True the trade file is streamed into typed columns rather than
+        loaded whole. The default is False.
+    cache_path : str, optional
+        If given trade files are read through the columnar cache kept in this
+        directory. The default is None.
+    profile : list, optional
+        stages (load, validation, window, ped, calc) to run under cProfile.
+        The default is ().
+    trace_memory : list, optional
+        stages to run under tracemalloc. The default is ().
+    profile_path : str, optional
+        folder to save cProfile stats in. The default is "".
+    name : str, optional
+        output name of the RR when not in batch mode. The default is "LTCUSD_RR".
+    instruments : list, optional
+        instruments to calculate, as named in the trades' instrument_field.
+        The default is None, the whole file is a single instrument.
+    instrument_field : str, optional
+        trade field naming the instrument. The default is "instrument".
+    markets : list, optional
+        exchanges to use, trades from any other are dropped as the file is
+        read. The default is None, all exchanges.
+    ped_mode : str, optional
+        'window' applies the PED check over the whole window, 'partition'
+        within each partition. The default is "window".
+    out_of_core : bool, optional
+        If True the trade file is spilled to disk as sorted runs and only the
+        window is read back, see outofcore.spill_json. The default is False.
+    memory_budget_mb : float, optional
+        trades held in memory while spilling, in MB. The default is 256.
+    spill_path : str, optional
+        directory for the spilled runs. The default is None, the system temp
+        directory.
+    relative_accuracy : float, optional
+        If given partition VWMs are approximate, from quantile sketches, see
+        utilities.calc. The default is None, exact.
+
+    Returns
+    -------
+    results : dict
+        {output name: (rr, weighted_medians, liquidity)} with rr the single
+        row frame of the RR value, weighted_medians the partition VWMs used in
+        the calc and liquidity its volume columns, see calc_trades.
+        Instruments without trades in the file are left out.
+    records : list
+        wall time & rows of each stage, see metrics.StageMetrics.
+    None is returned instead if there is no input data for the date.
+
+    """
+
+    print(
+        f"Starting: {date}"
+    )
+    
+    stages = metrics.StageMetrics(date, profile, trace_memory, profile_path)
+
+    parts = load_day(date, read_path, local, drop_erroneous, stream, cache_path, name, instruments, instrument_field, markets, stages, out_of_core, memory_budget_mb, spill_path)
+
+    if parts is None:
+
+        return None
+
+    results = {
+        name: calc_trades(part, date, name, window, partition, ped, first_last, stages, instruments is not None, ped_mode, relative_accuracy)
+        for name, part in parts.items()
+    }
+
+    return results, stages.records
+
+
+def load_day(date: datetime, read_path: str, local: bool, drop_erroneous: bool, stream: bool, cache_path: str, name: str, instruments: list, instrument_field: str, markets: list, stages: metrics.StageMetrics, out_of_core: bool = False, memory_budget_mb: float = 256, spill_path: str = None):
+    """
+    Loads, checks and time indexes (containers.TradeIndex) the trade file of
+    the calc date's day (and in batch mode splits it by instrument). The
+    result is kept in DAY_CACHE so hourly or finer calc times on the same day
+    reuse it, the previous day is evicted as soon as a new day is loaded.
+
+    Parameters
+    ----------
+    date : datetime
+        calc time, the file of its day is loaded.
+    read_path, local, drop_erroneous, stream, cache_path, name, instruments, instrument_field, markets, out_of_core, memory_budget_mb, spill_path
+        see calc_date.
+    stages : metrics.StageMetrics
+        metrics of the calc date, the load, validation & split stages are only
+        recorded when the file is actually loaded.
+
+    Returns
+    -------
+    dict
+        {output name: checked trade data} for each instrument with trades, or
+        none if there is no input data for the day.
+
+    """
+
+    file = f"{date.date()}.json"
+
+    try:
+
+        # a file rewritten during the run is loaded again.
+        source = os.stat(f"{read_path}{file}")
+
+        version = (source.st_size, source.st_mtime_ns)
+
+    except OSError:
+
+        version = None
+
+    key = (read_path, file, version, local, drop_erroneous, stream, cache_path, name, None if instruments is None else tuple(instruments), instrument_field, tuple(markets or ()), out_of_core)
+
+    if key in DAY_CACHE:
+
+        return DAY_CACHE[key]
+
+    # an out of core day's runs are deleted along with it.
+    DAY_CACHE.clear()
+
+    field = instrument_field if instruments is not None else None
+
+    with stages.stage("load") as record:
+
+        if local == True and out_of_core:
+
+            data = outofcore.spill_json(
+                read_path, file, spill_path, memory_budget_mb, drop_erroneous, field, markets
+            )
+
+        elif local == True and cache_path:
+
+            data = readers.read_json_cached(read_path, file, cache_path, instrument_field=field, markets=markets)
+
+        elif local == True and stream == True:
+
+            data = readers.read_json_stream(read_path, file, instrument_field=field, markets=markets)
+
+        elif local == True:
+
+            data = utilities.read_json(read_path, file, markets)
+            
+        else:
+            
+            ### download from s3 - not written yet 
+            data = None
+
+        if data is not None:
+
+            record["rows"] = len(data["trades"]["time"]) if isinstance(data["trades"], dict) else len(data["trades"])
+
+    if data is None:
+
+        DAY_CACHE[key] = None
+
+        return None
+
+    if not out_of_core:
+
+        with stages.stage("validation") as record:
+
+            data = utilities.erroneous_check(data, drop_erroneous)
+
+            record["rows"] = len(data["trades"])
+
+            # sorted once here so every window of the day is a binary search.
+            data["trades"] = containers.TradeIndex(data["trades"])
+
+    if instruments is None:
+
+        parts = {name: data}
+
+    else:
+
+        with stages.stage("split") as record:
+
+            if len(data["trades"]) == 0:
+
+                DAY_CACHE[key] = None
+
+                return None
+
+            if out_of_core:
+
+                found = len(data["trades"].instruments) > 0
+
+            else:
+
+                trades = data["trades"].trades
+
+                # trades with only the trade columns are held as a TradeBatch,
+                # the typed readers give trades without the field no value.
+                found = (
+                    not isinstance(trades, containers.TradeBatch)
+                    and instrument_field in trades.columns
+                    and trades[instrument_field].notna().any()
+                )
+
+            if not found:
+
+                raise ValueError(f"No {instrument_field} field in the trades of {read_path}{file}, needed to split instruments")
+
+            # the instrument column is dropped so each instrument's outputs
+            # have the same columns as a single instrument run.
+            split = data["trades"].split(instrument_field, instruments)
+
+            parts = {
+                output_name(i): {**data, "trades": split[i]}
+                for i in instruments
+                if i in split
+            }
+
+            record["rows"] = sum(len(p["trades"]) for p in parts.values())
+
+    DAY_CACHE[key] = parts
+
+    return parts
+
+
+def calc_trades(data: dict, date: datetime, name: str, window: int, partition: int, ped: float, first_last: bool, stages: metrics.StageMetrics, tag: bool = False, ped_mode: str = "window", relative_accuracy: float = None, exchange_medians: tuple = None):
+    """
+    Window, PED check and calc of the checked trades of one instrument.
+
+    Parameters
+    ----------
+    data : dict
+        trade data after utilities.erroneous_check.
+    date : datetime
+        calc time.
+    name : str
+        output name of the RR, also the column name.
+    window : int
+        Length of window in minutes.
+    partition : int
+        Partition length in minutes.
+    ped : float
+        The PED parameter as a %.
+    first_last : bool
+        If true will save first and last trade of each partition.
+    stages : metrics.StageMetrics
+        metrics of the calc date the stages are recorded in.
+    tag : bool, optional
+        If True the stage records are tagged with the instrument name.
+        The default is False.
+    ped_mode : str, optional
+        'window' or 'partition', see calc_date. The default is "window".
+    relative_accuracy : float, optional
+        see calc_date. The default is None.
+    exchange_medians : tuple, optional
+        utilities.exchange_medians of the window if already known, the PED
+        check then only applies the ped threshold to them. The default is
+        None, calculated here.
+
+    Returns
+    -------
+    rr : pd.DataFrame
+        single row frame of the RR value.
+    weighted_medians : pd.DataFrame
+        partition VWMs used in the calc.
+    liquidity : dict
+        'partitions' & 'exchanges' columns of the trades used in the calc,
+        see utilities.calc, with the calc 'time' added.
+
+    """
+
+    tags = {"instrument": name} if tag else {}
+
+    with stages.stage("window", **tags) as record:
+
+        df = utilities.filter_window(data, date, window)
+
+        record["rows"] = len(df)
+
+    # bucket VWMs are only reused for the same input & PED exclusions.
+    cache_key = (name, str(date.date()))
+
+    if ped_mode == "window":
+
+        with stages.stage("ped", **tags) as record:
+
+            ped_exchanges, vwm_e, median_vwm_e = utilities.potentially_errorneous_check(df, ped, exchange_medians)
+
+            if len(ped_exchanges) > 1:
+                
+                print(f"PED PARARM REMOVING: {ped_exchanges}")
+                
+                df = df[~containers.exchange_mask(df, ped_exchanges)]
+
+                cache_key += tuple(sorted(ped_exchanges))
+
+            record["rows"] = len(df)
+
+    else:
+
+        # the check is made per partition inside calc.
+        cache_key += ("partition", ped)
+
+    if relative_accuracy is not None:
+
+        cache_key += ("sketch", relative_accuracy)
+
+    # wm_e.update(
+    #     {
+    #         "lowerThreshold": pe_median * 0.9,
+    #         "upperThreshold": pe_median * 1.1,
+    #         "AllExchangeMedian": pe_median,
+    #     }
+    # )
+
+    # pe_ts = pd.concat([pe_ts, pd.DataFrame(wm_e, index=[date.date()])])
+
+
+
+    liquidity = {}
+
+    with stages.stage("calc", **tags) as record:
+
+        ccrr, weighted_medians = utilities.calc(
+            df,
+            partition,
+            datetime.timestamp(date),
+            first_last,
+            window,
+            BUCKET_CACHE,
+            cache_key,
+            ped if ped_mode == "partition" else None,
+            relative_accuracy,
+            liquidity,
+        )
+
+        record["rows"] = len(weighted_medians)
+
+    calc_time = int(datetime.timestamp(date) * 1000)
+
+    liquidity = {
+        table: {"time": np.full(len(columns["exchange"]), calc_time), **columns}
+        for table, columns in liquidity.items()
+    }
+
+    rr = pd.DataFrame(
+        {
+            "time": [calc_time],
+            "Date": [utilities.ts_to_dt(calc_time / 1000)],
+            name: [ccrr.round(4)],
+        }
+    )
+
+    return rr, weighted_medians, liquidity
+
+
+def iter_prefetched(calc_one, dates: list, pool, workers: int, prefetcher, ahead: int):
+    """
+    Yields calc_one(date) for each date in order while the next 'ahead' input
+    files (of the upcoming days, however many dates share a day) download in
+    the background. Each file is deleted once
+    no later date needs it, so the download folder stays bounded.
+
+    Parameters
+    ----------
+    calc_one : callable
+        calc for a single date, reading from the prefetcher's folder.
+    dates : list
+        calc times in order.
+    pool : ProcessPoolExecutor
+        pool to calc on, None calcs in this process.
+    workers : int
+        number of dates calculated at once on the pool.
+    prefetcher : sources.Prefetcher
+        downloads the input files.
+    ahead : int
+        number of upcoming files to download while calculating.
+
+    Yields
+    ------
+    the result of calc_one for each date.
+
+    """
+
+    files = [f"{date.date()}.json" for date in dates]
+
+    # dates of the same day share a file, so 'ahead' counts distinct files.
+    distinct = list(dict.fromkeys(files))
+
+    position = {file: i for i, file in enumerate(distinct)}
+
+    in_flight = workers if pool is not None else 1
+
+    pending = deque()
+
+    def finished():
+
+        i, future = pending.popleft()
+
+        result = future.result()
+
+        if i + 1 == len(files) or files[i + 1] != files[i]:
+
+            prefetcher.release(files[i])
+
+        return result
+
+    for i, date in enumerate(dates):
+
+        prefetcher.prefetch(distinct[position[files[i]] : position[files[i]] + ahead + 1])
+
+        prefetcher.fetch(files[i])
+
+        if pool is not None:
+
+            future = pool.submit(calc_one, date)
+
+        else:
+
+            future = Future()
+
+            future.set_result(calc_one(date))
+
+        pending.append((i, future))
+
+        while len(pending) >= in_flight:
+
+            yield finished()
+
+    while len(pending) > 0:
+
+        yield finished()
+
+
+def run(read_path:str, save_path :str, start: datetime, end:datetime, freq:str, tz:str, close:int, window:int, partition:int, markets:list,ped:float, local : bool, first_last : bool, drop_erroneous : bool = False, workers : int = 1, stream : bool = False, cache_path : str = None, step : int = 1, source : dict = None, output_format : str = "csv", flush_every : int = 100, save_metrics : bool = True, profile : list = (), trace_memory : list = (), name : str = "LTCUSD_RR", instruments : list = None, instrument_field : str = "instrument", ped_mode : str = "window", resume : bool = False, out_of_core : bool = False, memory_budget_mb : float = 256, spill_path : str = None, relative_accuracy : float = None ):
     """
     Main function for generating RR indices varying depending on inputs. Also has the ability to save data regarding the index
     depending on the list of bools parsed at the end. 
@@ -32,7 +515,7 @@ def run(read_path:str, save_path :str, start: datetime, end:datetime, freq:str,
     end : datetime
         Last Calc time.
     freq : str
-        Frequency of cacluation: 'days' 'hours'
+        Frequency of cacluation: 'days' 'hours' 'minutes'
     tz : str
         Timezone used for EOD calc and for dates in output.
     close : int
@@ -42,13 +525,96 @@ def run(read_path:str, save_path :str, start: datetime, end:datetime, freq:str,
     partition : int
         Partition length in minutes, default is 5 .
     markets : list
-        List of markets to use as input in calc.
+        List of markets (exchanges) to use as input in calc, trades from any
+        other are dropped while the files are read. Empty uses all.
     ped : float
         The PED parameter as a %. i.e. a float of 10 means 10% PED PARAM. 
     local : bool
-        If True will try to read .json trade files locally.
+        If True will try to read .json trade files locally, otherwise they are
+        downloaded from 'source'.
     first_last : bool
         If true will save first and last day.
+    drop_erroneous : bool, optional
+        If True erroneous trades are dropped before filtering the window,
+        otherwise they are only flagged. The default is False.
+    workers : int, optional
+        Number of processes to spread the dates over, 1 runs serially.
+        The default is 1.
+    stream : bool, optional
+        If True trade files are streamed into typed columns rather than
+        loaded whole with json.load. The default is False.
+    cache_path : str, optional
+        Directory of the columnar trade cache. When given each trade file is
+        parsed once into the cache and memory-mapped from it on later runs,
+        until the file's size or mtime changes. The default is None.
+    step : int, optional
+        Number of freq units between calcs, i.e. freq 'minutes' & step 5 is a
+        calc every 5 minutes. Independent of the window length, buckets shared
+        by overlapping windows are reused. The default is 1.
+    source : dict, optional
+        Remote source of the trade files when local is False, the 'source'
+        section of config.yml: 'type' ('s3', 'azure' or 'local') and its
+        settings, plus 'prefetch' (daily files downloaded ahead), 'threads' and
+        'download_path'. Needed when local is False. The default is None.
+    output_format : str, optional
+        'csv' or 'parquet', a parquet output is a folder of part files. The
+        default is "csv".
+    flush_every : int, optional
+        Number of dates buffered before outputs are written. A CSV batch is
+        appended to the file (and truncated back if the write fails), a
+        parquet batch is written as one more part file. The default is 100.
+    save_metrics : bool, optional
+        If True the wall time & rows of each stage of each date are appended
+        to metrics.jsonl in save_path and a summary printed at the end.
+        The default is True.
+    profile : list, optional
+        stages (load, validation, window, ped, calc) to run under cProfile,
+        stats are saved in save_path/profiles/. The default is ().
+    trace_memory : list, optional
+        stages to run under tracemalloc, recording their peak memory.
+        The default is ().
+    name : str, optional
+        name of the RR output (file & column) when not in batch mode, i.e.
+        '{asset}{quote}_RR'. The default is "LTCUSD_RR".
+    instruments : list, optional
+        Batch mode: instruments to calculate, as named in the trades'
+        instrument_field, i.e. ['BTC-USD', 'LTC-USD']. Each daily file is read
+        once and every instrument gets its own outputs, {ASSET}{QUOTE}_RR and
+        {ASSET}{QUOTE}_WeightedMedians. The default is None, the input files
+        hold a single instrument.
+    instrument_field : str, optional
+        trade field naming the instrument in batch mode, a ValueError is
+        raised for a day whose trades have no such field. The default is
+        "instrument".
+    ped_mode : str, optional
+        'window': the PED check removes exchanges over the whole window,
+        'partition': it is applied within each partition, in the same pass as
+        the partition VWMs, and the removed exchanges are saved with them.
+        The default is "window".
+    resume : bool, optional
+        If True completed calc times are recorded in save_path/manifest.jsonl
+        with a hash of their input file and of the parameters, and calc times
+        already completed from the same input & parameters are skipped. The
+        outputs stay in calc time order: they are cut back to the first calc
+        time to recalculate and every calc time after it is recalculated, so
+        a changed input redoes the rest of the range. The rows each calc time
+        wrote are recorded to find where to cut, the outputs keep the same
+        columns as without resume. Needs local inputs. The default is False.
+    out_of_core : bool, optional
+        If True each trade file is streamed to sorted runs on disk holding at
+        most memory_budget_mb of trades in memory, and only the trades of each
+        window are read back. Erroneous trades are then checked per window.
+        Each window is still held in memory whole. The default is False.
+    memory_budget_mb : float, optional
+        memory for buffered trades when out_of_core, in MB, on top of the
+        trades of the window being calculated. The default is 256.
+    spill_path : str, optional
+        directory for the out of core runs, deleted as each day is done. The
+        default is None, the system temp directory.
+    relative_accuracy : float, optional
+        Approximate mode: partition VWMs are read from mergeable quantile
+        sketches (see sketch.py) within this relative error, i.e. 0.001 =
+        0.1%, rather than sorting every partition. The default is None, exact.
 
     Returns
     -------
@@ -56,94 +622,284 @@ def run(read_path:str, save_path :str, start: datetime, end:datetime, freq:str,
 
     """
     
-    print(f"STARTING CALC \n START: {start} \n END: {end} \n FREQ: {freq} \n MARKETS: {markets} \n WINDOW: {window} \n K: {partition} \n SAVING: {save_path}")
+    print(f"STARTING CALC \n START: {start} \n END: {end} \n FREQ: {freq} \n MARKETS: {markets} \n INSTRUMENTS: {instruments or [name]} \n WINDOW: {window} \n K: {partition} \n SAVING: {save_path}")
+
+    if ped_mode not in ["window", "partition"]:
+
+        raise ValueError(f"Unknown ped_mode: {ped_mode}")
+
+    if local == False and not source:
+
+        raise ValueError("read_input_locally is False but no inputs.source is set in the config")
 
     tz = timezone(tz)
 
     os.makedirs(save_path, exist_ok=True)
 
     dates = utilities.create_list_dates(
-        tz.localize(start), tz.localize(end), freq
+        tz.localize(start), tz.localize(end), freq, step
     )
     
     if freq == 'days':
         
         dates = [i.replace(hour=close) for i in dates]
 
-    pe_ts = pd.DataFrame()
+    run_manifest = None
 
-    volumes = pd.DataFrame()
+    if resume == True and local == False:
 
-    for date in dates:
-        
-        print(
-            f"Starting: {date}"
+        print("WARNING RESUME NEEDS LOCAL INPUTS, ALL DATES WILL BE CALCULATED")
+
+    elif resume == True:
+
+        # rows already in the outputs of a first resumed run are kept ahead.
+        fresh = not os.path.exists(os.path.join(save_path, "manifest.jsonl"))
+
+        run_manifest = manifest.RunManifest(
+            save_path,
+            {
+                "window": window,
+                "partition": partition,
+                "ped": ped,
+                "ped_mode": ped_mode,
+                "markets": sorted(markets or []),
+                "drop_erroneous": drop_erroneous,
+                "first_last": first_last,
+                "tz": str(tz),
+                "name": name,
+                "instruments": instruments,
+                "instrument_field": instrument_field,
+                # only added when set so manifests of exact runs stay valid.
+                **({"relative_accuracy": relative_accuracy} if relative_accuracy is not None else {}),
+            },
         )
-        
-        if local == True:
 
-            data = utilities.read_json(read_path, f"{date.date()}.json")
-            
+        n = len(dates)
+
+        todo = [
+            d for d in dates
+            if not run_manifest.done(int(datetime.timestamp(d) * 1000), read_path, f"{d.date()}.json")
+        ]
+
+        if len(todo) > 0:
+
+            # outputs are kept in calc time order, so they are cut back to the
+            # first calc time to recalculate and every later one is redone.
+            first_redo = int(datetime.timestamp(todo[0]) * 1000)
+
+            last = int(datetime.timestamp(dates[-1]) * 1000)
+
+            later = [t for t in run_manifest.calcs if t > last]
+
+            if len(later) > 0:
+
+                print(f"WARNING {len(later)} CALC TIMES AFTER {dates[-1]} ARE CUT FROM THE OUTPUTS, RUN THEM AGAIN TO ADD THEM BACK")
+
+            dates = [d for d in dates if int(datetime.timestamp(d) * 1000) >= first_redo]
+
         else:
-            
-            ### download from s3 - not written yet 
-            ''
 
-        
+            dates = []
 
-        data = utilities.erroneous_check(data)
+        print(f"RESUMING: {n - len(dates)} OF {n} CALC TIMES ALREADY COMPLETE")
 
-        df = utilities.filter_window(data, date)  # ASSUMES HOUR WINDOW TO FILTER. 
+        # the commit of hashes of files hashed for the first time.
+        run_manifest.commit()
 
-        ped_exchanges, vwm_e, median_vwm_e = utilities.potentially_errorneous_check(df, ped)
-        
-        if len(ped_exchanges) > 1:
-            
-            print(f"PED PARARM REMOVING: {ped_exchanges}")
-            
-            df = df[~df['exchange'].isin(ped_exchanges)] ## CHECK THIS WORKS. 
-            
+    prefetcher = None
 
-        # df["Volume"] = df["price"] * df["size"]
-
-        # volumes = pd.concat(
-        #     [
-        #         volumes,
-        #         df[["exchange", "Volume"]]
-        #         .groupby("exchange")
-        #         .sum()
-        #         .rename(columns={"Volume": date + timedelta(hours=16)})
-        #         .T,
-        #     ]
-        # )
-
-        # wm_e.update(
-        #     {
-        #         "lowerThreshold": pe_median * 0.9,
-        #         "upperThreshold": pe_median * 1.1,
-        #         "AllExchangeMedian": pe_median,
-        #     }
-        # )
-
-        # pe_ts = pd.concat([pe_ts, pd.DataFrame(wm_e, index=[date.date()])])
-
-
-
-        ccrr, weighted_medians = utilities.calc(df, partition, datetime.timestamp(date) ,first_last)
-
-        utilities.write_csv(
-            "LTCUSD_RR",
-            pd.DataFrame(
-                {
-                    "time": [data["time"]],
-                    "Date": [utilities.ts_to_dt(int(data["time"]) / 1000)],
-                    "LTCUSD_RR": [median.round(4)],
-                }
-            ),
-            save_path,
+    if local == False:
+
+        # files are downloaded into download_path ahead of the calc and then
+        # read from there like local files.
+        prefetcher = sources.Prefetcher(
+            sources.make_source(source),
+            source.get("download_path", os.path.join(save_path, "downloads", "")),
+            source.get("threads", 2),
         )
 
-        utilities.write_csv("WeightedMedians", weighted_medians, save_path)
+        read_path = os.path.join(prefetcher.path, "")
+
+    calc_one = partial(
+        calc_date,
+        read_path=read_path,
+        window=window,
+        partition=partition,
+        ped=ped,
+        local=True,
+        first_last=first_last,
+        drop_erroneous=drop_erroneous,
+        stream=stream,
+        cache_path=cache_path,
+        profile=profile,
+        trace_memory=trace_memory,
+        profile_path=os.path.join(save_path, "profiles"),
+        name=name,
+        instruments=instruments,
+        instrument_field=instrument_field,
+        markets=markets,
+        ped_mode=ped_mode,
+        out_of_core=out_of_core,
+        memory_budget_mb=memory_budget_mb,
+        spill_path=spill_path,
+        relative_accuracy=relative_accuracy,
+    )
+
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    if prefetcher is not None:
+
+        results = iter_prefetched(calc_one, dates, pool, workers, prefetcher, source.get("prefetch", 2))
+
+    elif pool is not None:
+
+        # dates are independent, results come back in date order so the
+        # outputs are written exactly as a serial run would write them.
+        # Consecutive dates are kept together so bucket reuse still applies.
+        results = pool.map(
+            calc_one, dates, chunksize=max(1, len(dates) // (workers * 4))
+        )
+
+    else:
+
+        results = map(calc_one, dates)
+
+    # output name -> (rr sink, weighted medians sink, partition & exchange
+    # liquidity sinks), opened on first result.
+    outputs = {}
+
+    def sinks_for(rr_name):
+
+        if rr_name not in outputs:
+
+            prefix = "" if instruments is None else rr_name[: -len("_RR")] + "_"
+
+            outputs[rr_name] = (
+                sinks.ResultSink(save_path, rr_name, output_format, flush_every),
+                sinks.ResultSink(save_path, prefix + "WeightedMedians", output_format, flush_every),
+                # liquidity is collected as columns and joined once per flush.
+                sinks.ColumnSink(save_path, prefix + "PartitionLiquidity", output_format, flush_every),
+                sinks.ColumnSink(save_path, prefix + "ExchangeLiquidity", output_format, flush_every),
+            )
+
+        return outputs[rr_name]
+
+    if run_manifest is not None:
+
+        run_sinks = [
+            sink
+            for rr_name in ([name] if instruments is None else [output_name(i) for i in instruments])
+            for sink in sinks_for(rr_name)
+        ]
+
+        if fresh:
+
+            run_manifest.set_base({sink.name: sink.rows() for sink in run_sinks})
+
+        if len(dates) > 0:
+
+            # rows of the calc times about to be recalculated (from a changed
+            # input or a run that stopped before recording them) and of every
+            # later one are cut, the manifest forgets them first.
+            first_redo = int(datetime.timestamp(dates[0]) * 1000)
+
+            keep = {sink.name: run_manifest.rows_before(first_redo, sink.name) for sink in run_sinks}
+
+            run_manifest.truncate(first_redo)
+
+            run_manifest.commit()
+
+            for sink in run_sinks:
+
+                sink.truncate(keep[sink.name])
+
+        run_manifest.commit()
+
+    records = []
+
+    metrics_file = open(os.path.join(save_path, "metrics.jsonl"), "a") if save_metrics else None
+
+    try:
+
+        for date, result in zip(dates, results):
+
+            # output name -> rows written for the date.
+            rows = {}
+
+            if result is not None:
+
+                instrument_results, stage_records = result
+
+                for rr_name, (rr, weighted_medians, liquidity) in instrument_results.items():
+
+                    rr_sink, weighted_medians_sink, partitions_sink, exchanges_sink = sinks_for(rr_name)
+
+                    rows.update(
+                        {
+                            rr_sink.name: len(rr),
+                            weighted_medians_sink.name: len(weighted_medians),
+                            partitions_sink.name: len(liquidity["partitions"]["time"]),
+                            exchanges_sink.name: len(liquidity["exchanges"]["time"]),
+                        }
+                    )
+
+                    rr_sink.write(rr)
+
+                    weighted_medians_sink.write(weighted_medians)
+
+                    partitions_sink.write(liquidity["partitions"])
+
+                    exchanges_sink.write(liquidity["exchanges"])
+
+                records += stage_records
+
+                if metrics_file is not None:
+
+                    metrics_file.write("".join(json.dumps(r) + "\n" for r in stage_records))
+
+            if run_manifest is not None:
+
+                run_manifest.record(int(datetime.timestamp(date) * 1000), read_path, f"{date.date()}.json", rows)
+
+                # every flush_every dates all outputs are flushed together and
+                # the dates committed, in batch mode instruments' outputs hold
+                # different numbers of writes so they rarely flush together.
+                if len(run_manifest.pending) >= flush_every:
+
+                    for group in outputs.values():
+
+                        for sink in group:
+
+                            sink.flush()
+
+                    run_manifest.commit()
+
+    finally:
+
+        if metrics_file is not None:
+
+            metrics_file.close()
+
+            print(f"STAGE SUMMARY: \n{metrics.summarise(records).to_string()}")
+
+        # completed dates are kept even if a later one fails.
+        for group in outputs.values():
+
+            for sink in group:
+
+                sink.close()
+
+        if run_manifest is not None:
+
+            run_manifest.commit()
+
+        if pool is not None:
+
+            pool.shutdown()
+
+        if prefetcher is not None:
+
+            prefetcher.close()
 
     # weights = volumes.apply(lambda x: x / volumes.sum(axis=1))
 
@@ -227,39 +983,183 @@ def run(read_path:str, save_path :str, start: datetime, end:datetime, freq:str,
     #         print(type(e))
 
 
-if __name__ == "__main__":
-    
-    CONFIG = yaml.safe_load(open("config.yml"))
-    
-    READ_PATH = CONFIG['inputs']['read_path']
+def load_config(path: str = "config.yml", overrides: list = ()) -> dict:
+    """
+    Reads the yml config and applies command line overrides.
+
+    Parameters
+    ----------
+    path : str, optional
+        path to the config. The default is "config.yml".
+    overrides : list, optional
+        'section.key=value' strings, i.e. 'inputs.freq=hours' or
+        'inputs.sweep.ped_parameter=[5, 10]'. Values are read as yml, so
+        dates, numbers & lists have the same types as in the file. The
+        default is ().
+
+    Returns
+    -------
+    dict
+        the config.
+
+    """
 
-    SAVE_PATH = os.path.expanduser(f"~/{CONFIG['outputs']['root']}") + CONFIG['outputs']['expand']
+    with open(path) as f:
+
+        config = yaml.safe_load(f)
+
+    for override in overrides:
+
+        key, sep, value = override.partition("=")
+
+        if not sep or not key:
+
+            raise ValueError(f"Config overrides must be section.key=value: {override}")
+
+        *sections, last = key.strip().split(".")
+
+        node = config
+
+        for section in sections:
+
+            if not isinstance(node.get(section), dict):
+
+                node[section] = {}
+
+            node = node[section]
+
+        node[last] = yaml.safe_load(value)
+
+    return config
+
+
+def run_config(config: dict):
+    """
+    Runs the RR (or a sweep if inputs.sweep is set) for a config as read by
+    load_config.
+    """
+
+    READ_PATH = config['inputs']['read_path']
+
+    SAVE_PATH = os.path.expanduser(f"~/{config['outputs']['root']}") + config['outputs']['expand']
     
-    ASSET = CONFIG['inputs']['asset']
+    ASSET = config['inputs']['asset']
     
-    QUOTE = CONFIG['inputs']['quote']
+    QUOTE = config['inputs']['quote']
 
-    START = CONFIG['inputs']['start']
+    START = config['inputs']['start']
 
-    END = CONFIG['inputs']['end']
+    END = config['inputs']['end']
     
-    FREQ = CONFIG['inputs']['freq']
+    FREQ = config['inputs']['freq']
 
-    TZ = CONFIG['inputs']['tz']
+    TZ = config['inputs']['tz']
+    
+    CLOSE = config['inputs']['close']
+    
+    WINDOW = config['inputs']['window_length']
+    
+    PARTITION = config['inputs']['partition_length']
     
-    CLOSE = CONFIG['inputs']['close']
+    MARKETS = config['inputs']['markets']
     
-    WINDOW = CONFIG['inputs']['window_length']
+    PED = config['inputs']['ped_parameter']
     
-    PARTITION = CONFIG['inputs']['partition_length']
+    READ_LOCALLY = config['inputs']['read_input_locally']
     
-    MARKETS = CONFIG['inputs']['markets']
+    DROP_ERRONEOUS = config['inputs'].get('drop_erroneous', False)
     
-    PED = CONFIG['inputs']['ped_parameter']
+    WORKERS = config['inputs'].get('workers', 1)
     
-    READ_LOCALLY = CONFIG['inputs']['read_input_locally']
+    STREAM = config['inputs'].get('stream_input', False)
     
-    SAVE_FIRST_LAST = CONFIG['outputs']['save_first_last']
+    CACHE_PATH = config['inputs'].get('cache_path')
+    
+    STEP = config['inputs'].get('step', 1)
+    
+    SOURCE = config['inputs'].get('source')
+    
+    SAVE_FIRST_LAST = config['outputs']['save_first_last']
+    
+    OUTPUT_FORMAT = config['outputs'].get('format', 'csv')
+    
+    FLUSH_EVERY = config['outputs'].get('flush_every', 100)
+    
+    SAVE_METRICS = config['outputs'].get('metrics', True)
+    
+    PROFILE = config['outputs'].get('profile') or []
+    
+    TRACE_MEMORY = config['outputs'].get('trace_memory') or []
+    
+    INSTRUMENTS = config['inputs'].get('instruments') or None
+    
+    INSTRUMENT_FIELD = config['inputs'].get('instrument_field', 'instrument')
+    
+    PED_MODE = config['inputs'].get('ped_mode', 'window')
+    
+    RESUME = config['outputs'].get('resume', False)
+    
+    OUT_OF_CORE = config['inputs'].get('out_of_core', False)
+    
+    MEMORY_BUDGET_MB = config['inputs'].get('memory_budget_mb', 256)
+    
+    SPILL_PATH = config['inputs'].get('spill_path')
+    
+    SWEEP = config['inputs'].get('sweep') or {}
+    
+    RELATIVE_ACCURACY = config['inputs'].get('relative_accuracy')
+
+
+    if SWEEP:
+
+        # imported here as sweep imports this module, at the top a script run
+        # of main.py would load it a second time with its own caches.
+        import sweep
+
+        # missing grids take the single value from the config.
+        sweep.run(READ_PATH, SAVE_PATH, START, END, FREQ, TZ, CLOSE, SWEEP.get('window_length', [WINDOW]), SWEEP.get('partition_length', [PARTITION]), SWEEP.get('ped_parameter', [PED]), MARKETS, READ_LOCALLY, DROP_ERRONEOUS, WORKERS, STREAM, CACHE_PATH, STEP, OUTPUT_FORMAT, FLUSH_EVERY, SAVE_METRICS, output_name(ASSET + QUOTE), PED_MODE, OUT_OF_CORE, MEMORY_BUDGET_MB, SPILL_PATH, RELATIVE_ACCURACY)
+
+    else:
 
+        run(READ_PATH,SAVE_PATH, START, END, FREQ, TZ, CLOSE, WINDOW, PARTITION, MARKETS, PED, READ_LOCALLY, SAVE_FIRST_LAST, DROP_ERRONEOUS, WORKERS, STREAM, CACHE_PATH, STEP, SOURCE, OUTPUT_FORMAT, FLUSH_EVERY, SAVE_METRICS, PROFILE, TRACE_MEMORY, output_name(ASSET + QUOTE), INSTRUMENTS, INSTRUMENT_FIELD, PED_MODE, RESUME, OUT_OF_CORE, MEMORY_BUDGET_MB, SPILL_PATH, RELATIVE_ACCURACY)
+
+
+def cli(argv: list = None):
+    """
+    Command line entry point, runs the config with any overrides:
+
+        python main.py --config config.yml --set inputs.freq=hours --set "inputs.start=2024-01-01 16:00:00"
+
+    Nothing is plotted, so plotly is never imported.
+    """
+
+    parser = argparse.ArgumentParser(description="Calculate the RR for the dates & parameters in a config.")
+
+    parser.add_argument("--config", default="config.yml", help="yml config to run")
+
+    parser.add_argument("--set", dest="overrides", action="append", default=[], metavar="SECTION.KEY=VALUE", help="override a config value, i.e. inputs.window_length=30 (repeatable)")
+
+    parser.add_argument("--print-config", action="store_true", help="print the config after overrides and exit")
+
+    args = parser.parse_args(argv)
+
+    try:
+
+        config = load_config(args.config, args.overrides)
+
+    except ValueError as e:
+
+        parser.error(str(e))
+
+    if args.print_config:
+
+        print(yaml.safe_dump(config, sort_keys=False))
+
+        return
+
+    run_config(config)
+
+
+if __name__ == "__main__":
 
-    run(READ_PATH,SAVE_PATH, START, END, FREQ, TZ, CLOSE, WINDOW, PARTITION, MARKETS, PED, READ_LOCALLY, SAVE_FIRST_LAST)
+    cli()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Run manifest for resumable backfills. Every calc time whose outputs have been
+written is recorded with a content hash of its input file and a hash of the
+parameters used, so a rerun over the same range only calculates the dates
+that are missing or whose input or parameters have changed.
+
+The manifest is a json lines file in the save path, entries are only ever
+appended and the latest entry for a calc time (or file) wins. Each calc time
+also records the rows it wrote to every output. Outputs are kept in calc time
+order, so those counts locate the rows of any calc time and a resumed run
+cuts the outputs back to the first calc time it recalculates (a 'truncate'
+entry forgets every calc time from it on).
+
+@author: theo
+"""
+
+import hashlib
+import json
+import os
+
+
+def params_hash(params: dict) -> str:
+    """hash of the parameters that change the outputs of a calc time."""
+
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    """content hash of a file, read in chunks."""
+
+    digest = hashlib.blake2b(digest_size=16)
+
+    with open(path, "rb") as f:
+
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+class RunManifest:
+    """
+    Completed calc times of the runs saving to one folder:
+
+        manifest = RunManifest(save_path, params)
+
+        todo = [d for d in dates if not manifest.done(d, path, file)]
+
+        ...
+
+        manifest.record(date, path, file, {output: rows})
+
+        manifest.commit()
+
+    Input hashes are kept with the size/mtime of the file they were taken
+    from, so unchanged files are not hashed again on later runs.
+    """
+
+    def __init__(self, path: str, params: dict, name: str = "manifest.jsonl"):
+        """
+        Parameters
+        ----------
+        path : str
+            folder of the outputs, the manifest is saved with them.
+        params : dict
+            parameters of this run that change the outputs.
+        name : str, optional
+            file name of the manifest. The default is "manifest.jsonl".
+
+        """
+
+        self.file = os.path.join(path, name)
+
+        self.params = params_hash(params)
+
+        # calc time (ms) -> entry, file path -> entry
+        self.calcs = {}
+
+        self.files = {}
+
+        # output name -> rows it held before the first resumed run.
+        self.base = {}
+
+        self.pending = []
+
+        if os.path.exists(self.file):
+
+            with open(self.file) as f:
+
+                for line in f:
+
+                    try:
+
+                        entry = json.loads(line)
+
+                    except json.JSONDecodeError:
+
+                        # a line cut short by a crash.
+                        continue
+
+                    if "truncate" in entry:
+
+                        self.calcs = {t: e for t, e in self.calcs.items() if t < entry["truncate"]}
+
+                    elif "base" in entry:
+
+                        self.base = entry["base"]
+
+                    elif "time" in entry:
+
+                        self.calcs[entry["time"]] = entry
+
+                    else:
+
+                        self.files[entry["path"]] = entry
+
+    def input_hash(self, path: str, file: str) -> str:
+        """
+        content hash of path/file, None if it does not exist. Only hashed if
+        its size or mtime differ from when it was last hashed.
+        """
+
+        full = f"{path}{file}"
+
+        try:
+
+            stat = os.stat(full)
+
+        except FileNotFoundError:
+
+            return None
+
+        known = self.files.get(full)
+
+        if known is not None and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+
+            return known["hash"]
+
+        entry = {"path": full, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": file_hash(full)}
+
+        self.files[full] = entry
+
+        self.pending.append(entry)
+
+        return entry["hash"]
+
+    def done(self, calc_time: int, path: str, file: str) -> bool:
+        """
+        True if calc_time (ms) has been calculated from the same input and
+        parameters as this run.
+        """
+
+        entry = self.calcs.get(calc_time)
+
+        return (
+            entry is not None
+            and entry["params_hash"] == self.params
+            and entry["input_hash"] == self.input_hash(path, file)
+        )
+
+    def record(self, calc_time: int, path: str, file: str, rows: dict = None):
+        """
+        Marks calc_time (ms) as complete, having written 'rows' ({output name:
+        rows}) to the outputs. Written to the manifest on the next commit,
+        which should only be made once its outputs are on disk.
+        """
+
+        entry = {
+            "time": calc_time,
+            "file": file,
+            "input_hash": self.input_hash(path, file),
+            "params_hash": self.params,
+            "rows": rows or {},
+        }
+
+        self.calcs[calc_time] = entry
+
+        self.pending.append(entry)
+
+    def set_base(self, rows: dict):
+        """
+        Records the rows ({output name: rows}) the outputs held before the
+        first resumed run, kept ahead of every calc time.
+        """
+
+        self.base = rows
+
+        self.pending.append({"base": rows})
+
+    def rows_before(self, calc_time: int, output: str) -> int:
+        """rows of 'output' written before calc_time (ms)."""
+
+        return self.base.get(output, 0) + sum(
+            entry.get("rows", {}).get(output, 0) for t, entry in self.calcs.items() if t < calc_time
+        )
+
+    def truncate(self, calc_time: int):
+        """
+        Forgets every calc time at or after calc_time (ms), as their rows are
+        about to be cut from the outputs. Commit before cutting them.
+        """
+
+        self.calcs = {t: entry for t, entry in self.calcs.items() if t < calc_time}
+
+        self.pending.append({"truncate": calc_time})
+
+    def commit(self):
+
+        if len(self.pending) == 0:
+
+            return
+
+        with open(self.file, "a") as f:
+
+            f.write("".join(json.dumps(entry) + "\n" for entry in self.pending))
+
+            f.flush()
+
+            os.fsync(f.fileno())
+
+        self.pending = []
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per stage timing of the RR calculation. Each calc date records the wall time
+and row count of its stages (load, validation, window, ped, calc), which
+main.run writes as json lines and summarises at the end of the run. Any stage
+can also be run under cProfile and/or tracemalloc.
+
+@author: theo
+"""
+
+import cProfile
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+import pandas as pd
+
+
+class StageMetrics:
+    """
+    Collects one record per stage for a single calc date:
+
+        metrics = StageMetrics(date)
+
+        with metrics.stage("load") as record:
+
+            data = ...
+
+            record["rows"] = len(data["trades"])
+    """
+
+    def __init__(self, date, profile: list = (), trace_memory: list = (), profile_path: str = ""):
+        """
+        Parameters
+        ----------
+        date : datetime
+            calc date the records belong to.
+        profile : list, optional
+            stages to run under cProfile, stats are saved as
+            profile_path/{date}_{stage}.prof. The default is ().
+        trace_memory : list, optional
+            stages to run under tracemalloc, the peak is recorded as
+            'peak_bytes'. The default is ().
+        profile_path : str, optional
+            folder for the cProfile stats. The default is "".
+
+        """
+
+        self.date = str(date)
+
+        self.profile = profile or ()
+
+        self.trace_memory = trace_memory or ()
+
+        self.profile_path = profile_path
+
+        self.records = []
+
+    @contextmanager
+    def stage(self, name: str, **tags):
+        """times the stage 'name', any tags (i.e. instrument) are added to its record."""
+
+        record = {"date": self.date, "stage": name, **tags, "rows": None}
+
+        profiler = cProfile.Profile() if name in self.profile else None
+
+        trace = name in self.trace_memory and not tracemalloc.is_tracing()
+
+        if trace:
+
+            tracemalloc.start()
+
+        if profiler is not None:
+
+            profiler.enable()
+
+        t0 = time.perf_counter()
+
+        try:
+
+            yield record
+
+        finally:
+
+            record["seconds"] = time.perf_counter() - t0
+
+            if profiler is not None:
+
+                profiler.disable()
+
+                os.makedirs(self.profile_path or ".", exist_ok=True)
+
+                profiler.dump_stats(
+                    os.path.join(self.profile_path, f"{self.date[:19].replace(':', '-').replace(' ', '_')}_{'_'.join([name, *map(str, tags.values())])}.prof")
+                )
+
+            if trace:
+
+                record["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+
+                tracemalloc.stop()
+
+            self.records.append(record)
+
+
+def summarise(records: list) -> pd.DataFrame:
+    """
+    Summary of the stage records of a run: number of dates, total/mean/max
+    seconds and total rows for each stage.
+
+    Parameters
+    ----------
+    records : list
+        stage records (dicts) of every date.
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per stage, in the order the stages first ran.
+
+    """
+
+    if len(records) == 0:
+
+        return pd.DataFrame()
+
+    df = pd.DataFrame(records)
+
+    summary = df.groupby("stage", sort=False).agg(
+        dates=("date", "nunique"),
+        total_seconds=("seconds", "sum"),
+        mean_seconds=("seconds", "mean"),
+        max_seconds=("seconds", "max"),
+        rows=("rows", "sum"),
+    )
+
+    summary["share"] = summary["total_seconds"] / summary["total_seconds"].sum()
+
+    return summary
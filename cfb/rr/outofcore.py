@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Out of core loading for trade days larger than memory. The json is streamed
+into typed column buffers of at most 'memory_budget_mb', each full buffer is
+sorted by time and spilled to disk as a run of .npy columns. A window is then
+read back by binary searching every (memory-mapped) run and merging only the
+slices that fall in it. The budget bounds the spilling only: a calc window is
+loaded whole, so peak memory is the budget plus the largest window of trades,
+whatever the size of the day. A window larger than memory does not fit. Trades
+without a readable time are only counted, not kept.
+
+@author: theo
+"""
+
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import containers
+import readers
+import utilities
+
+
+# bytes per buffered trade: the typed columns plus the sort order and the
+# sorted copies made when spilling.
+BYTES_PER_TRADE = 64
+
+RUN_COLUMNS = ["time", "price", "size", "exchange", "flags", "instrument"]
+
+
+class SpilledTrades:
+    """
+    A day of trades spilled as sorted runs, windows are cut like
+    containers.TradeIndex.window:
+
+        trades = spill_json(path, file, spill_path, 256)["trades"]
+
+        df = trades.window(start_ms, end_ms)
+
+    Trades keep their file order within the same ms. Erroneous trades are
+    checked per window (utilities.erroneous_check). Each window is read into
+    memory whole, outside of the spilling budget.
+    """
+
+    def __init__(self, runs: list, exchanges: list, tmp, drop_erroneous: bool = False, instruments: dict = None, instrument: int = None, rejected: int = 0):
+        """
+        Parameters
+        ----------
+        runs : list
+            directories of the sorted runs, in file order.
+        exchanges : list
+            exchange names of the exchange codes.
+        tmp : tempfile.TemporaryDirectory
+            directory holding the runs, removed with the last reference to it.
+        drop_erroneous : bool, optional
+            If True erroneous trades are dropped from each window rather than
+            flagged. The default is False.
+        instruments : dict, optional
+            instrument name -> code, if the day was spilled with an
+            instrument field. The default is None.
+        instrument : int, optional
+            If given only trades of this instrument code are returned. The
+            default is None.
+        rejected : int, optional
+            number of trades of the day without a readable time, reported by
+            each window's erroneous check. The default is 0.
+
+        """
+
+        self.runs = runs
+
+        self.exchanges = exchanges
+
+        self.tmp = tmp
+
+        self.drop_erroneous = drop_erroneous
+
+        self.instruments = instruments or {}
+
+        self.instrument = instrument
+
+        self.rejected = rejected
+
+        self.columns = [
+            {
+                column: np.load(os.path.join(run, f"{column}.npy"), mmap_mode="r")
+                for column in RUN_COLUMNS
+                if os.path.exists(os.path.join(run, f"{column}.npy"))
+            }
+            for run in runs
+        ]
+
+    def __len__(self) -> int:
+
+        if self.instrument is None:
+
+            return sum(len(c["time"]) for c in self.columns)
+
+        return sum(int((c["instrument"] == self.instrument).sum()) for c in self.columns)
+
+    def window(self, start: float, end: float):
+        """
+        Checked trades with start <= time < end, in time order.
+
+        Parameters
+        ----------
+        start : float
+            window start in ms.
+        end : float
+            window end in ms, not included.
+
+        Returns
+        -------
+        containers.TradeBatch/pd.DataFrame
+            exchange, time, price, size, a frame if erroneous trades are
+            flagged rather than dropped.
+
+        """
+
+        slices = []
+
+        for columns in self.columns:
+
+            lo, hi = np.searchsorted(columns["time"], [start, end], side="left")
+
+            if hi > lo:
+
+                part = {column: np.asarray(values[lo:hi]) for column, values in columns.items()}
+
+                if self.instrument is not None:
+
+                    keep = part["instrument"] == self.instrument
+
+                    part = {column: values[keep] for column, values in part.items()}
+
+                slices.append(part)
+
+        if len(slices) == 0:
+
+            merged = {column: np.empty(0, dtype=dtype) for column, dtype in [("time", np.int64), ("price", np.float64), ("size", np.float64), ("exchange", np.int32), ("flags", np.uint8)]}
+
+        else:
+
+            merged = {column: np.concatenate([s[column] for s in slices]) for column in ["time", "price", "size", "exchange", "flags"]}
+
+            # runs are in file order, so a stable sort keeps ties in file order.
+            order = np.argsort(merged["time"], kind="stable")
+
+            merged = {column: values[order] for column, values in merged.items()}
+
+        data = {
+            "trades": {
+                "exchange": pd.Categorical.from_codes(merged["exchange"], categories=self.exchanges),
+                "time": merged["time"],
+                "price": merged["price"],
+                "size": merged["size"],
+            },
+            "flags": merged["flags"],
+            "rejected": self.rejected,
+        }
+
+        return containers.compact(utilities.erroneous_check(data, self.drop_erroneous)["trades"])
+
+    def split(self, column: str, keys: list = None) -> dict:
+        """
+        {instrument: SpilledTrades} for the instruments in keys (all if None),
+        sharing the same runs. 'column' is the instrument field the day was
+        spilled with.
+        """
+
+        return {
+            k: SpilledTrades(self.runs, self.exchanges, self.tmp, self.drop_erroneous, self.instruments, code, self.rejected)
+            for k, code in self.instruments.items()
+            if keys is None or k in keys
+        }
+
+
+def _spill(columns: readers.TradeColumns, directory: str) -> str:
+    """sorts the buffered trades by time and saves them as a run."""
+
+    os.makedirs(directory)
+
+    times = np.frombuffer(columns.times, dtype=np.int64)
+
+    order = np.argsort(times, kind="stable")
+
+    run = {
+        "time": times,
+        "price": np.frombuffer(columns.prices, dtype=np.float64),
+        "size": np.frombuffer(columns.sizes, dtype=np.float64),
+        "exchange": np.frombuffer(columns.codes, dtype=np.int32),
+        "flags": np.frombuffer(columns.flags, dtype=np.uint8),
+    }
+
+    if columns.instrument_field:
+
+        run["instrument"] = np.frombuffer(columns.instrument_codes, dtype=np.int32)
+
+    for column, values in run.items():
+
+        np.save(os.path.join(directory, f"{column}.npy"), values[order])
+
+    columns.clear()
+
+    return directory
+
+
+def spill_json(
+    path: str,
+    file: str,
+    spill_path: str = None,
+    memory_budget_mb: float = 256,
+    drop_erroneous: bool = False,
+    instrument_field: str = None,
+    markets: list = None,
+    chunk_size: int = 1 << 20,
+) -> dict:
+    """
+    Streams a trade file into sorted runs on disk, holding at most
+    'memory_budget_mb' of trades in memory at a time. The windows read back
+    afterwards are not part of the budget.
+
+    If file not found error returns none.
+
+    Parameters
+    ----------
+    path : str
+        directory path of file.
+    file : str
+        file name.
+    spill_path : str, optional
+        directory the runs are written under, removed once the day is no
+        longer referenced. The default is None, the system temp directory.
+    memory_budget_mb : float, optional
+        memory for buffered trades in MB. The default is 256.
+    drop_erroneous : bool, optional
+        see SpilledTrades. The default is False.
+    instrument_field : str, optional
+        see readers.read_json_stream. The default is None.
+    markets : list, optional
+        exchanges to keep. The default is None, all exchanges.
+    chunk_size : int, optional
+        characters read from the file at a time. The default is 1 << 20.
+
+    Returns
+    -------
+    dict
+        top level keys of the file (i.e. "time") with "trades" as a
+        SpilledTrades and "rejected" as the number of trades without a
+        readable time.
+
+    """
+
+    budget = max(1, int(memory_budget_mb * 1e6) // BYTES_PER_TRADE)
+
+    if spill_path:
+
+        os.makedirs(spill_path, exist_ok=True)
+
+    tmp = tempfile.TemporaryDirectory(prefix=f"{os.path.splitext(file)[0]}-", dir=spill_path or None)
+
+    columns = readers.TradeColumns(instrument_field, markets)
+
+    runs = []
+
+    def on_trade(trade):
+
+        columns.add(trade)
+
+        if len(columns) >= budget:
+
+            runs.append(_spill(columns, os.path.join(tmp.name, str(len(runs)))))
+
+    try:
+
+        with open(f"{path}{file}") as f:
+
+            data = readers._stream_top_level(f, chunk_size, on_trade)
+
+    except FileNotFoundError:
+
+        print(f"WARNING FILE NOT FOUND: {path}{file}")
+
+        tmp.cleanup()
+
+        return None
+
+    if len(columns) > 0 or len(runs) == 0:
+
+        runs.append(_spill(columns, os.path.join(tmp.name, str(len(runs)))))
+
+    if columns.rejected > 0:
+
+        print(f"WARNING {columns.rejected} TRADES WITHOUT A READABLE TIME: {path}{file}")
+
+    data["trades"] = SpilledTrades(runs, list(columns.exchanges), tmp, drop_erroneous, dict(columns.instruments), rejected=columns.rejected)
+
+    data["rejected"] = columns.rejected
+
+    return data
@@ -0,0 +1,723 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Readers for the daily {"time": ..., "trades": [...]} trade files.
+
+Rather than json.load-ing the whole file into a list of dicts, the trades
+array is parsed one trade at a time and appended straight into typed column
+buffers, so peak memory is close to the size of the final columns.
+
+Parsed files can also be kept in a columnar on disk cache, one entry per
+date, which later runs memory-map instead of parsing the json again.
+
+@author: theo
+"""
+
+import json
+import os
+import shutil
+import tempfile
+from array import array
+import numpy as np
+import pandas as pd
+
+
+DECODER = json.JSONDecoder()
+
+WHITESPACE = " \t\n\r"
+
+
+class _JsonStream:
+    """
+    Minimal incremental reader over a json text file: holds a rolling buffer
+    and decodes one value at a time with JSONDecoder.raw_decode, reading more
+    of the file whenever a value runs past the end of the buffer.
+    """
+
+    def __init__(self, f, chunk_size: int):
+
+        self.f = f
+
+        self.chunk_size = chunk_size
+
+        self.buf = ""
+
+        self.pos = 0
+
+        self.eof = False
+
+    def _fill(self) -> bool:
+
+        if self.eof:
+
+            return False
+
+        chunk = self.f.read(self.chunk_size)
+
+        if not chunk:
+
+            self.eof = True
+
+            return False
+
+        self.buf = self.buf[self.pos :] + chunk
+
+        self.pos = 0
+
+        return True
+
+    def peek(self) -> str:
+        """next non whitespace character, '' at end of file."""
+
+        while True:
+
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+
+                self.pos += 1
+
+            if self.pos < len(self.buf):
+
+                return self.buf[self.pos]
+
+            if not self._fill():
+
+                return ""
+
+    def expect(self, chars: str) -> str:
+
+        char = self.peek()
+
+        if char == "" or char not in chars:
+
+            raise ValueError(f"Expected one of {chars!r} in json, got {char!r}")
+
+        self.pos += 1
+
+        return char
+
+    def value(self):
+        """decodes the next json value."""
+
+        self.peek()
+
+        while True:
+
+            try:
+
+                value, end = DECODER.raw_decode(self.buf, self.pos)
+
+                # a number can be cut short by the end of the buffer.
+                if end < len(self.buf) or self.eof:
+
+                    self.pos = end
+
+                    return value
+
+            except json.JSONDecodeError:
+
+                if self.eof:
+
+                    raise
+
+            self._fill()
+
+
+def _stream_top_level(f, chunk_size: int, on_trade, until: str = None):
+    """
+    Walks the top level object of a trade file, calling on_trade for every
+    element of "trades" and returning the other top level keys. Stops early
+    once the key 'until' has been read.
+    """
+
+    stream = _JsonStream(f, chunk_size)
+
+    top = {}
+
+    stream.expect("{")
+
+    if stream.peek() == "}":
+
+        return top
+
+    while True:
+
+        key = stream.value()
+
+        stream.expect(":")
+
+        if key == "trades":
+
+            stream.expect("[")
+
+            if stream.peek() == "]":
+
+                stream.pos += 1
+
+            else:
+
+                while True:
+
+                    on_trade(stream.value())
+
+                    if stream.expect(",]") == "]":
+
+                        break
+
+        else:
+
+            top[key] = stream.value()
+
+            if key == until:
+
+                return top
+
+        if stream.expect(",}") == "}":
+
+            return top
+
+
+# erroneous trade checks, as utilities.validate_trades names them, bit i of a
+# trade's flags is set if it fails ERRONEOUS_FLAGS[i].
+ERRONEOUS_FLAGS = [
+    "missingField exchange",
+    "missingField time",
+    "missingField price",
+    "missingField size",
+    "price_non_numerical",
+    "price_negative",
+    "size_non_numerical",
+    "size_negative",
+]
+
+
+def _is_number(value) -> bool:
+
+    return isinstance(value, (float, int))
+
+
+def trade_flags(trade: dict) -> int:
+    """
+    Erroneous flags of a trade as bits of ERRONEOUS_FLAGS, the same checks
+    as utilities.validate_trades: value checks are only made if no field is
+    missing (absent or null).
+    """
+
+    bits = 0
+
+    for i, field in enumerate(["exchange", "time", "price", "size"]):
+
+        # a null or a nan, as pandas reads them.
+        if trade.get(field) is None or trade[field] != trade[field]:
+
+            bits |= 1 << i
+
+    if bits:
+
+        return bits
+
+    for i, field in [(4, "price"), (6, "size")]:
+
+        if not _is_number(trade[field]):
+
+            bits |= 1 << i
+
+        elif trade[field] < 0:
+
+            bits |= 1 << (i + 1)
+
+    return bits
+
+
+def flag_columns(flags: np.ndarray) -> dict:
+    """{check: bool array} of each check in ERRONEOUS_FLAGS from flag bits."""
+
+    flags = np.asarray(flags, dtype=np.uint8)
+
+    return {name: (flags >> i) & 1 == 1 for i, name in enumerate(ERRONEOUS_FLAGS)}
+
+
+class TradeColumns:
+    """
+    Typed column buffers trades are appended to one at a time: int64 ms time,
+    float64 price and size, int32 exchange (and instrument) codes and the
+    uint8 erroneous flags of each trade (see trade_flags). Erroneous trades
+    are kept and flagged as by utilities.erroneous_check, a price or size
+    that is missing or not a number is held as nan and a missing exchange as
+    code -1. Trades without a readable time can never fall in a window and
+    are only counted in 'rejected'. Trades from exchanges not in 'markets'
+    are skipped. clear() empties the buffers but keeps the code lookups, so
+    codes stay the same across chunks of a file.
+    """
+
+    def __init__(self, instrument_field: str = None, markets: list = None):
+
+        self.instrument_field = instrument_field
+
+        self.markets = set(markets) if markets else None
+
+        self.exchanges = {}
+
+        self.instruments = {}
+
+        self.rejected = 0
+
+        self.clear()
+
+    def clear(self):
+
+        self.times = array("q")
+
+        self.prices = array("d")
+
+        self.sizes = array("d")
+
+        self.codes = array("i")
+
+        self.instrument_codes = array("i")
+
+        self.flags = array("B")
+
+    def __len__(self) -> int:
+
+        return len(self.times)
+
+    def add(self, trade):
+
+        try:
+
+            time = int(trade["time"])
+
+        except (KeyError, TypeError, ValueError):
+
+            self.rejected += 1
+
+            return
+
+        exchange = trade.get("exchange")
+
+        if self.markets is not None and exchange not in self.markets:
+
+            return
+
+        flags = trade_flags(trade)
+
+        price, size = trade.get("price"), trade.get("size")
+
+        self.times.append(time)
+
+        self.prices.append(price if _is_number(price) else np.nan)
+
+        self.sizes.append(size if _is_number(size) else np.nan)
+
+        self.codes.append(-1 if exchange is None else self.exchanges.setdefault(exchange, len(self.exchanges)))
+
+        self.flags.append(flags)
+
+        if self.instrument_field:
+
+            instrument = trade.get(self.instrument_field)
+
+            self.instrument_codes.append(-1 if instrument is None else self.instruments.setdefault(instrument, len(self.instruments)))
+
+    def columns(self) -> dict:
+        """the buffered trades as columns that pd.DataFrame accepts."""
+
+        columns = {
+            "exchange": pd.Categorical.from_codes(
+                np.frombuffer(self.codes, dtype=np.int32), categories=list(self.exchanges)
+            ),
+            "time": np.frombuffer(self.times, dtype=np.int64),
+            "price": np.frombuffer(self.prices, dtype=np.float64),
+            "size": np.frombuffer(self.sizes, dtype=np.float64),
+        }
+
+        if self.instrument_field:
+
+            columns[self.instrument_field] = pd.Categorical.from_codes(
+                np.frombuffer(self.instrument_codes, dtype=np.int32), categories=list(self.instruments)
+            )
+
+        return columns
+
+
+def read_json_stream(path: str, file: str, chunk_size: int = 1 << 20, instrument_field: str = None, markets: list = None) -> dict:
+    """
+    Streams a trade file into typed columns: int64 ms time, float64 price and
+    size and a categorical exchange (and instrument, if instrument_field is
+    given). Erroneous trades are kept and flagged rather than rejected, see
+    TradeColumns, with the flags of every trade under "flags" for
+    utilities.erroneous_check. If markets are given trades from any other
+    exchange are skipped as they are parsed.
+
+    If file not found error returns none.
+
+    Parameters
+    ----------
+    path : str
+        directory path of file.
+    file : str
+        file name.
+    chunk_size : int, optional
+        characters read from the file at a time. The default is 1 << 20.
+    instrument_field : str, optional
+        trade field naming the instrument of each trade in files holding
+        several, read into a categorical column of the same name. The default
+        is None, no instrument column.
+    markets : list, optional
+        exchanges to keep. The default is None, all exchanges.
+
+    Returns
+    -------
+    dict
+        top level keys of the file (i.e. "time") with "trades" as a dict of
+        columns that pd.DataFrame accepts, "flags" as the uint8 flags of each
+        trade and "rejected" as the number of trades without a readable time.
+
+    """
+
+    columns = TradeColumns(instrument_field, markets)
+
+    try:
+
+        with open(f"{path}{file}") as f:
+
+            data = _stream_top_level(f, chunk_size, columns.add)
+
+    except FileNotFoundError:
+
+        print(f"WARNING FILE NOT FOUND: {path}{file}")
+
+        return None
+
+    if columns.rejected > 0:
+
+        print(f"WARNING {columns.rejected} TRADES WITHOUT A READABLE TIME: {path}{file}")
+
+    data["trades"] = columns.columns()
+
+    data["flags"] = np.frombuffer(columns.flags, dtype=np.uint8)
+
+    data["rejected"] = columns.rejected
+
+    return data
+
+
+def read_json_time(path: str, file: str, chunk_size: int = 1 << 20):
+    """
+    Returns the top level "time" of a trade file without holding the trades
+    in memory. If file not found error returns none.
+
+    Parameters
+    ----------
+    path : str
+        directory path of file.
+    file : str
+        file name.
+    chunk_size : int, optional
+        characters read from the file at a time. The default is 1 << 20.
+
+    Returns
+    -------
+    the "time" value as written in the file.
+
+    """
+
+    try:
+
+        with open(f"{path}{file}") as f:
+
+            return _stream_top_level(
+                f, chunk_size, lambda trade: None, until="time"
+            ).get("time")
+
+    except FileNotFoundError:
+
+        print(f"WARNING FILE NOT FOUND: {path}{file}")
+
+
+def filter_markets(data: dict, markets: list) -> dict:
+    """
+    Keeps only the trades of 'markets' in columnar trade data (as returned by
+    read_json_stream or read_cache), selecting on the exchange codes before
+    any frame is built. Unused exchanges are dropped from the categories.
+
+    Parameters
+    ----------
+    data : dict
+        columnar trade data.
+    markets : list
+        exchanges to keep, if empty or None the data is returned as is.
+
+    Returns
+    -------
+    dict
+        the input with "trades" holding only the kept trades.
+
+    """
+
+    if not markets:
+
+        return data
+
+    trades = data["trades"]
+
+    exchange = trades["exchange"]
+
+    kept = [e for e in exchange.categories if e in set(markets)]
+
+    # old code -> new code, -1 for dropped exchanges.
+    remap = np.full(len(exchange.categories) + 1, -1, dtype=np.int32)
+
+    remap[exchange.categories.get_indexer(kept)] = np.arange(len(kept), dtype=np.int32)
+
+    codes = remap[exchange.codes]
+
+    keep = codes >= 0
+
+    data["trades"] = {
+        "exchange": pd.Categorical.from_codes(codes[keep], categories=kept),
+        **{column: values[keep] for column, values in trades.items() if column != "exchange"},
+    }
+
+    if "flags" in data:
+
+        data["flags"] = data["flags"][keep]
+
+    return data
+
+
+CACHE_COLUMNS = {"time": np.int64, "price": np.float64, "size": np.float64, "exchange": np.int32, "flags": np.uint8}
+
+
+def _cache_entry(cache_path: str, file: str) -> str:
+
+    return os.path.join(cache_path, os.path.splitext(file)[0])
+
+
+def write_cache(entry: str, data: dict, source: os.stat_result, instrument_field: str = None):
+    """
+    Writes streamed trade data (as returned by read_json_stream) to a cache
+    entry: one .npy file per column plus meta.json holding the exchange (and
+    instrument) lookup, the other top level keys and the size/mtime of the
+    source file. The entry is built in a temporary directory next to it and
+    renamed into place, so pool workers writing the same date never see (or
+    read) a half written entry. If another worker's valid entry is already in
+    place it is kept.
+
+    Parameters
+    ----------
+    entry : str
+        directory of the cache entry, replaced if it exists and is stale.
+    data : dict
+        trade data as returned by read_json_stream.
+    source : os.stat_result
+        stat of the source json, used to invalidate the entry.
+    instrument_field : str, optional
+        name of the instrument column, if the data has one. The default is None.
+
+    Returns
+    -------
+    None.
+
+    """
+
+    parent, name = os.path.split(entry)
+
+    os.makedirs(parent, exist_ok=True)
+
+    tmp = tempfile.mkdtemp(prefix=f".{name}-", dir=parent)
+
+    trades = data["trades"]
+
+    columns = {
+        "time": trades["time"],
+        "price": trades["price"],
+        "size": trades["size"],
+        "exchange": trades["exchange"].codes,
+        "flags": data["flags"],
+    }
+
+    for column, dtype in CACHE_COLUMNS.items():
+
+        np.save(os.path.join(tmp, f"{column}.npy"), np.asarray(columns[column], dtype=dtype))
+
+    if instrument_field:
+
+        np.save(os.path.join(tmp, "instrument.npy"), np.asarray(trades[instrument_field].codes, dtype=np.int32))
+
+    meta = {
+        "source_size": source.st_size,
+        "source_mtime_ns": source.st_mtime_ns,
+        "exchanges": list(trades["exchange"].categories),
+        "instrument_field": instrument_field,
+        "instruments": list(trades[instrument_field].categories) if instrument_field else [],
+        "columns": list(CACHE_COLUMNS),
+        "top": {k: v for k, v in data.items() if k not in ["trades", "flags", "rejected"]},
+        "rejected": data["rejected"],
+    }
+
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+
+        json.dump(meta, f)
+
+    try:
+
+        os.replace(tmp, entry)
+
+        return
+
+    except OSError:
+
+        # an entry is already there, kept if another worker just wrote it.
+        if read_cache(entry, source, instrument_field) is not None:
+
+            shutil.rmtree(tmp, ignore_errors=True)
+
+            return
+
+    # a stale entry is moved aside (readers keep their open files) and the
+    # new one renamed in, if that loses a race the winner's entry is kept.
+    stale = tempfile.mkdtemp(prefix=f".{name}-stale-", dir=parent)
+
+    try:
+
+        os.replace(entry, os.path.join(stale, name))
+
+        os.replace(tmp, entry)
+
+    except OSError:
+
+        pass
+
+    shutil.rmtree(stale, ignore_errors=True)
+
+    shutil.rmtree(tmp, ignore_errors=True)
+
+
+def read_cache(entry: str, source: os.stat_result = None, instrument_field: str = None) -> dict:
+    """
+    Reads a cache entry with the columns memory-mapped. Returns none if the
+    entry does not exist, if it was written with other columns or a different
+    instrument column (or one when none is asked for) or, when 'source' is
+    given, if the source file has changed size or mtime since the entry was
+    written.
+
+    Parameters
+    ----------
+    entry : str
+        directory of the cache entry.
+    source : os.stat_result, optional
+        stat of the source json. The default is None, no invalidation check.
+    instrument_field : str, optional
+        instrument column needed. The default is None.
+
+    Returns
+    -------
+    dict
+        same layout as read_json_stream.
+
+    """
+
+    try:
+
+        with open(os.path.join(entry, "meta.json")) as f:
+
+            meta = json.load(f)
+
+    except FileNotFoundError:
+
+        return None
+
+    if source is not None and (
+        meta["source_size"] != source.st_size
+        or meta["source_mtime_ns"] != source.st_mtime_ns
+    ):
+
+        return None
+
+    if meta.get("columns") != list(CACHE_COLUMNS) or meta.get("instrument_field") != instrument_field:
+
+        return None
+
+    columns = {
+        column: np.load(os.path.join(entry, f"{column}.npy"), mmap_mode="r")
+        for column in CACHE_COLUMNS
+    }
+
+    data = dict(meta["top"])
+
+    data["trades"] = {
+        "exchange": pd.Categorical.from_codes(
+            columns["exchange"], categories=meta["exchanges"]
+        ),
+        "time": columns["time"],
+        "price": columns["price"],
+        "size": columns["size"],
+    }
+
+    if meta.get("instrument_field"):
+
+        data["trades"][meta["instrument_field"]] = pd.Categorical.from_codes(
+            np.load(os.path.join(entry, "instrument.npy"), mmap_mode="r"),
+            categories=meta["instruments"],
+        )
+
+    data["flags"] = columns["flags"]
+
+    data["rejected"] = meta["rejected"]
+
+    return data
+
+
+def read_json_cached(path: str, file: str, cache_path: str, chunk_size: int = 1 << 20, instrument_field: str = None, markets: list = None) -> dict:
+    """
+    Reads a trade file through the columnar cache: served memory-mapped from
+    'cache_path' if the cached copy is still valid, otherwise streamed from the
+    json and (re)written to the cache first. The cache holds every exchange,
+    markets are selected from it on read.
+
+    If file not found error returns none.
+
+    Parameters
+    ----------
+    path : str
+        directory path of file.
+    file : str
+        file name.
+    cache_path : str
+        directory holding the cache, one entry per file.
+    chunk_size : int, optional
+        characters read from the file at a time. The default is 1 << 20.
+    instrument_field : str, optional
+        see read_json_stream. The default is None.
+    markets : list, optional
+        exchanges to keep. The default is None, all exchanges.
+
+    Returns
+    -------
+    dict
+        same layout as read_json_stream.
+
+    """
+
+    try:
+
+        source = os.stat(f"{path}{file}")
+
+    except FileNotFoundError:
+
+        print(f"WARNING FILE NOT FOUND: {path}{file}")
+
+        return None
+
+    entry = _cache_entry(cache_path, file)
+
+    data = read_cache(entry, source, instrument_field)
+
+    if data is None:
+
+        data = read_json_stream(path, file, chunk_size, instrument_field)
+
+        write_cache(entry, data, source, instrument_field)
+
+    return filter_markets(data, markets)
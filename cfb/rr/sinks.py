@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Result sinks for the RR outputs. Rows are buffered in memory and flushed in
+batches, so writing a long backfill costs one append per batch rather than
+rewriting the output. CSV batches are appended to the file and an append cut
+short is undone (or trimmed back to its last complete row by the next run);
+parquet batches are written as part files of a dataset folder, each renamed
+into place once complete. Either way the output on disk is always complete
+rows, never a half written one.
+
+@author: theo
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+
+class ResultSink:
+    """
+    Buffers output frames for one output ({name}.csv or the {name}.parquet
+    dataset folder in 'path', read back with pd.read_parquet) and appends
+    them every 'batch_size' frames. CSV output is byte identical to calling
+    utilities.write_csv per frame.
+    """
+
+    def __init__(self, path: str, name: str, fmt: str = "csv", batch_size: int = 100):
+        """
+        Parameters
+        ----------
+        path : str
+            folder to write to.
+        name : str
+            file name without extension i.e. 'LTCUSD_RR'.
+        fmt : str, optional
+            'csv' or 'parquet' (needs pyarrow or fastparquet). The default is "csv".
+        batch_size : int, optional
+            number of frames buffered before a flush. The default is 100.
+
+        """
+
+        if fmt not in ["csv", "parquet"]:
+
+            raise ValueError(f"Unknown output format: {fmt}")
+
+        self.name = name
+
+        self.file = os.path.join(path, f"{name}.{fmt}")
+
+        self.fmt = fmt
+
+        self.batch_size = batch_size
+
+        self.buffer = []
+
+        self.checked = False
+
+    def __len__(self) -> int:
+        """number of writes not yet flushed."""
+
+        return len(self.buffer)
+
+    def write(self, data: pd.DataFrame):
+
+        self.buffer.append(data)
+
+        if len(self.buffer) >= self.batch_size:
+
+            self.flush()
+
+    def check(self):
+        """
+        Once per run, before the output is first touched: trims a CSV back to
+        its last complete row, in case a previous run was killed mid append.
+        """
+
+        if self.checked:
+
+            return
+
+        self.checked = True
+
+        if self.fmt != "csv" or not os.path.exists(self.file):
+
+            return
+
+        with open(self.file, "rb+") as f:
+
+            end = f.seek(0, os.SEEK_END)
+
+            size = end
+
+            while size > 0:
+
+                start = max(0, size - 65536)
+
+                f.seek(start)
+
+                block = f.read(size - start)
+
+                if block.rfind(b"\n") >= 0:
+
+                    size = start + block.rfind(b"\n") + 1
+
+                    break
+
+                size = start
+
+            if size < end:
+
+                print(f"WARNING INCOMPLETE LAST ROW REMOVED: {self.file}")
+
+                f.truncate(size)
+
+    def parts(self) -> list:
+        """part files of a parquet output, in the order they were written."""
+
+        if not os.path.isdir(self.file):
+
+            return []
+
+        return sorted(
+            os.path.join(self.file, f) for f in os.listdir(self.file) if f.startswith("part-") and f.endswith(".parquet")
+        )
+
+    def flush(self):
+
+        if len(self.buffer) == 0:
+
+            return
+
+        self.check()
+
+        if self.fmt == "csv":
+
+            with open(self.file, "a", newline="") as f:
+
+                size = f.tell()
+
+                text = "".join(
+                    data.to_csv(header=(i == 0 and size == 0), index=False) for i, data in enumerate(self.buffer)
+                )
+
+                try:
+
+                    f.write(text)
+
+                    f.flush()
+
+                    os.fsync(f.fileno())
+
+                except BaseException:
+
+                    f.truncate(size)
+
+                    raise
+
+        else:
+
+            os.makedirs(self.file, exist_ok=True)
+
+            parts = self.parts()
+
+            number = int(os.path.basename(parts[-1])[5:-8]) + 1 if parts else 0
+
+            part = os.path.join(self.file, f"part-{number:06d}.parquet")
+
+            # dot files are skipped when the folder is read as a dataset.
+            tmp = os.path.join(self.file, f".part-{number:06d}.parquet.tmp")
+
+            pd.concat(self.buffer, ignore_index=True).to_parquet(tmp, index=False)
+
+            os.replace(tmp, part)
+
+        self.buffer = []
+
+    def rows(self) -> int:
+        """number of rows already written to the output."""
+
+        self.flush()
+
+        self.check()
+
+        if self.fmt == "csv":
+
+            if not os.path.exists(self.file):
+
+                return 0
+
+            with open(self.file, "rb") as f:
+
+                # less the header.
+                return max(0, sum(1 for _ in f) - 1)
+
+        return sum(len(pd.read_parquet(part, columns=[])) for part in self.parts())
+
+    def truncate(self, rows: int):
+        """
+        Keeps only the first 'rows' rows written, i.e. those of the calc times
+        before the first one a resumed run recalculates, and removes the
+        rest. The CSV is cut in place, parquet parts after the cut are
+        removed (last first) and the part holding it rewritten atomically.
+        """
+
+        written = self.rows()
+
+        if written < rows:
+
+            print(f"WARNING {written} ROWS IN {self.file}, {rows} EXPECTED, NOT TRUNCATED")
+
+            return
+
+        if written == rows:
+
+            return
+
+        if self.fmt == "csv":
+
+            with open(self.file, "rb+") as f:
+
+                # the header & the rows kept.
+                for _ in range(rows + 1):
+
+                    f.readline()
+
+                f.truncate(f.tell())
+
+            return
+
+        kept = 0
+
+        parts = self.parts()
+
+        counts = [len(pd.read_parquet(part, columns=[])) for part in parts]
+
+        cut = 0
+
+        while kept + counts[cut] <= rows:
+
+            kept += counts[cut]
+
+            cut += 1
+
+        for part in reversed(parts[cut + 1 :]):
+
+            os.remove(part)
+
+        if kept == rows:
+
+            os.remove(parts[cut])
+
+            return
+
+        tmp = os.path.join(self.file, "." + os.path.basename(parts[cut]) + ".tmp")
+
+        pd.read_parquet(parts[cut]).iloc[: rows - kept].to_parquet(tmp, index=False)
+
+        os.replace(tmp, parts[cut])
+
+    def close(self):
+
+        self.flush()
+
+
+class ColumnSink(ResultSink):
+    """
+    ResultSink for outputs produced as columns (dicts of arrays) rather than
+    frames, i.e. the liquidity of each calc date. Each write only appends the
+    arrays to per column buffers, a single frame is built from them when the
+    batch is flushed.
+    """
+
+    def __init__(self, path: str, name: str, fmt: str = "csv", batch_size: int = 100):
+
+        super().__init__(path, name, fmt, batch_size)
+
+        self.columns = {}
+
+        self.writes = 0
+
+    def __len__(self) -> int:
+
+        return self.writes
+
+    def write(self, columns: dict):
+
+        for column, values in columns.items():
+
+            self.columns.setdefault(column, []).append(np.asarray(values))
+
+        self.writes += 1
+
+        if self.writes >= self.batch_size:
+
+            self.flush()
+
+    def flush(self):
+
+        if self.writes > 0:
+
+            self.buffer = [pd.DataFrame({column: np.concatenate(values) for column, values in self.columns.items()})]
+
+            self.columns = {}
+
+            self.writes = 0
+
+        super().flush()
@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Approximate weighted medians from mergeable quantile sketches, for streaming
+and very high volume partitions.
+
+A WeightedQuantileSketch is a volume histogram of prices on a fixed log grid
+(DDSketch style): bin k holds the volume of prices in (gamma^(k-1), gamma^k]
+with gamma = (1 + a) / (1 - a) for a relative accuracy a. Every price in a bin
+is within a of the bin's value, so the weighted median read from the sketch
+(the bin in which the cumulative volume reaches 50%) is within a relative
+error of a of the exact weighted median, whatever the number of trades.
+
+Because the grid is fixed, merging sketches is adding their bins: sketches
+of each exchange and partition can be merged into partition or window level
+medians without the trades, and the error bound holds for merged sketches
+exactly as for one built from all the trades. The only exception is an exact
+50% tie, where the exact rule averages two prices and the sketch returns the
+bin of the first.
+
+@author: theo
+"""
+
+import numpy as np
+
+
+# bins of a single sketch, past this the lowest bins are collapsed together
+# (only quantiles in the collapsed range lose accuracy).
+MAX_BINS = 2048
+
+# largest dense groups x exchanges x bins array grouped_sketch_median builds,
+# above this the occupied bins are found by sorting.
+MAX_DENSE = 1 << 22
+
+
+def gamma(relative_accuracy: float) -> float:
+
+    if not 0 < relative_accuracy < 1:
+
+        raise ValueError(f"relative_accuracy must be between 0 and 1: {relative_accuracy}")
+
+    return (1 + relative_accuracy) / (1 - relative_accuracy)
+
+
+def bin_keys(price: np.ndarray, relative_accuracy: float) -> np.ndarray:
+    """log grid bin of each (positive) price."""
+
+    return np.ceil(np.log(price) / np.log(gamma(relative_accuracy))).astype(np.int64)
+
+
+def bin_values(keys: np.ndarray, relative_accuracy: float) -> np.ndarray:
+    """value of each bin, within relative_accuracy of every price in it."""
+
+    g = gamma(relative_accuracy)
+
+    return 2 * np.power(g, np.asarray(keys, dtype=np.float64)) / (g + 1)
+
+
+def _first_reaching(cumulative: np.ndarray, totals: np.ndarray, q: float) -> np.ndarray:
+    """position of the first bin whose cumulative share reaches q, per row."""
+
+    return np.argmax(cumulative >= (totals * q)[..., None], axis=-1)
+
+
+class WeightedQuantileSketch:
+    """
+    Volume weighted quantile sketch of a stream of trades:
+
+        sketch = WeightedQuantileSketch(0.001)
+
+        sketch.add(prices, sizes)
+
+        sketch.merge(other_sketch)
+
+        sketch.median()
+
+    Memory is at most max_bins bins whatever the number of trades, a bin per
+    2a relative price range traded.
+    """
+
+    __slots__ = ("relative_accuracy", "max_bins", "keys", "weights", "zero")
+
+    def __init__(self, relative_accuracy: float = 0.001, max_bins: int = MAX_BINS):
+        """
+        Parameters
+        ----------
+        relative_accuracy : float, optional
+            relative error bound of the quantiles, i.e. 0.001 = 0.1%.
+            The default is 0.001.
+        max_bins : int, optional
+            most bins kept, see MAX_BINS. The default is MAX_BINS.
+
+        """
+
+        gamma(relative_accuracy)
+
+        self.relative_accuracy = relative_accuracy
+
+        self.max_bins = max_bins
+
+        self.keys = np.empty(0, dtype=np.int64)
+
+        self.weights = np.empty(0, dtype=np.float64)
+
+        # volume traded at a price of 0, below every bin.
+        self.zero = 0.0
+
+    @property
+    def total(self) -> float:
+
+        return self.zero + self.weights.sum()
+
+    @property
+    def nbytes(self) -> int:
+
+        return self.keys.nbytes + self.weights.nbytes
+
+    def __len__(self) -> int:
+
+        return len(self.keys)
+
+    def add(self, price: np.ndarray, size: np.ndarray) -> "WeightedQuantileSketch":
+        """adds trades (arrays or scalars of price & size), returns the sketch."""
+
+        price = np.atleast_1d(np.asarray(price, dtype=np.float64))
+
+        size = np.atleast_1d(np.asarray(size, dtype=np.float64))
+
+        positive = price > 0
+
+        self.zero += size[~positive].sum()
+
+        self._accumulate(bin_keys(price[positive], self.relative_accuracy), size[positive])
+
+        return self
+
+    def merge(self, other: "WeightedQuantileSketch") -> "WeightedQuantileSketch":
+        """adds the bins of other (same relative accuracy), returns the sketch."""
+
+        if other.relative_accuracy != self.relative_accuracy:
+
+            raise ValueError("only sketches with the same relative accuracy can be merged")
+
+        self.zero += other.zero
+
+        self._accumulate(other.keys, other.weights)
+
+        return self
+
+    @classmethod
+    def merged(cls, sketches: list, relative_accuracy: float = 0.001) -> "WeightedQuantileSketch":
+        """new sketch of all of 'sketches'."""
+
+        sketch = cls(relative_accuracy)
+
+        for s in sketches:
+
+            sketch.merge(s)
+
+        return sketch
+
+    def _accumulate(self, keys: np.ndarray, weights: np.ndarray):
+
+        if len(keys) == 0:
+
+            return
+
+        keys = np.concatenate([self.keys, keys])
+
+        weights = np.concatenate([self.weights, weights])
+
+        lo, hi = keys.min(), keys.max()
+
+        if hi - lo < 4 * self.max_bins:
+
+            # bins are close together, counted without sorting.
+            counts = np.bincount(keys - lo, weights, minlength=hi - lo + 1)
+
+            occupied = np.flatnonzero(counts)
+
+            self.keys, self.weights = occupied + lo, counts[occupied]
+
+        else:
+
+            self.keys, inverse = np.unique(keys, return_inverse=True)
+
+            self.weights = np.bincount(inverse, weights, minlength=len(self.keys))
+
+        if len(self.keys) > self.max_bins:
+
+            cut = len(self.keys) - self.max_bins
+
+            self.weights[cut] += self.weights[:cut].sum()
+
+            self.keys, self.weights = self.keys[cut:], self.weights[cut:]
+
+    def quantile(self, q: float) -> float:
+        """
+        price at which the cumulative volume share first reaches q, nan if the
+        sketch has no volume.
+        """
+
+        total = self.total
+
+        if not total > 0:
+
+            return np.nan
+
+        if self.zero >= q * total:
+
+            return 0.0
+
+        index = _first_reaching(self.zero + np.cumsum(self.weights), np.float64(total), q)
+
+        return float(bin_values(self.keys[index], self.relative_accuracy))
+
+    def median(self) -> float:
+
+        return self.quantile(0.5)
+
+    def weight_of(self, price: float) -> float:
+        """volume in the bin of 'price'."""
+
+        if not price > 0:
+
+            return self.zero
+
+        key = bin_keys(np.array([price]), self.relative_accuracy)[0]
+
+        i = np.searchsorted(self.keys, key)
+
+        return float(self.weights[i]) if i < len(self.keys) and self.keys[i] == key else 0.0
+
+
+def grouped_sketch_median(
+    price: np.ndarray,
+    size: np.ndarray,
+    groups: np.ndarray,
+    exchanges: np.ndarray,
+    relative_accuracy: float,
+    ped: float = None,
+) -> [np.ndarray, np.ndarray, np.ndarray, list]:
+    """
+    Approximate version of kernels.grouped_weighted_median (and, with ped,
+    kernels.grouped_ped_weighted_median). A sketch is built for every group &
+    exchange in one pass and merged into the group's median, the winner is
+    the exchange with the most volume in the median's bin.
+
+    Parameters
+    ----------
+    price : np.ndarray
+        trade prices.
+    size : np.ndarray
+        trade sizes.
+    groups : np.ndarray
+        integer group id of each trade i.e. bucket number.
+    exchanges : np.ndarray
+        integer exchange code of each trade.
+    relative_accuracy : float
+        relative error bound of the medians, see WeightedQuantileSketch.
+    ped : float, optional
+        If given exchanges whose median is more than ped % from the median of
+        the group's exchange medians are left out of the group's median, if
+        more than one is flagged. The default is None.
+
+    Returns
+    -------
+    keys : np.ndarray
+        unique group ids in ascending order.
+    medians : np.ndarray
+        approximate weighted median price of each group, nan if the group has
+        no volume.
+    winners : np.ndarray
+        exchange code with the most volume in each median's bin, -1 if none.
+    removed : list
+        exchange codes removed by the PED check from each group.
+
+    """
+
+    price = np.asarray(price, dtype=np.float64)
+
+    size = np.asarray(size, dtype=np.float64)
+
+    keys, group_index = np.unique(np.asarray(groups), return_inverse=True)
+
+    codes, exchange_index = np.unique(np.asarray(exchanges), return_inverse=True)
+
+    if len(keys) == 0:
+
+        return keys, np.empty(0), codes[:0], []
+
+    positive = price > 0
+
+    bins = np.zeros(len(price), dtype=np.int64)
+
+    bins[positive] = bin_keys(price[positive], relative_accuracy)
+
+    lo, hi = (bins[positive].min(), bins[positive].max()) if positive.any() else (0, 0)
+
+    # position 0 holds prices of 0, the others are the bins from lo to hi, or
+    # only the occupied ones if that range is too wide to hold densely.
+    if len(keys) * len(codes) * (hi - lo + 2) <= MAX_DENSE:
+
+        bin_index = np.where(positive, bins - lo + 1, 0)
+
+        grid = np.arange(lo - 1, hi + 1)
+
+    else:
+
+        grid, bin_index = np.unique(np.where(positive, bins - lo + 1, 0), return_inverse=True)
+
+        grid = grid + lo - 1
+
+    values = bin_values(grid, relative_accuracy)
+
+    values[0] = 0
+
+    # volume of every group x exchange x bin, merging sketches is summing it.
+    shape = (len(keys), len(codes), len(grid))
+
+    volume = np.bincount(
+        np.ravel_multi_index((group_index, exchange_index, bin_index), shape),
+        size,
+        minlength=int(np.prod(shape)),
+    ).reshape(shape)
+
+    removed = [codes[:0]] * len(keys)
+
+    if ped is not None:
+
+        exchange_totals = volume.sum(axis=2)
+
+        exchange_medians = values[_first_reaching(np.cumsum(volume, axis=2), exchange_totals, 0.5)]
+
+        traded = exchange_totals > 0
+
+        for i in range(len(keys)):
+
+            median = np.median(exchange_medians[i][traded[i]])
+
+            flagged = traded[i] & (np.abs(exchange_medians[i] / median - 1) > ped / 100)
+
+            if flagged.sum() > 1:
+
+                volume[i, flagged] = 0
+
+                removed[i] = codes[flagged]
+
+    group_volume = volume.sum(axis=1)
+
+    totals = group_volume.sum(axis=1)
+
+    median_bins = _first_reaching(np.cumsum(group_volume, axis=1), totals, 0.5)
+
+    medians = np.where(totals > 0, values[median_bins], np.nan)
+
+    in_bin = volume[np.arange(len(keys)), :, median_bins]
+
+    winners = np.where(in_bin.max(axis=1) > 0, codes[np.argmax(in_bin, axis=1)], -1)
+
+    return keys, medians, winners, removed
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Remote sources for the daily trade files, used when read_input_locally is
+False. A source only has to download one file (key) to a local path, the
+Prefetcher then downloads the next few dates on background threads into a
+bounded local folder while the current date calculates.
+
+@author: theo
+"""
+
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+
+class LocalSource:
+    """
+    Folder standing in for a bucket, files are copied out of it. Used to test
+    the remote path without network access.
+    """
+
+    def __init__(self, root: str, prefix: str = ""):
+
+        self.root = root
+
+        self.prefix = prefix
+
+    def download(self, key: str, dest: str):
+
+        shutil.copyfile(os.path.join(self.root, self.prefix + key), dest)
+
+
+class S3Source:
+    """
+    S3 or any S3 compatible store (via endpoint_url). boto3 is only imported
+    when this source is used.
+    """
+
+    def __init__(self, bucket: str, prefix: str = "", endpoint_url: str = None):
+
+        import boto3
+
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+
+        self.bucket = bucket
+
+        self.prefix = prefix
+
+    def download(self, key: str, dest: str):
+
+        self.client.download_file(self.bucket, self.prefix + key, dest)
+
+
+class AzureBlobSource:
+    """
+    Azure blob container read with a sas key, url + file + key as in
+    modules/azure.py download_blob_csv.
+    """
+
+    def __init__(self, url: str, key: str, prefix: str = ""):
+
+        self.url = url
+
+        self.key = key
+
+        self.prefix = prefix
+
+    def download(self, key: str, dest: str):
+
+        import requests
+
+        r = requests.get(self.url + self.prefix + key + self.key, stream=True)
+
+        r.raise_for_status()
+
+        with open(dest, "wb") as f:
+
+            for chunk in r.iter_content(1 << 20):
+
+                f.write(chunk)
+
+
+def make_source(config: dict):
+    """
+    Builds a source from the 'source' section of config.yml.
+
+    Parameters
+    ----------
+    config : dict
+        must have 'type': 's3', 'azure' or 'local', other keys are passed on.
+
+    Returns
+    -------
+    source with a download(key, dest) method.
+
+    """
+
+    config = dict(config)
+
+    source_type = config.pop("type")
+
+    for key in ["prefetch", "threads", "download_path"]:
+
+        config.pop(key, None)
+
+    if source_type == "s3":
+
+        return S3Source(**config)
+
+    elif source_type == "azure":
+
+        return AzureBlobSource(**config)
+
+    elif source_type == "local":
+
+        return LocalSource(**config)
+
+    raise ValueError(f"Unknown source type: {source_type}")
+
+
+class Prefetcher:
+    """
+    Downloads files from a source into 'path' on background threads. Files
+    are fetched ahead with prefetch() and removed with release() once they
+    are no longer needed, so the folder only holds the files in use plus
+    those being prefetched.
+    """
+
+    def __init__(self, source, path: str, threads: int = 2):
+
+        self.source = source
+
+        self.path = path
+
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+
+        self.downloads = {}
+
+        os.makedirs(path, exist_ok=True)
+
+    def _download(self, key: str):
+
+        dest = os.path.join(self.path, key)
+
+        try:
+
+            self.source.download(key, dest + ".part")
+
+        except Exception as e:
+
+            print(f"WARNING DOWNLOAD FAILED: {key} {e}")
+
+            return
+
+        os.replace(dest + ".part", dest)
+
+    def prefetch(self, keys: list):
+        """starts downloading any of 'keys' not already downloaded/downloading."""
+
+        for key in keys:
+
+            if key not in self.downloads:
+
+                self.downloads[key] = self.pool.submit(self._download, key)
+
+    def fetch(self, key: str):
+        """waits for 'key' to be downloaded, starting it if need be."""
+
+        self.prefetch([key])
+
+        self.downloads[key].result()
+
+    def release(self, key: str):
+        """deletes the local copy of 'key'."""
+
+        download = self.downloads.pop(key, None)
+
+        if download is not None:
+
+            download.result()
+
+        for file in [key, key + ".part"]:
+
+            try:
+
+                os.remove(os.path.join(self.path, file))
+
+            except FileNotFoundError:
+
+                pass
+
+    def close(self):
+
+        for key in list(self.downloads):
+
+            self.release(key)
+
+        self.pool.shutdown()
@@ -0,0 +1,522 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Online version of the _RR calculation. Trades are fed in as they arrive (one
+at a time or in micro batches) and the RR is emitted for each calc time as
+soon as its window has closed, with the same PED check and bucket VWM rules
+as main.calc_date / utilities.calc. With a relative_accuracy only a quantile
+sketch of each partition & exchange is kept rather than its trades, so
+memory per partition is bounded whatever the volume (see sketch.py).
+
+Replaying a daily trade file:
+
+    rr_stream = RRStream(window=60, partition=5, ped=10, step=5)
+
+    for trade in utilities.read_json(path, file)["trades"]:
+
+        for rr, weighted_medians in rr_stream.add_trade(trade):
+
+            ...
+
+@author: theo
+"""
+
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import kernels
+import sketch
+import utilities
+
+
+class RRStream:
+    """
+    Keeps the trades of every partition still needed by an open window and
+    emits the RR of calc time T once the watermark (latest trade time seen,
+    less the allowed lateness) reaches T. Trades arriving out of order are
+    used as long as they are no older than the start of the oldest open
+    window, older ones are counted in 'late_trades' and dropped.
+
+    Calc times are every 'step' minutes since the epoch (or from 'start'),
+    window and step must be whole numbers of partitions so that every window
+    shares the same partition grid and bucket VWMs can be reused between
+    windows.
+    """
+
+    def __init__(
+        self,
+        window: int = 60,
+        partition: int = 5,
+        ped: float = 10,
+        step: int = 60,
+        lateness: float = 0,
+        first_last: bool = False,
+        start: datetime = None,
+        on_rr=None,
+        name: str = "LTCUSD_RR",
+        relative_accuracy: float = None,
+    ):
+        """
+        Parameters
+        ----------
+        window : int, optional
+            Length of window in minutes. The default is 60.
+        partition : int, optional
+            Partition length in minutes. The default is 5.
+        ped : float, optional
+            The PED parameter as a %. The default is 10.
+        step : int, optional
+            Minutes between calc times. The default is 60.
+        lateness : float, optional
+            Seconds a trade may arrive after trades later than it, windows are
+            held open this long after they end. The default is 0.
+        first_last : bool, optional
+            If true the first and last trade of each partition are included in
+            the output. The default is False.
+        start : datetime, optional
+            First calc time, a whole number of partitions since the epoch. The
+            default is None, the first calc time after the first trade.
+        on_rr : callable, optional
+            called with (rr, weighted_medians) for every calc time emitted.
+            The default is None.
+        name : str, optional
+            column name of the RR value. The default is "LTCUSD_RR".
+        relative_accuracy : float, optional
+            If given partitions are kept as a sketch per exchange and the
+            partition VWMs and PED exchange medians are approximate, within
+            this relative error (i.e. 0.001 = 0.1%). The default is None,
+            exact.
+
+        """
+
+        if window % partition != 0 or step % partition != 0:
+
+            raise ValueError("window and step must be multiples of the partition length")
+
+        self.window = window * 60 * 1000
+
+        self.partition = partition * 60 * 1000
+
+        self.ped = ped
+
+        self.step = step * 60 * 1000
+
+        self.lateness = lateness * 1000
+
+        self.first_last = first_last
+
+        self.on_rr = on_rr
+
+        self.name = name
+
+        self.relative_accuracy = relative_accuracy
+
+        self.next_calc = None if start is None else int(datetime.timestamp(start) * 1000)
+
+        # windows are cut from partitions on the epoch grid.
+        if self.next_calc is not None and self.next_calc % self.partition != 0:
+
+            raise ValueError(f"start must be on the partition grid (a whole number of {partition} minutes since the epoch): {start}")
+
+        self.watermark = None
+
+        self.exchanges = {}
+
+        self.exchange_names = []
+
+        # partition start -> [times, prices, sizes, exchange codes, arrival], or
+        # with a relative_accuracy partition start -> {exchange code: [sketch,
+        # trades, first trade, last trade]} with trades as (time, arrival,
+        # price, size).
+        self.buckets = {}
+
+        # partition start -> (PED removed exchanges, number of trades, vwm, exchange)
+        self.vwms = {}
+
+        self.arrivals = 0
+
+        self.late_trades = 0
+
+        self.rejected_trades = 0
+
+    def _open_from(self) -> float:
+        """start of the oldest window not yet emitted."""
+
+        return -np.inf if self.next_calc is None else self.next_calc - self.window
+
+    def add_trade(self, trade: dict) -> list:
+        """
+        Adds a single trade (a dict as in the trade jsons) and emits any calc
+        times it closes.
+
+        Returns
+        -------
+        list
+            (rr, weighted_medians) for every calc time emitted.
+
+        """
+
+        try:
+
+            time = int(trade["time"])
+
+            price = trade["price"]
+
+            size = trade["size"]
+
+            exchange = trade["exchange"]
+
+        except (KeyError, TypeError, ValueError):
+
+            self.rejected_trades += 1
+
+            return []
+
+        if not isinstance(price, (float, int)) or not isinstance(size, (float, int)) or price < 0 or size < 0:
+
+            self.rejected_trades += 1
+
+            return []
+
+        self._append(np.array([time]), np.array([price], dtype=np.float64), np.array([size], dtype=np.float64), [exchange])
+
+        return self.advance(time - self.lateness)
+
+    def add_trades(self, trades) -> list:
+        """
+        Adds a micro batch of trades, list of dicts or columns, and emits any
+        calc times it closes. Erroneous trades are dropped.
+
+        Returns
+        -------
+        list
+            (rr, weighted_medians) for every calc time emitted.
+
+        """
+
+        trades = pd.DataFrame(trades)
+
+        if len(trades) == 0:
+
+            return []
+
+        flags, summary = utilities.validate_trades(trades)
+
+        erroneous = flags.any(axis=1).to_numpy()
+
+        self.rejected_trades += int(erroneous.sum())
+
+        trades = trades[~erroneous]
+
+        if len(trades) == 0:
+
+            return []
+
+        times = trades["time"].to_numpy().astype(np.int64)
+
+        self._append(
+            times,
+            trades["price"].to_numpy(dtype=np.float64),
+            trades["size"].to_numpy(dtype=np.float64),
+            trades["exchange"].to_numpy(),
+        )
+
+        return self.advance(times.max() - self.lateness)
+
+    def _append(self, times, prices, sizes, exchanges):
+
+        late = times < self._open_from()
+
+        if late.any():
+
+            self.late_trades += int(late.sum())
+
+            times, prices, sizes = times[~late], prices[~late], sizes[~late]
+
+            exchanges = [e for e, l in zip(exchanges, late) if not l]
+
+        codes = np.array(
+            [self.exchanges.setdefault(e, len(self.exchanges)) for e in exchanges],
+            dtype=np.int64,
+        )
+
+        self.exchange_names = list(self.exchanges)
+
+        arrival = np.arange(self.arrivals, self.arrivals + len(times))
+
+        self.arrivals += len(times)
+
+        starts = times - times % self.partition
+
+        for bs in np.unique(starts):
+
+            b = starts == bs
+
+            if self.relative_accuracy is not None:
+
+                self._add_to_sketches(self.buckets.setdefault(int(bs), {}), times[b], prices[b], sizes[b], codes[b], arrival[b])
+
+                continue
+
+            bucket = self.buckets.setdefault(int(bs), [[], [], [], [], []])
+
+            for column, values in zip(bucket, [times[b], prices[b], sizes[b], codes[b], arrival[b]]):
+
+                column.extend(values.tolist())
+
+        if self.next_calc is None and len(times) > 0:
+
+            first = int(times.min())
+
+            self.next_calc = first - first % self.step + self.step
+
+    def _add_to_sketches(self, bucket: dict, times, prices, sizes, codes, arrival):
+
+        for code in np.unique(codes):
+
+            c = codes == code
+
+            entry = bucket.setdefault(int(code), [sketch.WeightedQuantileSketch(self.relative_accuracy), 0, None, None])
+
+            entry[0].add(prices[c], sizes[c])
+
+            entry[1] += int(c.sum())
+
+            order = np.lexsort((arrival[c], times[c]))
+
+            first, last = order[0], order[-1]
+
+            for i, row, earlier in [(2, first, True), (3, last, False)]:
+
+                trade = (int(times[c][row]), int(arrival[c][row]), float(prices[c][row]), float(sizes[c][row]))
+
+                if entry[i] is None or (trade[:2] < entry[i][:2]) == earlier:
+
+                    entry[i] = trade
+
+    def advance(self, watermark: float) -> list:
+        """
+        Moves the watermark forward (i.e. to the wall clock time less the
+        lateness, or the end of a replayed file) and emits every calc time
+        at or before it.
+
+        Parameters
+        ----------
+        watermark : float
+            time in ms up to which the feed is considered complete.
+
+        Returns
+        -------
+        list
+            (rr, weighted_medians) for every calc time emitted.
+
+        """
+
+        if self.watermark is None or watermark > self.watermark:
+
+            self.watermark = watermark
+
+        emitted = []
+
+        while self.next_calc is not None and self.next_calc <= self.watermark:
+
+            result = self._emit(self.next_calc)
+
+            self.next_calc += self.step
+
+            # partitions before the next window are no longer needed.
+            for bs in [bs for bs in self.buckets if bs < self._open_from()]:
+
+                del self.buckets[bs]
+
+                self.vwms.pop(bs, None)
+
+            if result is None:
+
+                continue
+
+            if self.on_rr is not None:
+
+                self.on_rr(*result)
+
+            emitted.append(result)
+
+        return emitted
+
+    def _emit(self, calc_time: int):
+
+        start = calc_time - self.window
+
+        bucket_starts = [bs for bs in sorted(self.buckets) if start <= bs < calc_time]
+
+        if len(bucket_starts) == 0:
+
+            return None
+
+        if self.relative_accuracy is not None:
+
+            return self._emit_sketches(calc_time, bucket_starts)
+
+        columns = [np.concatenate([np.asarray(self.buckets[bs][i]) for bs in bucket_starts]) for i in range(5)]
+
+        times, prices, sizes, codes, arrival = columns
+
+        # PED check over the whole window, as utilities.potentially_errorneous_check.
+        keys, medians, _ = kernels.grouped_weighted_median(prices, sizes, codes)
+
+        median_wm_e = np.median(medians)
+
+        ped_exchanges = [
+            self.exchange_names[k] for k, m in zip(keys, medians) if abs(m / median_wm_e - 1) > self.ped / 100
+        ]
+
+        # same rule as main.calc_date for removing exchanges.
+        removed = tuple(sorted(ped_exchanges)) if len(ped_exchanges) > 1 else ()
+
+        keep = ~np.isin(codes, [self.exchanges[e] for e in removed])
+
+        times, prices, sizes, codes, arrival = [c[keep] for c in (times, prices, sizes, codes, arrival)]
+
+        order = np.lexsort((arrival, times))
+
+        times, prices, sizes, codes = times[order], prices[order], sizes[order], codes[order]
+
+        bucket_ids = (times - start) // self.partition
+
+        present, firsts, lasts = kernels.group_bounds(bucket_ids)
+
+        lasts = lasts - 1
+
+        # reuse partition VWMs unless the removed exchanges or the trades in
+        # the partition (late arrivals) have changed.
+        state = {b: (removed, len(self.buckets[start + b * self.partition][0])) for b in present}
+
+        missing = [b for b in present if self.vwms.get(start + b * self.partition, (None,))[:2] != state[b]]
+
+        if len(missing) > 0:
+
+            new = np.isin(bucket_ids, missing)
+
+            calced, vwms, winners = kernels.grouped_weighted_median(prices[new], sizes[new], bucket_ids[new], codes[new])
+
+            for b, vwm, winner in zip(calced, vwms, winners):
+
+                self.vwms[start + b * self.partition] = state[b] + (vwm, self.exchange_names[winner])
+
+        weighted_medians = np.array([self.vwms[start + b * self.partition][2] for b in present], dtype=np.float64)
+
+        output = pd.DataFrame(
+            {
+                "ExecTime": [datetime.fromtimestamp((start + b * self.partition) / 1000) for b in present],
+                "VWM_Price": weighted_medians,
+                "VWM_Exchange": [self.vwms[start + b * self.partition][3] for b in present],
+            }
+        )
+
+        if self.first_last == True:
+
+            for name, rows in [("first", firsts), ("last", lasts)]:
+
+                output[f"{name}_trade_exchange"] = [self.exchange_names[c] for c in codes[rows]]
+
+                output[f"{name}_trade_prtice"] = prices[rows]
+
+                output[f"{name}_trade_size"] = sizes[rows]
+
+                output[f"{name}_trade_datetime"] = pd.to_datetime(times[rows], unit="ms", utc=True).tz_convert("GMT")
+
+        rr = pd.DataFrame(
+            {
+                "time": [calc_time],
+                "Date": [utilities.ts_to_dt(calc_time / 1000)],
+                self.name: [np.mean(weighted_medians).round(4)],
+            }
+        )
+
+        return rr, output
+
+    def _emit_sketches(self, calc_time: int, bucket_starts: list):
+        """_emit from the partition sketches, merged without the trades."""
+
+        buckets = [self.buckets[bs] for bs in bucket_starts]
+
+        codes = sorted({code for bucket in buckets for code in bucket})
+
+        # PED check on window medians of each exchange, merged over partitions.
+        medians = np.array(
+            [
+                sketch.WeightedQuantileSketch.merged(
+                    [bucket[code][0] for bucket in buckets if code in bucket], self.relative_accuracy
+                ).median()
+                for code in codes
+            ]
+        )
+
+        median_wm_e = np.median(medians)
+
+        ped_exchanges = [
+            self.exchange_names[k] for k, m in zip(codes, medians) if abs(m / median_wm_e - 1) > self.ped / 100
+        ]
+
+        removed = tuple(sorted(ped_exchanges)) if len(ped_exchanges) > 1 else ()
+
+        removed_codes = [self.exchanges[e] for e in removed]
+
+        rows = []
+
+        for bs, bucket in zip(bucket_starts, buckets):
+
+            kept = {code: entry for code, entry in bucket.items() if code not in removed_codes}
+
+            if len(kept) == 0:
+
+                continue
+
+            state = (removed, sum(entry[1] for entry in bucket.values()))
+
+            if self.vwms.get(bs, (None,))[:2] != state:
+
+                vwm = sketch.WeightedQuantileSketch.merged([entry[0] for entry in kept.values()], self.relative_accuracy).median()
+
+                # the exchange with the most volume around the median.
+                winner = max(kept, key=lambda code: kept[code][0].weight_of(vwm))
+
+                self.vwms[bs] = state + (vwm, self.exchange_names[winner])
+
+            first = min(kept, key=lambda code: kept[code][2][:2])
+
+            last = max(kept, key=lambda code: kept[code][3][:2])
+
+            rows.append((bs, first, kept[first][2], last, kept[last][3]))
+
+        weighted_medians = np.array([self.vwms[row[0]][2] for row in rows], dtype=np.float64)
+
+        output = pd.DataFrame(
+            {
+                "ExecTime": [datetime.fromtimestamp(row[0] / 1000) for row in rows],
+                "VWM_Price": weighted_medians,
+                "VWM_Exchange": [self.vwms[row[0]][3] for row in rows],
+            }
+        )
+
+        if self.first_last == True:
+
+            for name, code, trade in [("first", 1, 2), ("last", 3, 4)]:
+
+                output[f"{name}_trade_exchange"] = [self.exchange_names[row[code]] for row in rows]
+
+                output[f"{name}_trade_prtice"] = [row[trade][2] for row in rows]
+
+                output[f"{name}_trade_size"] = [row[trade][3] for row in rows]
+
+                output[f"{name}_trade_datetime"] = pd.to_datetime([row[trade][0] for row in rows], unit="ms", utc=True).tz_convert("GMT")
+
+        rr = pd.DataFrame(
+            {
+                "time": [calc_time],
+                "Date": [utilities.ts_to_dt(calc_time / 1000)],
+                self.name: [np.mean(weighted_medians).round(4)],
+            }
+        )
+
+        return rr, output
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parameter sweeps of the RR. Every combination of window length, partition
+length and PED parameter is calculated for each calc time from a single load
+of its trade file (loaded, checked and time indexed once, see main.load_day),
+so a sweep costs about one run's loading plus a window cut and grouped VWM
+pass per combination. The exchange VWMs the PED check compares are found
+once per window and reused for every PED parameter. Results are saved as one table with a row
+per calc time & parameter set:
+
+    time, Date, window, partition, ped, {name}
+
+@author: theo
+"""
+
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+import pandas as pd
+from pytz import timezone
+import utilities
+import metrics
+import sinks
+import main
+
+
+def sweep_date(date: datetime, read_path: str, windows: list, partitions: list, peds: list, drop_erroneous: bool = False, stream: bool = False, cache_path: str = None, name: str = "LTCUSD_RR", markets: list = None, ped_mode: str = "window", out_of_core: bool = False, memory_budget_mb: float = 256, spill_path: str = None, relative_accuracy: float = None):
+    """
+    RR of every parameter combination for a single calc time.
+
+    Parameters
+    ----------
+    date : datetime
+        calc time.
+    read_path : str
+        path to read the (local) input data from.
+    windows : list
+        window lengths in minutes.
+    partitions : list
+        partition lengths in minutes.
+    peds : list
+        PED parameters as a %.
+    drop_erroneous, stream, cache_path, name, markets, ped_mode, out_of_core, memory_budget_mb, spill_path, relative_accuracy
+        see main.calc_date.
+
+    Returns
+    -------
+    rr : pd.DataFrame
+        RR of each combination (a row each) with the window, partition & ped
+        it was calculated with.
+    records : list
+        wall time & rows of each stage, see metrics.StageMetrics.
+    None is returned instead if there is no input data for the date.
+
+    """
+
+    print(f"Starting: {date}")
+
+    stages = metrics.StageMetrics(date)
+
+    parts = main.load_day(date, read_path, True, drop_erroneous, stream, cache_path, name, None, None, markets, stages, out_of_core, memory_budget_mb, spill_path)
+
+    if parts is None:
+
+        return None
+
+    rows = []
+
+    for window in windows:
+
+        medians = None
+
+        # the exchange VWMs of a window are the same for every ped, only the
+        # threshold applied to them changes.
+        if ped_mode == "window":
+
+            with stages.stage("ped") as record:
+
+                df = utilities.filter_window(parts[name], date, window)
+
+                medians = utilities.exchange_medians(df)
+
+                record["rows"] = len(df)
+
+        for ped, partition in itertools.product(peds, partitions):
+
+            rr = main.calc_trades(parts[name], date, name, window, partition, ped, False, stages, ped_mode=ped_mode, relative_accuracy=relative_accuracy, exchange_medians=medians)[0]
+
+            rows.append(rr.assign(window=window, partition=partition, ped=ped)[["time", "Date", "window", "partition", "ped", name]])
+
+    return pd.concat(rows, ignore_index=True), stages.records
+
+
+def run(read_path: str, save_path: str, start: datetime, end: datetime, freq: str, tz: str, close: int, windows: list, partitions: list, peds: list, markets: list, local: bool, drop_erroneous: bool = False, workers: int = 1, stream: bool = False, cache_path: str = None, step: int = 1, output_format: str = "csv", flush_every: int = 100, save_metrics: bool = True, name: str = "LTCUSD_RR", ped_mode: str = "window", out_of_core: bool = False, memory_budget_mb: float = 256, spill_path: str = None, relative_accuracy: float = None):
+    """
+    Sweeps the RR over every combination of windows x partitions x peds for
+    each calc time from start to end, saved as {name}_Sweep in save_path.
+    Partition VWMs are not saved.
+
+    Parameters
+    ----------
+    windows : list
+        window lengths in minutes, i.e. [30, 60, 120].
+    partitions : list
+        partition lengths in minutes, i.e. [1, 5, 15].
+    peds : list
+        PED parameters as a %, i.e. [5, 10, 20].
+    read_path, save_path, start, end, freq, tz, close, markets, local, drop_erroneous, workers, stream, cache_path, step, output_format, flush_every, save_metrics, name, ped_mode, out_of_core, memory_budget_mb, spill_path, relative_accuracy
+        see main.run, sweeps only read local inputs.
+
+    Returns
+    -------
+    None.
+
+    """
+
+    print(f"STARTING SWEEP \n START: {start} \n END: {end} \n FREQ: {freq} \n MARKETS: {markets} \n WINDOWS: {windows} \n K: {partitions} \n PEDS: {peds} \n SAVING: {save_path}")
+
+    if ped_mode not in ["window", "partition"]:
+
+        raise ValueError(f"Unknown ped_mode: {ped_mode}")
+
+    if local == False:
+
+        print("WARNING SWEEPS NEED LOCAL INPUTS, NOTHING CALCULATED")
+
+        return
+
+    tz = timezone(tz)
+
+    os.makedirs(save_path, exist_ok=True)
+
+    dates = utilities.create_list_dates(
+        tz.localize(start), tz.localize(end), freq, step
+    )
+
+    if freq == 'days':
+
+        dates = [i.replace(hour=close) for i in dates]
+
+    calc_one = partial(
+        sweep_date,
+        read_path=read_path,
+        windows=windows,
+        partitions=partitions,
+        peds=peds,
+        drop_erroneous=drop_erroneous,
+        stream=stream,
+        cache_path=cache_path,
+        name=name,
+        markets=markets,
+        ped_mode=ped_mode,
+        out_of_core=out_of_core,
+        memory_budget_mb=memory_budget_mb,
+        spill_path=spill_path,
+        relative_accuracy=relative_accuracy,
+    )
+
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    if pool is not None:
+
+        results = pool.map(
+            calc_one, dates, chunksize=max(1, len(dates) // (workers * 4))
+        )
+
+    else:
+
+        results = map(calc_one, dates)
+
+    sink = sinks.ResultSink(save_path, f"{name}_Sweep", output_format, flush_every)
+
+    records = []
+
+    metrics_file = open(os.path.join(save_path, "metrics.jsonl"), "a") if save_metrics else None
+
+    try:
+
+        for result in results:
+
+            if result is None:
+
+                continue
+
+            rr, stage_records = result
+
+            sink.write(rr)
+
+            records += stage_records
+
+            if metrics_file is not None:
+
+                metrics_file.write("".join(json.dumps(r) + "\n" for r in stage_records))
+
+    finally:
+
+        if metrics_file is not None:
+
+            metrics_file.close()
+
+            print(f"STAGE SUMMARY: \n{metrics.summarise(records).to_string()}")
+
+        sink.close()
+
+        if pool is not None:
+
+            pool.shutdown()
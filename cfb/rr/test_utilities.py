@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for utilities.calc and the loaders, sinks & streams around it, run
+with pytest from this folder.
+
+@author: theo
+"""
+
+from datetime import datetime, timedelta, timezone
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+import containers
+import kernels
+import main
+import metrics
+import sinks
+import sources
+import sweep
+import stream
+import utilities
+
+
+CALC_TIME = 1577894400
+
+
+def trades_with_flagged_partition() -> pd.DataFrame:
+    """
+    Two 5 minute partitions of a 10 minute window: in the first both
+    exchanges are more than 1% from their median, in the second they agree.
+    """
+
+    start = (CALC_TIME - 600) * 1000
+
+    return pd.DataFrame(
+        {
+            "exchange": ["a", "b", "a", "b", "a", "b"],
+            "time": [start + 1000, start + 2000, start + 301000, start + 302000, start + 303000, start + 304000],
+            "price": [100.0, 120.0, 101.0, 101.0, 102.0, 101.5],
+            "size": [1.0, 1.0, 1.0, 2.0, 1.0, 1.0],
+        }
+    )
+
+
+def test_partition_with_every_exchange_flagged_is_dropped():
+
+    df = trades_with_flagged_partition()
+
+    _, expected, _ = kernels.grouped_weighted_median(df["price"][2:], df["size"][2:], np.zeros(4, dtype=np.int64))
+
+    for trades in [df, containers.TradeBatch.from_frame(df)]:
+
+        rr, output = utilities.calc(trades, 5, CALC_TIME, True, 10, ped=1)
+
+        assert not np.isnan(rr)
+
+        assert rr == expected[0]
+
+        assert len(output) == 1
+
+        assert output["PED_Removed"][0] == []
+
+        assert output["first_trade_prtice"][0] == 101.0
+
+
+def test_partition_with_every_exchange_flagged_is_dropped_with_sketches():
+
+    df = trades_with_flagged_partition()
+
+    rr, output = utilities.calc(df, 5, CALC_TIME, False, 10, ped=1, relative_accuracy=0.001)
+
+    assert len(output) == 1
+
+    assert abs(rr / 101.0 - 1) <= 0.001
+
+
+def test_liquidity_rows_in_exchange_name_order():
+
+    codes = np.array([1, 0, -1, 1])
+
+    size = np.array([1.0, 2.0, 3.0, 4.0])
+
+    liquidity = utilities.liquidity_columns(np.zeros(4, dtype=np.int64), np.ones(4), size, codes, np.array(["b", "a", None], dtype=object), [CALC_TIME], {0: "a"})
+
+    assert list(liquidity["exchanges"]["exchange"]) == ["a", "b", None]
+
+    assert list(liquidity["exchanges"]["Size"]) == [5.0, 2.0, 3.0]
+
+    assert list(liquidity["partitions"]["VWM"]) == [True, False, False]
+
+
+def test_trade_batch_names_trades_without_an_exchange_none():
+
+    df = pd.DataFrame(
+        {
+            "exchange": ["a", "b", None],
+            "time": [1000, 2000, 3000],
+            "price": [10.0, 20.0, 50.0],
+            "size": [1.0, 1.0, 5.0],
+        }
+    )
+
+    batch = containers.TradeBatch.from_frame(df)
+
+    assert list(batch.exchange) == ["a", "b", None]
+
+    assert utilities.weighted_median(batch) == utilities.weighted_median(df) == (50.0, None)
+
+    _, frame_medians, _ = utilities.potentially_errorneous_check(df, 10)
+
+    _, batch_medians, _ = utilities.potentially_errorneous_check(batch, 10)
+
+    assert frame_medians == batch_medians == {"a": 10.0, "b": 20.0, None: 50.0}
+
+    assert batch.to_frame()["exchange"].isna().tolist() == [False, False, True]
+
+    assert batch[1:].exchange.tolist() == ["b", None]
+
+
+def test_parquet_round_trip_with_flagged_trades(tmp_path):
+
+    df = trades_with_flagged_partition()
+
+    df.loc[5, "size"] = -1.0
+
+    trades = utilities.erroneous_check({"trades": df}, False)["trades"]
+
+    _, output = utilities.calc(trades, 5, CALC_TIME, True, 10)
+
+    assert output.columns.is_unique
+
+    assert "first_trade_size_negative" in output and "last_trade_size_negative" in output
+
+    sink = sinks.ResultSink(str(tmp_path), "WeightedMedians", "parquet", 1)
+
+    sink.write(output)
+
+    sink.write(output)
+
+    sink.close()
+
+    data = pd.read_parquet(tmp_path / "WeightedMedians.parquet")
+
+    assert list(data.columns) == list(output.columns)
+
+    assert len(data) == 2 * len(output)
+
+    assert list(data["last_trade_size_negative"]) == 2 * list(output["last_trade_size_negative"])
+
+
+def replay_trades(hours: int = 3, seed: int = 0) -> pd.DataFrame:
+    """
+    'hours' of trades from 5 exchanges with unique times, d is always 20%
+    above the rest and e only in the second hour, so the PED check removes
+    exchanges in some windows only.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    start = (CALC_TIME - hours * 3600) * 1000
+
+    times = start + np.sort(rng.choice(hours * 3600 * 1000, 2000, replace=False))
+
+    exchange = rng.choice(["a", "b", "c", "d", "e"], len(times))
+
+    price = 100 + rng.normal(0, 0.5, len(times))
+
+    second_hour = (times >= start + 3600 * 1000) & (times < start + 2 * 3600 * 1000)
+
+    price[(exchange == "d") | ((exchange == "e") & second_hour)] *= 1.2
+
+    return pd.DataFrame({"exchange": exchange, "time": times, "price": price, "size": rng.uniform(0.1, 2, len(times))})
+
+
+def test_stream_replay_matches_batch_calc():
+
+    df = replay_trades()
+
+    # trades arrive up to 20 seconds out of order, within the lateness.
+    arrival = np.argsort(df["time"].to_numpy() + np.random.default_rng(1).uniform(0, 20000, len(df)), kind="stable")
+
+    first = datetime.fromtimestamp(CALC_TIME - 2 * 3600, tz=timezone.utc)
+
+    rr_stream = stream.RRStream(window=60, partition=5, ped=10, step=60, lateness=30, first_last=True, start=first)
+
+    emitted = []
+
+    for trade in df.iloc[arrival].to_dict("records"):
+
+        emitted += rr_stream.add_trade(trade)
+
+    emitted += rr_stream.advance(CALC_TIME * 1000)
+
+    assert rr_stream.late_trades == 0
+
+    assert len(emitted) == 3
+
+    data = {"trades": containers.TradeIndex(utilities.erroneous_check({"trades": df})["trades"])}
+
+    main.BUCKET_CACHE.clear()
+
+    for hour, (rr, weighted_medians) in enumerate(emitted):
+
+        date = first + timedelta(hours=hour)
+
+        expected_rr, expected, _ = main.calc_trades(data, date, "LTCUSD_RR", 60, 5, 10, True, metrics.StageMetrics(date))
+
+        pd.testing.assert_frame_equal(rr, expected_rr)
+
+        columns = ["VWM_Price", "VWM_Exchange", "first_trade_exchange", "first_trade_prtice", "last_trade_exchange", "last_trade_prtice", "last_trade_datetime"]
+
+        # the batch exchanges are categorical, the stream's plain strings.
+        pd.testing.assert_frame_equal(weighted_medians[columns].astype(object), expected[columns].astype(object))
+
+
+def test_stream_start_off_the_partition_grid():
+
+    with pytest.raises(ValueError):
+
+        stream.RRStream(partition=5, start=datetime.fromtimestamp(CALC_TIME + 60, tz=timezone.utc))
+
+
+def write_days(path, days: int = 2):
+    """
+    'days' daily trade files from 2020-01-01 as main.run reads them, each
+    with the trades of its day and of the hour before.
+    """
+
+    start = int(datetime(2020, 1, 1, tzinfo=timezone.utc).timestamp() * 1000)
+
+    df = replay_trades(24 * days + 1)
+
+    df["time"] += start + days * 86400 * 1000 - CALC_TIME * 1000
+
+    for day in range(days):
+
+        begin = start + day * 86400 * 1000
+
+        trades = df[(df["time"] >= begin - 3600 * 1000) & (df["time"] < begin + 86400 * 1000)]
+
+        name = datetime.fromtimestamp(begin / 1000, tz=timezone.utc).date()
+
+        (path / f"{name}.json").write_text(json.dumps({"time": begin + 16 * 3600 * 1000, "trades": trades.to_dict("records")}))
+
+
+def test_prefetch_counts_files_not_dates(tmp_path):
+
+    (tmp_path / "bucket").mkdir()
+
+    write_days(tmp_path / "bucket")
+
+    prefetcher = sources.Prefetcher(sources.LocalSource(str(tmp_path / "bucket")), str(tmp_path / "downloads"))
+
+    dates = [datetime(2020, 1, 1, hour, tzinfo=timezone.utc) for hour in range(0, 24, 6)] + [datetime(2020, 1, 2, 0, tzinfo=timezone.utc)]
+
+    fetched = []
+
+    def calc_one(date):
+
+        fetched.append(sorted(prefetcher.downloads))
+
+        return date
+
+    assert list(main.iter_prefetched(calc_one, dates, None, 1, prefetcher, 1)) == dates
+
+    # the next day is on its way from the first date of the day before.
+    assert fetched[0] == ["2020-01-01.json", "2020-01-02.json"]
+
+    # a day's file is released once its last date is done.
+    assert fetched[-1] == ["2020-01-02.json"]
+
+    prefetcher.close()
+
+
+def test_remote_run_matches_local_run(tmp_path):
+
+    (tmp_path / "bucket").mkdir()
+
+    write_days(tmp_path / "bucket")
+
+    source = {"type": "local", "root": str(tmp_path / "bucket"), "download_path": str(tmp_path / "downloads"), "prefetch": 1}
+
+    for local, out in [(True, "local"), (False, "remote")]:
+
+        main.DAY_CACHE.clear()
+
+        main.BUCKET_CACHE.clear()
+
+        main.run(str(tmp_path / "bucket") + "/", str(tmp_path / out) + "/", datetime(2020, 1, 1), datetime(2020, 1, 2), "hours", "GMT", 16, 60, 5, [], 10, local, True, source=source, save_metrics=False)
+
+    for file in ["LTCUSD_RR.csv", "WeightedMedians.csv"]:
+
+        assert (tmp_path / "local" / file).read_text() == (tmp_path / "remote" / file).read_text()
+
+    # every download is removed once used.
+    assert os.listdir(tmp_path / "downloads") == []
+
+
+def test_remote_run_without_a_source():
+
+    with pytest.raises(ValueError, match="source"):
+
+        main.run("", "", datetime(2020, 1, 1), datetime(2020, 1, 2), "days", "GMT", 16, 60, 5, [], 10, False, True)
+
+
+def test_resume_after_an_input_changes(tmp_path):
+
+    (tmp_path / "data").mkdir()
+
+    write_days(tmp_path / "data")
+
+    def run(out):
+
+        main.DAY_CACHE.clear()
+
+        main.BUCKET_CACHE.clear()
+
+        main.run(str(tmp_path / "data") + "/", str(tmp_path / out) + "/", datetime(2020, 1, 1), datetime(2020, 1, 2, 12), "hours", "GMT", 16, 60, 5, [], 10, True, True, flush_every=5, resume=True, save_metrics=False)
+
+    run("resumed")
+
+    header = (tmp_path / "resumed" / "WeightedMedians.csv").read_text().splitlines()[0]
+
+    # late corrections to the first day.
+    day = json.loads((tmp_path / "data" / "2020-01-01.json").read_text())
+
+    day["trades"] = day["trades"][::2]
+
+    (tmp_path / "data" / "2020-01-01.json").write_text(json.dumps(day))
+
+    run("resumed")
+
+    run("fresh")
+
+    for file in ["LTCUSD_RR.csv", "WeightedMedians.csv", "PartitionLiquidity.csv", "ExchangeLiquidity.csv"]:
+
+        assert (tmp_path / "resumed" / file).read_text() == (tmp_path / "fresh" / file).read_text()
+
+    rr = pd.read_csv(tmp_path / "resumed" / "LTCUSD_RR.csv")
+
+    assert rr["time"].is_monotonic_increasing and rr["time"].is_unique
+
+    # the same columns as without resume.
+    assert "time" not in header.split(",")
+
+
+def test_grouped_median_sums_each_group_on_its_own():
+
+    # a cumulative share of exactly 0.5 at the 8th trade when the group is
+    # summed on its own, the two prices either side are averaged.
+    size = np.array([0.2, 0.2, 0.2, 0.1, 0.1, 0.2, 0.7, 0.1, 0.3, 0.7, 0.2, 0.2, 0.3, 0.1])
+
+    price = 100.0 + np.arange(len(size))
+
+    before = np.array([0.1, 0.3, 0.7])
+
+    sizes = np.concatenate([before, size])
+
+    groups = np.repeat([0, 1], [len(before), len(size)])
+
+    # summed across groups, the tie is lost.
+    offset_cumsum = np.cumsum(sizes)[len(before):] - sizes[: len(before)].sum()
+
+    assert offset_cumsum[7] / np.add.reduceat(sizes, [0, len(before)])[1] != 0.5
+
+    _, alone, _ = kernels.grouped_weighted_median(price, size, np.zeros(len(size), dtype=np.int64))
+
+    _, medians, _ = kernels.grouped_weighted_median(np.concatenate([before, price]), sizes, groups)
+
+    assert medians[1] == alone[0] == 107.5
+
+
+def test_sweep_matches_separate_runs(tmp_path, monkeypatch):
+
+    write_days(tmp_path, 1)
+
+    calls = []
+
+    exchange_medians = utilities.exchange_medians
+
+    monkeypatch.setattr(utilities, "exchange_medians", lambda df: calls.append(len(df)) or exchange_medians(df))
+
+    # the first hour of the day, when d and e are both 20% above the rest.
+    date = datetime(2020, 1, 1, 1, tzinfo=timezone.utc)
+
+    main.BUCKET_CACHE.clear()
+
+    swept, _ = sweep.sweep_date(date, str(tmp_path) + "/", [30, 60], [5], [10, 30])
+
+    # once per window, not per ped.
+    assert len(calls) == 2
+
+    data = main.load_day(date, str(tmp_path) + "/", True, False, False, None, "LTCUSD_RR", None, None, None, metrics.StageMetrics(date))
+
+    for row in swept.itertuples():
+
+        main.BUCKET_CACHE.clear()
+
+        rr, _, _ = main.calc_trades(data["LTCUSD_RR"], date, "LTCUSD_RR", row.window, row.partition, row.ped, False, metrics.StageMetrics(date))
+
+        assert row.LTCUSD_RR == rr["LTCUSD_RR"][0]
+
+    # d and e are removed at a 10% PED and kept at 30%.
+    assert swept["LTCUSD_RR"].nunique() > 2
+
+
+def test_import_main_loads_no_optional_packages():
+
+    # anything pandas itself imports (pyarrow in pandas 3 when installed) is
+    # not a cost of importing main.
+    code = (
+        "import sys, pandas; before = set(sys.modules); import main; "
+        "print(sorted({m.split('.')[0] for m in set(sys.modules) - before}))"
+    )
+
+    loaded = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True, cwd=os.path.dirname(__file__)).stdout
+
+    for package in ["pyarrow", "fastparquet", "plotly", "IPython", "numba", "sweep"]:
+
+        assert f"'{package}'" not in loaded
+
+
+def test_sinks_append_trim_and_truncate(tmp_path):
+
+    frames = [pd.DataFrame({"time": [i, i], "RR": [i + 0.5, i + 0.25]}) for i in range(5)]
+
+    for frame in frames:
+
+        utilities.write_csv("expected", frame, str(tmp_path) + "/")
+
+    for fmt in ["csv", "parquet"]:
+
+        sink = sinks.ResultSink(str(tmp_path), "RR", fmt, 2)
+
+        for frame in frames[:3]:
+
+            sink.write(frame)
+
+        sink.close()
+
+        if fmt == "csv":
+
+            # a previous run killed mid append.
+            with open(sink.file, "a") as f:
+
+                f.write("3,3.")
+
+        sink = sinks.ResultSink(str(tmp_path), "RR", fmt, 2)
+
+        for frame in frames[3:]:
+
+            sink.write(frame)
+
+        assert sink.rows() == 10
+
+        sink.close()
+
+        if fmt == "csv":
+
+            assert (tmp_path / "RR.csv").read_text() == (tmp_path / "expected.csv").read_text()
+
+        # the second parquet part holds the 5th & 6th rows, cut after the 5th.
+        sink.truncate(5)
+
+        assert sink.rows() == 5
+
+        expected = pd.concat(frames, ignore_index=True)[:5]
+
+        data = pd.read_csv(sink.file) if fmt == "csv" else pd.read_parquet(sink.file)
+
+        pd.testing.assert_frame_equal(data, expected)
@@ -12,15 +12,13 @@ from datetime import datetime, timedelta
 import json
 from pytz import timezone
 import numpy as np
-import plotly.graph_objects as go
-import plotly.express as px
-import plotly.io as pio
-from plotly.subplots import make_subplots
+import kernels
+import containers
+import readers
+import sketch
 
-pio.renderers.default = "browser"
 
-
-def read_json(path: str, file: str) -> dict:
+def read_json(path: str, file: str, markets: list = None) -> dict:
     """
     attempts to read a json file for a given path/directory and file name.
     If file not found error returns none
@@ -31,6 +29,9 @@ def read_json(path: str, file: str) -> dict:
         directory path of file.
     file : str
         file name.
+    markets : list, optional
+        if given only trades from these exchanges are kept. The default is
+        None.
 
     Returns
     -------
@@ -42,6 +43,14 @@ def read_json(path: str, file: str) -> dict:
     try:
         dct = json.load(open(f"{path}{file}"))
 
+        if markets and isinstance(dct.get("trades"), list):
+
+            markets = set(markets)
+
+            dct["trades"] = [
+                t for t in dct["trades"] if isinstance(t, dict) and t.get("exchange") in markets
+            ]
+
         return dct
 
     except FileNotFoundError:
@@ -72,7 +81,7 @@ def ts_to_dt(ts: int) -> datetime:
     return dt
 
 
-def create_list_dates(start: datetime, end: datetime, freq: str) -> list:
+def create_list_dates(start: datetime, end: datetime, freq: str, step: int = 1) -> list:
     """
     takes 2 dates (tz info does not need to be defined but resulting list
                    will have the tz info of the inputs)
@@ -86,6 +95,9 @@ def create_list_dates(start: datetime, end: datetime, freq: str) -> list:
         last date you want , most recent.
     freq : str
         'day','hour','minute'
+    step : int, optional
+        number of freq units between dates i.e. 5 with 'minutes' is every 5
+        minutes. The default is 1.
 
     Returns
     -------
@@ -97,135 +109,191 @@ def create_list_dates(start: datetime, end: datetime, freq: str) -> list:
     if freq == "days":
         dates = [
             start + timedelta(days=x)
-            for x in range(int((end - start).total_seconds()) // 86400 +1)
+            for x in range(0, int((end - start).total_seconds()) // 86400 +1, step)
         ]
     elif freq == "hours":
         dates = [
             start + timedelta(hours=x)
-            for x in range(int((end - start).total_seconds()) // 3600+1)
+            for x in range(0, int((end - start).total_seconds()) // 3600+1, step)
         ]
     elif freq == "minutes":
         dates = [
             start + timedelta(minutes=x)
-            for x in range(int((end - start).total_seconds()) // 60+1)
+            for x in range(0, int((end - start).total_seconds()) // 60+1, step)
         ]
 
     return dates
 
 
-def filter_window(data: dict, date: datetime):
+def filter_window(data: dict, date: datetime, window: int = 60):
     """
-
+    Returns the trades in the window of 'window' minutes up to (not
+    including) the calc time, sorted by time. The window is cut from a
+    containers.TradeIndex (or outofcore.SpilledTrades) by binary search, if
+    "trades" is not one already a TradeIndex is built (sorted) first.
 
     Parameters
     ----------
     data : dict
-        DESCRIPTION.
+        trade file as read by read_json, with the trades under "trades".
     date : datetime
-        DESCRIPTION.
+        calc time, the end of the window. If None the file's "time" is used.
+    window : int, optional
+        window length in minutes. The default is 60.
 
     Returns
     -------
-    None.
+    df : containers.TradeBatch/pd.DataFrame
+        trades in the window with int64 ms times, a TradeBatch unless the
+        trades carry erroneous flags or other columns. See
+        containers.with_datetime for their datetimes.
 
     """
 
-    df = pd.DataFrame(data["trades"])
+    end = float(data["time"]) if date is None else datetime.timestamp(date) * 1000
 
-    df["time"] = df["time"].astype(float)
+    index = data["trades"]
 
-    df["datetime"] = (df["time"] / 1000).map(ts_to_dt)
+    if not hasattr(index, "window"):
 
-    df.sort_values("datetime", inplace=True)
+        index = containers.TradeIndex(index)
 
-    df = df[
-        (df["time"] >= float(data["time"]) - 3600 * 1000)
-        & (df["time"] < float(data["time"]))
-    ]
+    return index.window(end - window * 60 * 1000, end)
 
-    if (
-        len(
-            df[
-                (df["time"] < float(data["time"]) - 3600 * 1000)
-                & (df["time"] >= float(data["time"]))
-            ]
-        )
-        > 0
-    ):
 
-        print(
-            df[
-                (df["time"] < float(data["time"]) - 3600 * 1000)
-                & (df["time"] >= float(data["time"]))
-            ]
-        )
+TRADE_FIELDS = ["exchange", "time", "price", "size"]
 
-    return df
 
+def validate_trades(trades) -> [pd.DataFrame, dict]:
+    """
+    Columnar validation of a batch of trades. Checks every trade for missing
+    fields, non numerical price/size and negative price/size in one vectorised
+    pass. As in the original per trade check, value checks are only applied to
+    trades with all fields present. A field set to null counts as missing.
+
+    Parameters
+    ----------
+    trades : list/dict/pd.DataFrame
+        trades as a list of dicts (raw json) or in columns, anything
+        pd.DataFrame accepts.
 
+    Returns
+    -------
+    flags : pd.DataFrame
+        one boolean column per check, True where the trade fails it.
+    summary : dict
+        number of trades failing each check.
 
-def erroneous_check(data: dict) -> dict:
     """
 
+    trades = pd.DataFrame(trades)
+
+    flags = pd.DataFrame(index=trades.index)
+
+    for i in TRADE_FIELDS:
+
+        flags[f"missingField {i}"] = trades[i].isna() if i in trades else True
+
+    complete = ~flags.any(axis=1)
+
+    for i in ["price", "size"]:
+
+        if i not in trades:
+
+            flags[f"{i}_non_numerical"] = False
+
+            flags[f"{i}_negative"] = False
+
+            continue
+
+        if pd.api.types.is_numeric_dtype(trades[i]) and not pd.api.types.is_bool_dtype(trades[i]):
+
+            numerical = pd.Series(True, index=trades.index)
+
+        else:
+
+            numerical = trades[i].map(lambda x: isinstance(x, (float, int)))
+
+        flags[f"{i}_non_numerical"] = complete & ~numerical
+
+        flags[f"{i}_negative"] = (
+            complete
+            & numerical
+            & (pd.to_numeric(trades[i].where(numerical), errors="coerce") < 0)
+        )
+
+    summary = {i: int(flags[i].sum()) for i in flags}
+
+    return flags, summary
+
+
+def erroneous_check(data: dict, drop: bool = False) -> dict:
+    """
+    Flags (or drops) erroneous trades: missing fields, non numerical or
+    negative price/size. Flag columns are only added for checks that at least
+    one trade fails and a summary is printed once if anything is found.
 
     Parameters
     ----------
     data : dict
-        DESCRIPTION.
+        trade file as read by read_json, with the trades under "trades". The
+        typed readers (see readers.TradeColumns) have already made the checks
+        on the raw trades, their "flags" are used rather than checking again.
+    drop : bool, optional
+        If True erroneous trades are removed rather than flagged.
+        The default is False.
 
     Returns
     -------
-    None.
+    data : dict
+        the input with "trades" replaced by a DataFrame of the checked trades.
 
     """
 
-    for trade in data["trades"]:
-
-        error = False
-
-        index = data["trades"].index(trade)
-
-        for i in ["exchange", "time", "price", "size"]:
+    trades = pd.DataFrame(data["trades"])
 
-            if i not in trade:
+    if data.get("flags") is not None:
 
-                data["trades"][index].update({f"missingField {i}": True})
+        flags = pd.DataFrame(readers.flag_columns(data.pop("flags")), index=trades.index)
 
-                print(f"Trade missing {i} : \n{trade}")
+        summary = {i: int(flags[i].sum()) for i in flags}
 
-                error = True
+        # trades without a readable time were only counted by the reader.
+        unread = data.get("rejected", 0)
 
-        if error == False:
+        summary["missingField time"] += unread
 
-            if not isinstance(trade["price"], (float, int)):
+    else:
 
-                data["trades"][index].update({"price_non_numerical": True})
+        flags, summary = validate_trades(trades)
 
-                print("ERROR")
+        unread = 0
 
-            if not isinstance(trade["size"], (float, int)):
+    erroneous = flags.any(axis=1)
 
-                data["trades"][index].update({"size_non_numerical": True})
+    if erroneous.any() or unread > 0:
 
-                print("ERROR")
+        print(f"ERRONEOUS TRADES: {int(erroneous.sum()) + unread} {summary}")
 
-            try:
+    if drop == True:
 
-                if trade["price"] < 0:
+        trades = trades[~erroneous]
 
-                    data["trades"][index].update({"price_negative": True})
+    else:
 
-                    print("ERROR")
+        # flagged prices & sizes that are not numbers are kept as nan, as the
+        # typed readers hold them, so every loader calculates the same.
+        for i in ["price", "size"]:
 
-                if trade["size"] < 0:
+            if i in trades and not pd.api.types.is_numeric_dtype(trades[i]):
 
-                    data["trades"][index].update({"size_negative": True})
+                trades[i] = pd.to_numeric(trades[i].mask(flags[f"{i}_non_numerical"]), errors="coerce")
 
-                    print("ERROR")
+        failed = flags.columns[flags.any() | (flags.columns == "missingField time") & (unread > 0)]
 
-            except TypeError:
+        trades = pd.concat([trades, flags[failed]], axis=1)
 
-                print("Data Not Numerical")
+    data["trades"] = trades
 
     return data
 
@@ -245,58 +313,33 @@ def weighted_median(df: pd.DataFrame) -> float:
         DESCRIPTION.
 
     """
-    df = df.sort_values("price").reset_index().copy()
-
-    df["cumvol_percent"] = df["size"].cumsum() / df["size"].sum()
-
-    if df["cumvol_percent"].iloc[0] >= 0.5:
-
-        w_median = df["price"].iloc[0]
+    _, price, size, codes, names = containers.as_arrays(df)
 
-        exchange = df["exchange"].iloc[0]
-
-    else:
-
-        w_median_index = df[df["cumvol_percent"] < 0.5].index[-1] + 1
-
-        if df["cumvol_percent"].iloc[w_median_index] == 0.5:
-
-            w_median = (
-                df["price"].iloc[w_median_index]
-                + df["price"].iloc[w_median_index + 1]
-            ) / 2
+    keys, medians, winners = kernels.grouped_weighted_median(
+        price, size, np.zeros(len(price), dtype=np.int64), codes
+    )
 
-            exchange = df["exchange"].iloc[w_median_index]
+    return medians[0], names[winners[0]]
 
-        else:
-            w_median = df["price"].iloc[w_median_index]
 
-            exchange = df["exchange"].iloc[w_median_index]
+def exchange_medians(data: pd.DataFrame) -> [dict, float]:
+    """VWM of each exchange in data and the median of those VWMs."""
 
-    return w_median, exchange
+    _, price, size, codes, exchanges = containers.as_arrays(data)
 
+    keys, medians, _ = kernels.grouped_weighted_median(price, size, codes)
 
-def potentially_errorneous_check(data:pd.DataFrame,ped_param:float ):
-    
-    wm_e = {}
+    return dict(zip(exchanges[keys], medians)), np.median(medians)
 
-    medians = []
 
-    for exchange in list(data["exchange"].unique()):
-
-        wm_e.update(
-            {
-                exchange: weighted_median(
-                    data[data["exchange"] == exchange]
-                )[0]
-            }
-        )
-
-        medians.append(
-            weighted_median(data[data["exchange"] == exchange])[0]
-        )
+def potentially_errorneous_check(data:pd.DataFrame,ped_param:float, medians: tuple = None):
+    """
+    Exchanges whose VWM is more than ped_param % from the median of the
+    exchange VWMs. 'medians' are the exchange_medians of data if already
+    known, i.e. to check one window against several PED parameters.
+    """
 
-    median_wm_e = np.median(medians)
+    wm_e, median_wm_e = exchange_medians(data) if medians is None else medians
 
     potentially_erroneous = [
         i for i in wm_e if abs(wm_e[i] / median_wm_e - 1) > ped_param/100
@@ -305,20 +348,23 @@ def potentially_errorneous_check(data:pd.DataFrame,ped_param:float ):
     return potentially_erroneous, wm_e, median_wm_e
 
 
-def calc(df: pd.DataFrame, partition: int,  calc_time: float, first_last : bool) -> [pd.DataFrame, float]:
+def calc(df: pd.DataFrame, partition: int,  calc_time: float, first_last : bool, window: int = 60, cache: dict = None, cache_key: tuple = (), ped: float = None, relative_accuracy: float = None, liquidity: dict = None) -> [pd.DataFrame, float]:
     """
     function to calc _RR indices: Partitions into buckets, 
     Calculates the VWM of each bucket & averages into the final TWAP _RR
-    price for the hour. 
+    price for the window. 
     
     Each stage of the calculation is returned.
     
-    !!! Still fixed to one hour. 
+    Bucket VWMs can be kept in 'cache' between calls, so that a rolling
+    schedule (i.e. 60 minute window every 5 minutes) only calculates the
+    buckets that are new to each window. Buckets that have slid out of the
+    window are evicted from the cache.
 
 
     Parameters
     ----------
-    df : pd.DataFrame
+    df : containers.TradeBatch/pd.DataFrame
         input data consissting of trades, formateed and all erroneous and potentially
         errorneous data removed.
     partition : int
@@ -328,50 +374,244 @@ def calc(df: pd.DataFrame, partition: int,  calc_time: float, first_last : bool)
     first_last : bool
         TRUE: The first and last trade of each bucket will be saved.
         FALSE: Not saved. 
+    window : int, optional
+        Length of the window in minutes. The default is 60.
+    cache : dict, optional
+        bucket VWMs from previous calls, updated in place. The default is None.
+    cache_key : tuple, optional
+        identifies the input a bucket was calculated from (i.e. the file and
+        the exchanges removed by the PED check), a cached bucket is only
+        reused for the same key. The default is ().
+    ped : float, optional
+        If given the PED check is applied per partition with this parameter
+        (as a %), in the same grouped pass as the bucket VWMs, and the removed
+        exchanges of each bucket are added to the output as 'PED_Removed'.
+        First/last trades are still of the whole partition. Partitions where
+        every exchange is removed are left out of the output and the RR. The
+        default is None, df has already been PED checked over the window.
+    relative_accuracy : float, optional
+        If given bucket VWMs (and per partition PED checks) are approximate,
+        read from quantile sketches of each bucket & exchange rather than
+        sorting the trades, within this relative error. VWM_Exchange is then
+        the exchange with the most volume around the VWM. The default is
+        None, exact.
+    liquidity : dict, optional
+        If given it is filled in place with liquidity columns from the same
+        bucket ids: 'partitions', the Volume (price x size), Size, Trades and
+        VWM (True if it set the partition's VWM) of each partition & exchange,
+        and 'exchanges', the totals of each exchange over the window with its
+        share of the volume and of the partition VWMs. The default is None.
 
     Returns
     -------
-    
+    float
+        the _RR, mean of the bucket VWMs.
+    output : pd.DataFrame
+        VWM and exchange of each bucket, with first/last trades if requested.
 
     """
 
-    start = int(calc_time) - 3600
+    start = int(calc_time) - window * 60
 
-    bucket_starts = [start + 60 * i for i in range(0, 60, partition)]
+    bucket_starts = [start + 60 * i for i in range(0, window, partition)]
+
+    # sort the window once and give every trade its bucket id in one step,
+    # each bucket is then a contiguous slice of the sorted trades.
+    df = containers.sort_by_time(df)
+
+    time, price, size, codes, names = containers.as_arrays(df)
+
+    bucket_ids = ((time - start * 1000) // (60 * partition * 1000)).astype(np.int64)
+
+    in_window = (bucket_ids >= 0) & (bucket_ids < len(bucket_starts))
+
+    if not in_window.all():
+
+        df = df[in_window]
+
+        price, size, codes, bucket_ids = price[in_window], size[in_window], codes[in_window], bucket_ids[in_window]
+
+    if cache is None:
+
+        cache = {}
+
+    for key in [k for k in cache if k[2] < start]:
+
+        del cache[key]
+
+    # a bucket is identified by its start and (clipped) end, so a partial last
+    # bucket is not confused with the full bucket of a later window.
+    keys = [
+        (cache_key, partition, bs, min(bs + 60 * partition, start + window * 60))
+        for bs in bucket_starts
+    ]
+
+    buckets = np.unique(bucket_ids)
+
+    missing = [b for b in buckets if keys[b] not in cache]
+
+    if len(missing) > 0:
+
+        new = np.isin(bucket_ids, missing)
+
+        # the kernels work on the exchange codes, names are only looked up for
+        # the winning trades.
+        if relative_accuracy is not None:
+
+            calced, vwms, winners, removed = sketch.grouped_sketch_median(
+                price[new], size[new], bucket_ids[new], codes[new], relative_accuracy, ped
+            )
+
+            for b, vwm, winner, r in zip(calced, vwms, winners, removed):
+
+                cache[keys[b]] = (vwm, None if winner < 0 else names[winner], sorted(names[r]))
+
+        elif ped is None:
+
+            calced, vwms, winners = kernels.grouped_weighted_median(
+                price[new], size[new], bucket_ids[new], codes[new]
+            )
+
+            for b, vwm, winner in zip(calced, vwms, winners):
+
+                cache[keys[b]] = (vwm, names[winner])
+
+        else:
+
+            calced, vwms, winners, removed = kernels.grouped_ped_weighted_median(
+                price[new], size[new], bucket_ids[new], codes[new], ped, codes[new]
+            )
+
+            for b, vwm, winner, r in zip(calced, vwms, winners, removed):
+
+                cache[keys[b]] = (vwm, None if winner is None else names[winner], sorted(names[r]))
+
+    if ped is not None:
+
+        # a partition whose every exchange was removed by the PED check has
+        # no trades left to price, it is dropped like a partition without
+        # trades rather than making the RR nan.
+        buckets = buckets[[cache[keys[b]][1] is not None for b in buckets]]
+
+    weighted_medians = np.array([cache[keys[b]][0] for b in buckets], dtype=np.float64)
+
+    exchanges = [cache[keys[b]][1] for b in buckets]
+
+    firsts = np.searchsorted(bucket_ids, buckets, side="left")
+
+    lasts = np.searchsorted(bucket_ids, buckets, side="right") - 1
+
+    output = pd.DataFrame(
+        {
+            "ExecTime": [datetime.fromtimestamp(bucket_starts[b]) for b in buckets],
+            "VWM_Price": weighted_medians,
+            "VWM_Exchange": exchanges,
+        }
+    )
+
+    if ped is not None:
+
+        output["PED_Removed"] = [cache[keys[b]][2] for b in buckets]
+
+    if liquidity is not None:
+
+        liquidity.update(liquidity_columns(bucket_ids, price, size, codes, names, [datetime.fromtimestamp(bs) for bs in bucket_starts], dict(zip(buckets, exchanges))))
+
+    if first_last == True:
+
+        # datetimes are only built for the first & last trades. Any other
+        # column (i.e. the erroneous check flags) is prefixed as well so the
+        # first & last columns never share a name.
+        first = containers.with_datetime(containers.take(df, firsts)).drop("time", axis=1).rename(columns={"exchange": "first_trade_exchange","datetime":"first_trade_datetime","size":"first_trade_size","price":"first_trade_prtice"})
+
+        first = first.rename(columns=lambda c: c if c.startswith("first_trade_") else f"first_trade_{c}")
+
+        last = containers.with_datetime(containers.take(df, lasts)).drop("time", axis=1).rename(columns={"exchange": "last_trade_exchange","datetime":"last_trade_datetime","size":"last_trade_size","price":"last_trade_prtice"})
+
+        last = last.rename(columns=lambda c: c if c.startswith("last_trade_") else f"last_trade_{c}")
+
+        output = pd.concat([output, first, last], axis=1)
 
-    output = pd.DataFrame()
-    
-    weighted_medians = []
-
-    for bs in bucket_starts:
-
-        print(f"Calcing Bucket : {ts_to_dt(bs)}")
-
-        bucket = df[
-            (df["time"] >= bs* 1000) & (df["time"] < (bs + 60 * partition) * 1000)
-        ].copy()
-
-        if len(bucket) > 0:
-
-            vwm, exchange = weighted_median(bucket)
-            
-            weighted_medians.append(vwm)
-            
-            if first_last == True:
-                
-                first = bucket.head(1).copy().reset_index(drop=True).drop('time',axis=1).rename(columns={"exchange": "first_trade_exchange","datetime":"first_trade_datetime","size":"first_trade_size","price":"first_trade_prtice"})
-                
-                last = bucket.tail(1).copy().reset_index(drop=True).drop('time',axis=1).rename(columns={"exchange": "last_trade_exchange","datetime":"last_trade_datetime","size":"last_trade_size","price":"last_trade_prtice"})
-
-                output = pd.concat([output, pd.concat([pd.DataFrame({"ExecTime":[datetime.fromtimestamp(bs)], "VWM_Price":[vwm], "VWM_Exchange":[exchange]}),first, last],axis=1)])
-                
-            else: 
-                
-                output = pd.concat([output, pd.DataFrame({"ExecTime":[datetime.fromtimestamp(bs)], "VWM_Price":[vwm], "VWM_Exchange":[exchange]})])
-                
     return np.mean(weighted_medians), output
 
 
+def liquidity_columns(bucket_ids: np.ndarray, price: np.ndarray, size: np.ndarray, codes: np.ndarray, names: np.ndarray, exec_times: list, winners: dict) -> dict:
+    """
+    Volume, size & trade count of every partition & exchange of a window in
+    one pass over the trades' bucket ids & exchange codes (see calc for
+    the columns).
+
+    Parameters
+    ----------
+    bucket_ids, price, size, codes : np.ndarray
+        bucket id, price, size & exchange code of each trade in the window.
+    names : np.ndarray
+        exchange name of each code, as containers.as_arrays. Rows are in
+        exchange name order, trades without an exchange last.
+    exec_times : list
+        start of each bucket id.
+    winners : dict
+        bucket id -> exchange that set its VWM.
+
+    Returns
+    -------
+    dict
+        {'partitions': {column: array}, 'exchanges': {column: array}}.
+
+    """
+
+    # trades without an exchange have code -1, named by the trailing None.
+    codes = np.where(codes < 0, len(names) - 1, codes)
+
+    # columns (so rows) in exchange name order, whatever order the loader
+    # coded the exchanges in.
+    order = np.array(sorted(range(len(names)), key=lambda e: (names[e] is None, str(names[e]))), dtype=np.int64)
+
+    column = np.empty(len(order), dtype=np.int64)
+
+    column[order] = np.arange(len(order))
+
+    exchange_index = column[codes]
+
+    names = names[order]
+
+    cells = bucket_ids * len(names) + exchange_index
+
+    shape = (len(exec_times), len(names))
+
+    volume, traded, trades = (
+        t.reshape(shape) for t in kernels.cell_totals(cells, price, size, shape[0] * shape[1])
+    )
+
+    vwm = np.array([[winners.get(b) == e for e in names] for b in range(shape[0])], dtype=bool).reshape(shape)
+
+    b, e = np.nonzero(trades)
+
+    partitions = {
+        "ExecTime": np.array([exec_times[i] for i in b], dtype=object),
+        "exchange": names[e],
+        "Volume": volume[b, e],
+        "Size": traded[b, e],
+        "Trades": trades[b, e],
+        "VWM": vwm[b, e],
+    }
+
+    present = np.flatnonzero(trades.sum(axis=0))
+
+    exchanges = {
+        "exchange": names[present],
+        "Volume": volume.sum(axis=0)[present],
+        "Size": traded.sum(axis=0)[present],
+        "Trades": trades.sum(axis=0)[present],
+        "Volume_Share": volume.sum(axis=0)[present] / volume.sum(),
+        "Partitions": (trades > 0).sum(axis=0)[present],
+        "VWM_Partitions": vwm.sum(axis=0)[present],
+        "VWM_Share": vwm.sum(axis=0)[present] / max(1, len(winners)),
+    }
+
+    return {"partitions": partitions, "exchanges": exchanges}
+
+
 def write_csv(index_name: str, data: pd.DataFrame, output_path: str):
     """
     writes dataframe to CSV
@@ -399,6 +639,23 @@ def write_csv(index_name: str, data: pd.DataFrame, output_path: str):
     )
 
 
+def _plotly():
+    """
+    plotly's graph_objects, express, io & make_subplots, imported on the first
+    plot rather than with this module so calc runs never load plotly. Plots
+    open in the browser.
+    """
+
+    import plotly.graph_objects as go
+    import plotly.express as px
+    import plotly.io as pio
+    from plotly.subplots import make_subplots
+
+    pio.renderers.default = "browser"
+
+    return go, px, pio, make_subplots
+
+
 def plot(
     df_plot: pd.DataFrame,
     order: list,
@@ -422,6 +679,8 @@ def plot(
     plotly plot in browser
 
     """
+    go, _, pio, _ = _plotly()
+
     fig = go.Figure()
 
     for col in order:
@@ -478,10 +737,9 @@ def write_excel_append(path: str, file_name: str,sheet_name:str, data:dict):
 
     """
     with pd.ExcelWriter(f"{path}{file_name}.xlsx", mode='a', engine='openpyxl') as writer:
-        
-        
-        
-        
+
+        pd.DataFrame(data).to_excel(writer, sheet_name=sheet_name, index=False)
+
 
 
 def plotly_palette(
@@ -519,6 +777,8 @@ def plotly_palette(
 
     else:
 
+        _, px, _, _ = _plotly()
+
         segs = (number - len(base)) / len(base)
 
         interpolated_palette = []
@@ -569,6 +829,8 @@ def rgb_to_hex(rgb: tuple) -> str:
 
 
 def plot_bar_and_scatter(bar, line, title, x_name, y1_name, y2_name):
+    go, _, _, make_subplots = _plotly()
+
     fig = make_subplots(specs=[[{"secondary_y": True}]])
 
     fig.add_trace(
@@ -621,6 +883,8 @@ def plot_lines(
     plotly plot in browser
 
     """
+    go, _, pio, _ = _plotly()
+
     fig = go.Figure()
 
     for col in order:
@@ -686,6 +950,8 @@ def plot_daily_bar_chart(
     df, x_column, y_column, color_column, title, x_label, y_label, palette
 ):
 
+    go, _, _, _ = _plotly()
+
     i = 0
 
     traces = []
@@ -718,6 +984,8 @@ def plot_daily_bar_chart(
 
 def plot_bar_chart(df, palette, title, x_title, y_title):
 
+    go, _, _, _ = _plotly()
+
     i = 0
 
     fig = go.Figure()